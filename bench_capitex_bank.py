@@ -0,0 +1,1281 @@
+# Benchmarks for the CapitEx banking core
+# Run from this folder, e.g. python bench_capitex_bank.py journal --sizes 1000 1000000
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+
+from capitex_bank import CapitEx_App, Account_User, Bank_Account, Transaction_Journal, Lazy_User_Table, Account_Store, Bank_Service, Batch_Engine, Bank_Server, Credential_Hasher, Account_Number_Allocator, Money, parse_cents, SQLite_Storage, read_signups, Transaction_Ledger, Shard_Router, Sharded_Batch_Engine, username_shard, Interest_Schedule, Snapshot_Storage, Reconciler, Session_Table
+
+
+# Builds a user table of the given size with predictable names and balances
+def make_users(count):
+    users = {}
+    for i in range(count):
+        username = f"user{i:08d}"
+        users[username] = Account_User(username, "password@12", Bank_Account(str(10000000 + i), 500.0))
+    return users
+
+
+# Writes the users the same way CapitEx_App.save_users does
+def write_snapshot(path, users):
+    with open(path, mode='w', newline='') as user_file:
+        writer = csv.writer(user_file)
+        for user in users.values():
+            writer.writerow([user.username, user.password, user.account.account_number, user.account.check_balance()])
+        user_file.flush()
+        os.fsync(user_file.fileno())
+
+
+def user_row(user):
+    return [user.username, user.password, user.account.account_number, user.account.check_balance()]
+
+
+# Compares per-deposit latency of the journal against a full .csv rewrite
+# The journal run includes its share of snapshot compaction
+def bench_journal(sizes, operations, rewrites, sync):
+    print(f"{'users':>10} {'journal us/op':>14} {'rewrite us/op':>14}")
+    for size in sizes:
+        users = make_users(size)
+        names = list(users)
+        with tempfile.TemporaryDirectory() as folder:
+            snapshot = os.path.join(folder, "bank_users.csv")
+            journal = Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync)
+
+            start = time.perf_counter()
+            for i in range(operations):
+                user = users[names[i * 7919 % size]]
+                user.account.deposit(10)
+                journal.append([user_row(user)])
+                if journal.records >= max(1000, len(users)):
+                    write_snapshot(snapshot, users)
+                    journal.reset()
+            journal_time = (time.perf_counter() - start) / operations
+            journal.close()
+
+            start = time.perf_counter()
+            for i in range(rewrites):
+                write_snapshot(snapshot, users)
+            rewrite_time = (time.perf_counter() - start) / rewrites
+
+        print(f"{size:>10} {journal_time * 1e6:>14.1f} {rewrite_time * 1e6:>14.1f}")
+
+
+# Writes a .csv user file of the given size without building any users
+def write_user_file(path, count, password="password@12"):
+    with open(path, mode='w', newline='') as user_file:
+        for start in range(0, count, 100000):
+            user_file.write("".join(f"user{i:08d},{password},{10000000 + i},500.0\n" for i in range(start, min(count, start + 100000))))
+
+
+# Measures lazy startup with and without the sidecar index, and random lookup latency
+def bench_lazy(sizes, lookups, capacity):
+    print(f"{'users':>10} {'cold start s':>13} {'warm start s':>13} {'lookup us':>10} {'cached':>8}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bank_users.csv")
+            write_user_file(path, size)
+            journal = Transaction_Journal(os.path.join(folder, "bank_users.journal"))
+
+            start = time.perf_counter()
+            Lazy_User_Table(path, journal, capacity)
+            cold = time.perf_counter() - start
+
+            start = time.perf_counter()
+            users = Lazy_User_Table(path, journal, capacity)
+            warm = time.perf_counter() - start
+
+            names = [f"user{random.randrange(size):08d}" for _ in range(lookups)]
+            start = time.perf_counter()
+            for username in names:
+                users.get(username)
+            lookup = (time.perf_counter() - start) / lookups
+            users.base_file.close()
+
+        print(f"{size:>10} {cold:>13.2f} {warm:>13.3f} {lookup * 1e6:>10.1f} {len(users.cache):>8}")
+
+
+# Compares memory per account of the users dictionary and the Account_Store
+# and times the aggregate queries on the store
+def bench_store(sizes):
+    print(f"{'users':>10} {'dict bytes':>11} {'store bytes':>12} {'total ms':>9} {'histogram ms':>13}")
+    for size in sizes:
+        tracemalloc.start()
+        users = {}
+        for i in range(size):
+            username = f"user{i:08d}"
+            users[username] = Account_User(username, f"password{i}", Bank_Account(str(10000000 + i), 500.0))
+        dict_bytes = tracemalloc.get_traced_memory()[0] / size
+        del users
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        store = Account_Store()
+        for i in range(size):
+            store.add(f"user{i:08d}", f"password{i}", str(10000000 + i), 500.0)
+        store_bytes = tracemalloc.get_traced_memory()[0] / size
+        tracemalloc.stop()
+
+        start = time.perf_counter()
+        store.total_deposits()
+        total = time.perf_counter() - start
+        start = time.perf_counter()
+        store.balance_histogram([0, 100, 1000, 10000])
+        histogram = time.perf_counter() - start
+
+        print(f"{size:>10} {dict_bytes:>11.0f} {store_bytes:>12.0f} {total * 1e3:>9.2f} {histogram * 1e3:>13.2f}")
+
+
+# Yields random transfer operations between the given users as JSON lines
+def transfer_lines(names, count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield json.dumps({"op": "transfer", "username": rng.choice(names), "recipient": rng.choice(names),
+                          "amount": rng.randrange(1, 500)})
+
+
+# Runs random transfers on a thread pool and checks that no money is created or lost
+def bench_stress(accounts, transfers, workers_list, sync):
+    print(f"{'workers':>8} {'ops/s':>10} {'failed':>8} {'conserved':>10}")
+    for workers in workers_list:
+        with tempfile.TemporaryDirectory() as folder:
+            service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                   Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync))
+            service.users = make_users(accounts)
+            expected = sum(user.account.check_balance() for user in service.users.values())
+
+            report = Batch_Engine(service, workers=workers).run(transfer_lines(list(service.users), transfers, workers))
+            service.close()
+
+            total = sum(user.account.check_balance() for user in service.users.values())
+            overdrawn = sum(1 for user in service.users.values() if user.account.check_balance() < 0)
+        print(f"{workers:>8} {report['ops_per_second']:>10.0f} {report['failed']:>8} {str(total == expected and not overdrawn):>10}")
+
+
+# Yields deposits spread over the given users as JSON lines
+def deposit_lines(names, count):
+    for i in range(count):
+        yield json.dumps({"op": "deposit", "username": names[i * 7919 % len(names)], "amount": 5})
+
+
+# Compares fsync-per-operation journaling with group commit on the same deposit stream
+def bench_commit(accounts, deposits, workers, interval, batch_size):
+    print(f"{'mode':>14} {'ops/s':>10} {'journal rows':>13}")
+    for mode in ("sync", "group commit"):
+        with tempfile.TemporaryDirectory() as folder:
+            service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                   Transaction_Journal(os.path.join(folder, "bank_users.journal")))
+            service.users = make_users(accounts)
+            service.compact_threshold = 10 ** 9
+            if mode == "group commit":
+                service.enable_group_commit(interval, batch_size)
+
+            start = time.perf_counter()
+            Batch_Engine(service, workers=workers).run(deposit_lines(list(service.users), deposits))
+            service.wait_durable()
+            seconds = time.perf_counter() - start
+            rows = service.journal.records
+            service.close()
+        print(f"{mode:>14} {deposits / seconds:>10.0f} {rows:>13}")
+
+
+# Reports logins/sec at each hash cost, paying the hash every time and through the login cache
+def bench_credentials(scheme, costs, logins, budget):
+    if budget:
+        tuned = Credential_Hasher.tuned(budget, scheme)
+        print(f"cost tuned to a {budget * 1e3:.0f} ms budget: {tuned.cost}")
+        costs = sorted(set(costs) | {tuned.cost})
+    print(f"{'scheme':>14} {'cost':>8} {'hashed logins/s':>16} {'cached logins/s':>16}")
+    for cost in costs:
+        with tempfile.TemporaryDirectory() as folder:
+            service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                   Transaction_Journal(os.path.join(folder, "bank_users.journal")))
+            service.credentials = Credential_Hasher(scheme, cost)
+            service.users = {"lennyzhe": Account_User("lennyzhe", service.credentials.hash("password@12"),
+                                                      Bank_Account("12345678", 500.0))}
+
+            start = time.perf_counter()
+            for _ in range(logins):
+                service.login_cache.entries.clear()
+                service.login("lennyzhe", "password@12")
+            hashed = logins / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in range(logins * 100):
+                service.login("lennyzhe", "password@12")
+            cached = logins * 100 / (time.perf_counter() - start)
+            service.close()
+        print(f"{scheme:>14} {cost:>8} {hashed:>16.1f} {cached:>16.0f}")
+
+
+def bench_accounts(count, lookups):
+    with tempfile.TemporaryDirectory() as folder:
+        allocator = Account_Number_Allocator(os.path.join(folder, "bank_users.csv.seq"))
+        start = time.perf_counter()
+        numbers = allocator.allocate_many(count)
+        seconds = time.perf_counter() - start
+    print(f"allocated {count} numbers in {seconds:.2f} s, collisions={count - len(set(numbers))}")
+
+    # The old scheme drew random numbers and could hand out the same one twice
+    drawn = [random.randint(10000000, 999999999) for _ in range(count)]
+    print(f"random draws of the same size: collisions={count - len(set(drawn))}")
+
+    users = Account_Store()
+    start = time.perf_counter()
+    for i, number in enumerate(numbers):
+        users.add(f"user{i:07d}", "password@12", number, 100)
+    print(f"indexed {count} accounts in {time.perf_counter() - start:.2f} s")
+
+    sample = random.Random(7).sample(numbers, lookups)
+    start = time.perf_counter()
+    for number in sample:
+        users.account_owner(number)
+    indexed = (time.perf_counter() - start) / lookups
+
+    # A scan over every account is what a lookup without the index costs
+    start = time.perf_counter()
+    for number in sample[:5]:
+        next(user for user in users.values() if user.account.account_number == number)
+    scanned = (time.perf_counter() - start) / 5
+    print(f"lookup by account number: indexed {indexed * 1e6:.2f} us, scan {scanned * 1e3:.1f} ms")
+
+
+# The float balance account that Money replaced, kept to compare against
+class Float_Account:
+    def __init__(self, balance=0.0):
+        self.balance = balance
+
+    def deposit(self, amount):
+        if 1 <= amount < 3000:
+            self.balance += amount
+            return True
+        return False
+
+    def withdraw(self, amount):
+        if 0 < amount <= self.balance:
+            self.balance -= amount
+            return True
+        return False
+
+
+def amount_texts(count, seed):
+    rng = random.Random(seed)
+    return [f"{rng.randrange(1, 3000)}.{rng.randrange(100):02d}" for _ in range(count)]
+
+
+def time_pairs(account, amounts, operations):
+    deposit, withdraw = account.deposit, account.withdraw
+    start = time.perf_counter()
+    for i in range(operations):
+        amount = amounts[i & 1023]
+        deposit(amount)
+        withdraw(amount)
+    return (time.perf_counter() - start) / (2 * operations)
+
+
+def bench_money(operations, replay):
+    texts = amount_texts(1024, 1)
+    print(f"{'':>24} {'float ns/op':>12} {'Money ns/op':>12}")
+
+    # Hot path: amounts are parsed once at the edge, then applied to the balance
+    floats = [float(text) for text in texts]
+    moneys = [Money.parse(text) for text in texts]
+    old = time_pairs(Float_Account(), floats, operations)
+    new = time_pairs(Bank_Account("12345678"), moneys, operations)
+    print(f"{'deposit + withdraw':>24} {old * 1e9:>12.0f} {new * 1e9:>12.0f}")
+
+    column = amount_texts(operations, 2)
+    start = time.perf_counter()
+    list(map(float, column))
+    old = (time.perf_counter() - start) / operations
+    start = time.perf_counter()
+    list(map(parse_cents, column))
+    new = (time.perf_counter() - start) / operations
+    print(f"{'parse balance column':>24} {old * 1e9:>12.0f} {new * 1e9:>12.0f}")
+
+    # Replays deposits and withdrawals against both balances and an exact integer tally
+    rng = random.Random(3)
+    steps = [(rng.random() < 0.5, text, float(text), Money.parse(text), int(text.replace(".", ""))) for text in amount_texts(4096, 4)]
+    float_account, money_account, exact = Float_Account(), Bank_Account("12345678"), 0
+    start = time.perf_counter()
+    for i in range(replay):
+        is_deposit, text, as_float, as_money, cents = steps[i & 4095]
+        if is_deposit:
+            if money_account.deposit(as_money):
+                exact += cents
+                float_account.balance += as_float
+        elif money_account.withdraw(as_money):
+            exact -= cents
+            float_account.balance -= as_float
+    seconds = time.perf_counter() - start
+    drift = abs(float_account.balance * 100 - exact)
+    print(f"replayed {replay} operations in {seconds:.1f} s: Money off by {money_account.cents - exact} cents, "
+          f"float off by {drift:.4f} cents")
+
+
+# One employer paying every employee, cycling through them when there are more legs than employees
+def bench_payroll(sizes, employees, sync):
+    print(f"{'legs':>9} {'per-call s':>11} {'batch s':>9} {'speedup':>8}")
+    for legs in sizes:
+        staff = min(legs, employees)
+        rng = random.Random(legs)
+        pay = [(f"emp{i % staff:07d}", rng.randrange(1000, 3000)) for i in range(legs)]
+        timings = []
+        for batched in (False, True):
+            with tempfile.TemporaryDirectory() as folder:
+                service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                       Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync))
+                service.users = {f"emp{i:07d}": Account_User(f"emp{i:07d}", "password@12", Bank_Account(str(10000000 + i)))
+                                 for i in range(staff)}
+                service.users["employer"] = Account_User("employer", "password@12", Bank_Account("99999999", 3000 * legs))
+                start = time.perf_counter()
+                if batched:
+                    service.transfer_batch(("employer", employee, amount) for employee, amount in pay)
+                else:
+                    for employee, amount in pay:
+                        service.transfer("employer", employee, amount)
+                timings.append(time.perf_counter() - start)
+                assert service.balance("employer").cents == 300000 * legs - 100 * sum(amount for _, amount in pay)
+                service.close()
+        print(f"{legs:>9} {timings[0]:>11.2f} {timings[1]:>9.2f} {timings[0] / timings[1]:>7.0f}x")
+
+
+# Compares startup, random lookup and deposit latency of the .csv and SQLite storages
+def bench_storage(sizes, lookups, writes, sync):
+    print(f"{'users':>10} {'storage':>8} {'startup s':>10} {'lookup us':>10} {'write us':>10}")
+    # A cheap hash, so loading does not stop to migrate plaintext passwords
+    password = Credential_Hasher(cost=1000).hash("password@12")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bank_users.csv")
+            db = os.path.join(folder, "bank_users.db")
+            write_user_file(path, size, password)
+            storage = SQLite_Storage(db)
+            with open(path, mode='r', newline='') as user_file:
+                storage.save(csv.reader(user_file))
+            storage.close()
+
+            backends = (("csv", lambda: Bank_Service(path, Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync))),
+                        ("sqlite", lambda: Bank_Service(storage=SQLite_Storage(db, sync=sync))))
+            for name, open_service in backends:
+                start = time.perf_counter()
+                service = open_service()
+                service.load_users()
+                startup = time.perf_counter() - start
+
+                names = [f"user{random.randrange(size):08d}" for _ in range(lookups)]
+                start = time.perf_counter()
+                for username in names:
+                    service.balance(username)
+                lookup = (time.perf_counter() - start) / lookups
+
+                start = time.perf_counter()
+                for username in names[:writes]:
+                    service.deposit(username, 10)
+                write = (time.perf_counter() - start) / writes
+                service.close()
+                print(f"{size:>10} {name:>8} {startup:>10.3f} {lookup * 1e6:>10.1f} {write * 1e6:>10.1f}")
+
+
+# Measures what metrics cost per deposit, then shows where a mixed load spends its time
+def bench_metrics(accounts, operations, sync):
+    with tempfile.TemporaryDirectory() as folder:
+        service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                               Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=False))
+        service.users = make_users(accounts)
+        names = list(service.users)
+        service.compact_threshold = 10 ** 9
+        timings = []
+        for enabled in (False, True):
+            if enabled:
+                service.enable_metrics()
+            start = time.perf_counter()
+            for i in range(operations):
+                service.deposit(names[i % accounts], 1)
+            timings.append((time.perf_counter() - start) / operations)
+        service.close()
+    print(f"deposit: {timings[0] * 1e6:.2f} us without metrics, {timings[1] * 1e6:.2f} us with")
+
+    # A mixed load with invalid amounts; the journal is compacted whenever it outgrows the users
+    with tempfile.TemporaryDirectory() as folder:
+        service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                               Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync))
+        service.users = make_users(accounts)
+        metrics = service.enable_metrics()
+        engine = Batch_Engine(service)
+        rng = random.Random(5)
+        lines = []
+        for i in range(operations):
+            username = names[rng.randrange(accounts)]
+            kind = rng.randrange(3)
+            amount = rng.choice([50, 200, 4000, -1])
+            if kind == 0:
+                lines.append(json.dumps({"op": "deposit", "username": username, "amount": amount}))
+            elif kind == 1:
+                lines.append(json.dumps({"op": "withdraw", "username": username, "amount": amount}))
+            else:
+                lines.append(json.dumps({"op": "transfer", "username": username, "recipient": names[rng.randrange(accounts)], "amount": amount}))
+        engine.run(lines)
+        service.close()
+
+    print(f"{'op':>14} {'calls':>8} {'rejected':>9} {'seconds':>8} {'p50 us':>8} {'p99 us':>9} {'max us':>10}")
+    for op, stats in metrics.snapshot().items():
+        print(f"{op:>14} {stats['calls']:>8} {stats['rejected']:>9} {stats['seconds']:>8.2f} "
+              f"{stats['p50_us']:>8.1f} {stats['p99_us']:>9.1f} {stats['max_us']:>10.1f}")
+
+
+# Writes a signup file where about 1 in 20 rows is invalid and 1 in 20 repeats an earlier name
+def write_signup_file(path, count, seed):
+    rng = random.Random(seed)
+    with open(path, mode='w', newline='') as signup_file:
+        writer = csv.writer(signup_file)
+        writer.writerow(["username", "password"])
+        for i in range(count):
+            roll = rng.random()
+            if roll < 0.05:
+                writer.writerow([f"new{i:08d}!", "password@12"])
+            elif roll < 0.10 and i:
+                writer.writerow([f"new{rng.randrange(i):08d}", "password@12"])
+            else:
+                writer.writerow([f"new{i:08d}", "password@12"])
+
+
+# Compares signing up one row at a time with import_signups, over the same file
+def bench_import(sizes, cost, workers, single_limit):
+    print(f"{'rows':>9} {'mode':>8} {'seconds':>8} {'rows/s':>10} {'created':>8}")
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            signups = os.path.join(folder, "signups.csv")
+            write_signup_file(signups, rows, rows)
+            modes = (["single"] if rows <= single_limit else []) + ["import"]
+            for mode in modes:
+                service = Bank_Service(os.path.join(folder, f"{mode}.csv"),
+                                       Transaction_Journal(os.path.join(folder, f"{mode}.journal")))
+                service.credentials = Credential_Hasher(cost=cost)
+                service.users = {}
+                with open(signups, mode='r', newline='') as signup_file:
+                    records = list(read_signups(signup_file, False))
+                start = time.perf_counter()
+                if mode == "single":
+                    for username, password in records:
+                        try:
+                            service.signup(username, password)
+                        except ValueError:
+                            pass
+                else:
+                    service.import_signups(records, workers=workers)
+                seconds = time.perf_counter() - start
+                print(f"{rows:>9} {mode:>8} {seconds:>8.2f} {rows / seconds:>10.0f} {len(service.users):>8}")
+                service.close()
+
+
+# Times statements and past balances from the ledger index against scanning every record
+# Records are written in batches of 1000 over the given number of accounts
+def bench_ledger(sizes, accounts, queries):
+    print(f"{'records':>10} {'MB':>6} {'open s':>7} {'statement us':>13} {'as-of us':>9} {'scan ms':>8}")
+    for size in sizes:
+        rng = random.Random(size)
+        with tempfile.TemporaryDirectory() as folder:
+            ledger = Transaction_Ledger(os.path.join(folder, "bank_users.ledger"), sync=False)
+            for start in range(0, size, 1000):
+                ledger.append([(str(10000000 + rng.randrange(accounts)), "deposit", 100, 100, "")
+                               for _ in range(min(1000, size - start))])
+            ledger.close()
+
+            start = time.perf_counter()
+            ledger = Transaction_Ledger(ledger.path, sync=False)
+            opened = time.perf_counter() - start
+            numbers = [str(10000000 + rng.randrange(accounts)) for _ in range(queries)]
+            times = [record["time"] for record in ledger.statement(numbers[0])]
+            middle = times[len(times) // 2] if times else None
+
+            start = time.perf_counter()
+            for number in numbers:
+                ledger.statement(number, middle)
+            statement = (time.perf_counter() - start) / queries * 1e6
+            start = time.perf_counter()
+            for number in numbers:
+                ledger.balance_as_of(number, middle)
+            as_of = (time.perf_counter() - start) / queries * 1e6
+
+            # What a statement costs without the index: read every record and keep the account's
+            start = time.perf_counter()
+            account = numbers[0].encode().ljust(16, b"\0")
+            with open(ledger.path, mode='rb') as ledger_file:
+                matches = [record for record in Transaction_Ledger.RECORD.iter_unpack(ledger_file.read()) if record[4] == account]
+            scan = (time.perf_counter() - start) * 1e3
+            megabytes = os.path.getsize(ledger.path) / 1e6
+            print(f"{size:>10} {megabytes:>6.0f} {opened:>7.2f} {statement:>13.1f} {as_of:>9.1f} {scan:>8.1f}")
+            ledger.close()
+
+
+# Mixed operations over the given users: deposits, withdrawals, balances and transfers
+def mixed_lines(names, count, seed):
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        roll = rng.random()
+        username = rng.choice(names)
+        if roll < 0.4:
+            lines.append(json.dumps({"op": "deposit", "username": username, "amount": rng.randrange(10, 100)}))
+        elif roll < 0.6:
+            lines.append(json.dumps({"op": "withdraw", "username": username, "amount": rng.randrange(1, 10)}))
+        elif roll < 0.8:
+            lines.append(json.dumps({"op": "balance", "username": username}))
+        else:
+            lines.append(json.dumps({"op": "transfer", "username": username, "recipient": rng.choice(names), "amount": 5}))
+    return lines
+
+
+# Splits user00000000, user00000001, ... over the shard files the router will open
+def write_shard_files(path, count, shards, password):
+    root, extension = os.path.splitext(path)
+    files = [open(f"{root}.shard{shard}{extension}", mode='w', newline='') for shard in range(shards)]
+    for i in range(count):
+        username = f"user{i:08d}"
+        files[username_shard(username, shards)].write(f"{username},{password},{10000000 + i},500.0\n")
+    for user_file in files:
+        user_file.close()
+
+
+# Ops/sec of a mixed workload in one process and over each number of shards
+# Scaling depends on free cores: each shard is a process, and the router itself needs one
+def bench_shards(accounts, operations, shard_counts, sync):
+    password = Credential_Hasher(cost=1000).hash("password@12")
+    names = [f"user{i:08d}" for i in range(accounts)]
+    lines = mixed_lines(names, operations, accounts)
+    print(f"{'shards':>7} {'ops/s':>10} {'failed':>8}   ({os.cpu_count()} cores)")
+    for shards in [0] + shard_counts:
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bank_users.csv")
+            if shards:
+                write_shard_files(path, accounts, shards, password)
+                service = Shard_Router(path, shards, sync=sync)
+                engine = Sharded_Batch_Engine(service)
+            else:
+                write_user_file(path, accounts, password)
+                service = Bank_Service(path, Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync))
+                service.load_users()
+                service.enable_group_commit()
+                engine = Batch_Engine(service)
+            start = time.perf_counter()
+            report = engine.run(lines)
+            service.close()
+            seconds = time.perf_counter() - start
+        print(f"{shards or 'none':>7} {operations / seconds:>10.0f} {report['failed']:>8}")
+
+
+# Deposits/sec without keys, with a fresh key each, and as retries of keys already seen
+def bench_idempotency(accounts, deposits, sync):
+    print(f"{'mode':>10} {'ops/s':>10} {'applied':>8}")
+    for mode in ("no key", "new key", "retry"):
+        with tempfile.TemporaryDirectory() as folder:
+            service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                   Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync))
+            service.users = make_users(accounts)
+            service.compact_threshold = 10 ** 9
+            names = list(service.users)
+            keys = [None] * deposits if mode == "no key" else [f"deposit-{i}" for i in range(deposits)]
+            if mode == "retry":
+                for i, key in enumerate(keys):
+                    service.deposit(names[i % accounts], 10, key)
+            rows = service.journal.records
+            start = time.perf_counter()
+            for i, key in enumerate(keys):
+                service.deposit(names[i % accounts], 10, key)
+            seconds = time.perf_counter() - start
+            print(f"{mode:>10} {deposits / seconds:>10.0f} {service.journal.records - rows:>8}")
+            service.close()
+
+
+# Deposits/sec without and with rate limits, and how fast a flood from one account is turned away
+def bench_limits(accounts, deposits):
+    print(f"{'mode':>10} {'ops/s':>10} {'refused':>8} {'journal rows':>13}")
+    for mode in ("off", "on", "flood"):
+        with tempfile.TemporaryDirectory() as folder:
+            service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                   Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=False))
+            service.users = make_users(accounts)
+            service.compact_threshold = 10 ** 9
+            if mode != "off":
+                service.enable_rate_limits(rate=5, burst=20)
+            names = list(service.users) if mode != "flood" else ["user00000000"]
+            refused = 0
+            start = time.perf_counter()
+            for i in range(deposits):
+                try:
+                    service.deposit(names[i % len(names)], 10)
+                except ValueError:
+                    refused += 1
+            seconds = time.perf_counter() - start
+            print(f"{mode:>10} {deposits / seconds:>10.0f} {refused:>8} {service.journal.records:>13}")
+            service.close()
+
+
+# Time until the window is shown and until the users are loaded, and the time per page change
+# with cached frames vs rebuilding every page as before; needs a display
+def bench_gui(sizes, navigations, lazy):
+    from tkinter import Tk
+    password = Credential_Hasher(cost=1000).hash("password@12")
+    print(f"{'users':>10} {'window s':>9} {'loaded s':>9} {'cached ms':>10} {'rebuilt ms':>11}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            write_user_file(os.path.join(folder, "bank_users.csv"), size, password)
+            # The app opens bank_users.csv in the working directory
+            cwd = os.getcwd()
+            os.chdir(folder)
+            try:
+                root = Tk()
+                start = time.perf_counter()
+                app = CapitEx_App(root, lazy=lazy)
+                root.update()
+                shown = time.perf_counter() - start
+                app.finish_loading()
+                loaded = time.perf_counter() - start
+
+                timings = []
+                for rebuild in (False, True):
+                    start = time.perf_counter()
+                    for _ in range(navigations):
+                        for page in (app.signup_page, app.login_page):
+                            if rebuild:
+                                app.clear_windows()
+                            page()
+                            root.update_idletasks()
+                    timings.append((time.perf_counter() - start) / (2 * navigations) * 1e3)
+                app.service.close()
+                root.destroy()
+            finally:
+                os.chdir(cwd)
+        print(f"{size:>10} {shown:>9.3f} {loaded:>9.2f} {timings[0]:>10.2f} {timings[1]:>11.2f}")
+
+
+# Times the interest pass over an array of balances, against one charges() call per account,
+# and a full close_period on a columnar user file including the snapshot save
+def bench_interest(sizes, save_limit):
+    schedule = Interest_Schedule()
+    print(f"{'accounts':>10} {'pass s':>7} {'per-call s':>11} {'close_period s':>15}")
+    for size in sizes:
+        rng = random.Random(size)
+        balances = array('q', (rng.randrange(0, 2000000) for _ in range(size)))
+        start = time.perf_counter()
+        schedule.apply(balances)
+        vectorized = time.perf_counter() - start
+        start = time.perf_counter()
+        for cents in balances:
+            schedule.charges(cents)
+        per_call = time.perf_counter() - start
+        del balances
+
+        closed = "-"
+        if size <= save_limit:
+            with tempfile.TemporaryDirectory() as folder:
+                write_user_file(os.path.join(folder, "bank_users.csv"), size, Credential_Hasher(cost=1000).hash("password@12"))
+                service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                       Transaction_Journal(os.path.join(folder, "bank_users.journal")), columnar=True)
+                service.load_users()
+                closed = f"{service.close_period(schedule, 'bench')['seconds']:.2f}"
+                service.close()
+        print(f"{size:>10} {vectorized:>7.2f} {per_call:>11.2f} {closed:>15}")
+
+
+# Measures time from opening the users to the first successful login
+# for the .csv file (parsed in full), the lazy .csv table (cold, building its index) and the binary snapshot
+def bench_snapshot(sizes, lookups):
+    print(f"{'users':>10} {'storage':>8} {'first login s':>14} {'lookup us':>10} {'file MB':>8}")
+    hasher = Credential_Hasher(cost=1000)
+    password = hasher.hash("password@12")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bank_users.csv")
+            snap = os.path.join(folder, "bank_users.snap")
+            write_user_file(path, size, password)
+            start = time.perf_counter()
+            with open(path, mode='r', newline='') as user_file:
+                Snapshot_Storage(snap).save(csv.reader(user_file))
+            print(f"{size:>10} {'build':>8} {time.perf_counter() - start:>14.2f}")
+
+            journal = os.path.join(folder, "bank_users.journal")
+            backends = (("csv", path, lambda: Bank_Service(path, Transaction_Journal(journal))),
+                        ("lazy", path, lambda: Bank_Service(path, Transaction_Journal(journal), lazy=True)),
+                        ("snapshot", snap, lambda: Bank_Service(storage=Snapshot_Storage(snap))))
+            for name, file, open_service in backends:
+                start = time.perf_counter()
+                service = open_service()
+                service.credentials = hasher
+                service.load_users()
+                service.login(f"user{size // 2:08d}", "password@12")
+                first_login = time.perf_counter() - start
+
+                names = [f"user{random.randrange(size):08d}" for _ in range(lookups)]
+                start = time.perf_counter()
+                for username in names:
+                    service.balance(username)
+                lookup = (time.perf_counter() - start) / lookups
+                service.close()
+                print(f"{size:>10} {name:>8} {first_login:>14.3f} {lookup * 1e6:>10.1f} {os.path.getsize(file) / 1e6:>8.1f}")
+
+
+# Runs random transfers on a thread pool while the main thread adds up every balance over and over
+# The reports read the live accounts (unlocked), hold every account lock (locked) or use a Balance_View (snapshot)
+# Transfers never change the total, so an unlocked report that sees another total caught a transfer half made
+# The transfer latencies show how long writers were held up by the reports
+def bench_reads(accounts, transfers, workers):
+    print(f"{'reader':>9} {'transfers/s':>12} {'p99 us':>9} {'max us':>9} {'reports/s':>10} {'balances/s':>11} {'torn':>6}")
+    for reader in ("none", "unlocked", "locked", "snapshot"):
+        with tempfile.TemporaryDirectory() as folder:
+            service = Bank_Service(os.path.join(folder, "bank_users.csv"),
+                                   Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=False))
+            service.users = make_users(accounts)
+            if reader == "snapshot":
+                service.enable_snapshot_reads()
+            metrics = service.enable_metrics()
+            expected = sum(user.account.cents for user in service.users.values())
+
+            reports = torn = 0
+            engine = Batch_Engine(service, workers=workers)
+            thread = threading.Thread(target=engine.run, args=(transfer_lines(list(service.users), transfers, 1),))
+            start = time.perf_counter()
+            thread.start()
+            while reader != "none" and thread.is_alive():
+                if reader == "unlocked":
+                    total = sum(user.account.cents for user in list(service.users.values()))
+                elif reader == "locked":
+                    with service.locks.holding_all():
+                        total = sum(user.account.cents for user in list(service.users.values()))
+                else:
+                    with service.read_view() as view:
+                        total = view.total_deposits().cents
+                reports += 1
+                torn += total != expected
+            thread.join()
+            seconds = time.perf_counter() - start
+            service.close()
+        stats = metrics.snapshot()["transfer"]
+        print(f"{reader:>9} {transfers / seconds:>12.0f} {stats['p99_us']:>9.0f} {stats['max_us']:>9.0f} "
+              f"{reports / seconds:>10.1f} {reports * accounts / seconds:>11.0f} {torn:>6}")
+
+
+# Times the reconciliation tool over generated files, with one duplicate username and account number added
+# The peak memory is the largest worker process's, which depends on the chunk size and not the file size
+def bench_reconcile(sizes, workers_list, chunk_mb):
+    print(f"{'rows':>11} {'workers':>8} {'seconds':>8} {'rows/s':>10} {'worker MB':>10} {'100M rows min':>14} {'found':>6}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "bank_users.csv")
+            write_user_file(path, size)
+            with open(path, mode='a') as user_file:
+                user_file.write(f"user{size // 3:08d},password@12,{10000000 + size},500.0\n")
+                user_file.write(f"user{size:08d},password@12,{10000000 + size // 2},500.0\n")
+            for workers in workers_list:
+                report = Reconciler(path, workers, chunk_mb << 20, folder=folder).run()
+                peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+                found = report["duplicate_usernames"] + report["duplicate_accounts"]
+                print(f"{report['rows']:>11} {workers:>8} {report['seconds']:>8.1f} {report['rows_per_second']:>10.0f} "
+                      f"{peak:>10.0f} {1e8 / report['rows_per_second'] / 60:>14.1f} {found:>6}")
+
+
+# Creates, validates and expires sessions on a simulated clock that moves one second per 10000 logins
+# Half the sessions are used again before they expire, so the wheel also reschedules
+def bench_sessions(sizes, validations, idle_timeout):
+    print(f"{'sessions':>10} {'create/s':>10} {'validate/s':>11} {'expire/s':>10} {'expired':>9}")
+    for size in sizes:
+        now = 0.0
+        sessions = Session_Table(idle_timeout, clock=lambda: now)
+        tokens = []
+        start = time.perf_counter()
+        for i in range(size):
+            if i % 10000 == 0:
+                now += 1
+            tokens.append(sessions.create(f"user{i:08d}"))
+        create = size / (time.perf_counter() - start)
+
+        picks = [tokens[random.randrange(size)] for _ in range(validations)]
+        start = time.perf_counter()
+        for token in picks:
+            sessions.validate(token)
+        validate = validations / (time.perf_counter() - start)
+
+        # Every session is past its deadline, and the used ones past their later one
+        now += idle_timeout + size / 10000 + 1
+        start = time.perf_counter()
+        expired = sessions.expire()
+        expire = expired / (time.perf_counter() - start)
+        print(f"{size:>10} {create:>10.0f} {validate:>11.0f} {expire:>10.0f} {expired:>9}")
+
+
+# Password hash stored for every generated user: cheap, and seeded so the files are reproducible
+BENCH_PASSWORD = "password@12"
+BENCH_COST = 1000
+
+
+def bench_password_hash(rng):
+    hasher = Credential_Hasher(cost=BENCH_COST)
+    salt = rng.randbytes(16)
+    return f"{hasher.scheme}${hasher.cost}${salt.hex()}${hasher.derive(hasher.scheme, hasher.cost, salt, BENCH_PASSWORD).hex()}"
+
+
+# Writes a seeded synthetic bank_users.csv: user00000000, user00000001, ... with random balances
+# The same count and seed always give the same bytes
+def generate_users(path, count, seed):
+    rng = random.Random(seed)
+    password = bench_password_hash(rng)
+    with open(path, mode='w', newline='') as user_file:
+        for start in range(0, count, 100000):
+            rows = []
+            for i in range(start, min(count, start + 100000)):
+                cents = rng.randrange(500000)
+                rows.append(f"user{i:08d},{password},{100000000 + i},{cents // 100}.{cents % 100:02d}\n")
+            user_file.write("".join(rows))
+
+
+# Parses a mix such as "deposit=40,withdraw=30,transfer=20,login=10" into ops and weights
+def parse_mix(mix):
+    ops, weights = [], []
+    for part in mix.split(","):
+        op, weight = part.split("=")
+        if op not in ("deposit", "withdraw", "transfer", "login", "balance"):
+            raise ValueError(f"Unknown operation in mix: {op}")
+        ops.append(op)
+        weights.append(float(weight))
+    return ops, weights
+
+
+# Yields a seeded stream of JSON operation lines for the batch engine
+# hot_share of the operations go to the first hot_accounts fraction of the users
+def generate_workload(count, users, mix, hot_accounts, hot_share, seed):
+    rng = random.Random(seed)
+    ops, weights = parse_mix(mix)
+    hot = max(1, int(users * hot_accounts))
+
+    def pick():
+        return f"user{rng.randrange(hot) if rng.random() < hot_share else rng.randrange(users):08d}"
+
+    for op in rng.choices(ops, weights, k=count):
+        operation = {"op": op, "username": pick()}
+        if op == "login":
+            operation["password"] = BENCH_PASSWORD
+        elif op == "deposit":
+            operation["amount"] = f"{rng.randrange(100, 300000) / 100:.2f}"
+        elif op in ("withdraw", "transfer"):
+            operation["amount"] = f"{rng.randrange(100, 50000) / 100:.2f}"
+        if op == "transfer":
+            operation["recipient"] = pick()
+        yield json.dumps(operation)
+
+
+def run_generate(args):
+    generate_users(args.users_file, args.users, args.seed)
+    print(f"wrote {args.users} users to {args.users_file}")
+    if args.workload_file:
+        with open(args.workload_file, mode='w') as workload_file:
+            for line in generate_workload(args.operations, args.users, args.mix, args.hot_accounts, args.hot_share, args.seed):
+                workload_file.write(line + "\n")
+        print(f"wrote {args.operations} operations to {args.workload_file}")
+
+
+# The commit the results were measured at, if this folder is a git checkout
+def git_commit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return output.stdout.strip() or None
+
+
+def median_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+# Runs the startup, save_users and per-operation scenarios and writes flat JSON results
+# Every result is a time, so lower is better, except names ending in _per_second
+def run_suite(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "bank_users.csv")
+
+        def open_service(mode, sync=False):
+            service = Bank_Service(path, Transaction_Journal(os.path.join(folder, "bank_users.journal"), sync=sync),
+                                   lazy=mode == "lazy", columnar=mode == "columnar")
+            service.credentials = Credential_Hasher(cost=BENCH_COST)
+            return service
+
+        for size in args.sizes:
+            generate_users(path, size, args.seed)
+            for mode in args.modes:
+                # The first lazy start builds the sidecar index; later ones reuse it
+                if mode == "lazy":
+                    results[f"startup.lazy_cold.{size}.seconds"] = median_time(lambda: open_service(mode).load_users(), 1)
+                results[f"startup.{mode}.{size}.seconds"] = median_time(lambda: open_service(mode).load_users(), args.repeat)
+                print(f"startup {mode:>8} {size:>9} users: {results[f'startup.{mode}.{size}.seconds']:.3f} s")
+            service = open_service("dict")
+            service.load_users()
+            results[f"save_users.{size}.seconds"] = median_time(service.save_users, args.repeat)
+            print(f"save_users        {size:>9} users: {results[f'save_users.{size}.seconds']:.3f} s")
+
+        generate_users(path, args.workload_users, args.seed)
+        service = open_service("dict", sync=args.sync)
+        service.load_users()
+        metrics = service.enable_metrics()
+        lines = generate_workload(args.operations, args.workload_users, args.mix, args.hot_accounts, args.hot_share, args.seed)
+        report = Batch_Engine(service, workers=args.workers).run(lines)
+        service.close()
+        results["workload.ops_per_second"] = report["ops_per_second"]
+        for op, stats in metrics.snapshot().items():
+            for key in ("mean_us", "p50_us", "p99_us"):
+                results[f"op.{op}.{key}"] = stats[key]
+        print(f"workload: {report['operations']} operations at {report['ops_per_second']:.0f} ops/s")
+
+    output = {
+        "meta": {"commit": git_commit(), "python": sys.version.split()[0], "platform": sys.platform,
+                 "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "seed": args.seed, "sizes": args.sizes,
+                 "modes": args.modes, "operations": args.operations, "workload_users": args.workload_users,
+                 "mix": args.mix, "hot_accounts": args.hot_accounts, "hot_share": args.hot_share,
+                 "sync": args.sync, "workers": args.workers},
+        "results": results,
+    }
+    with open(args.output, mode='w') as output_file:
+        json.dump(output, output_file, indent=2)
+    print(f"results written to {args.output}")
+
+
+# Compares two suite results and exits with status 1 if any result got worse than the threshold
+def run_compare(args):
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)["results"]
+    with open(args.current) as current_file:
+        current = json.load(current_file)["results"]
+    regressions = 0
+    print(f"{'result':>40} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name in sorted(set(baseline) & set(current)):
+        before, after = baseline[name], current[name]
+        if not before:
+            continue
+        change = (after - before) / before
+        worse = -change if name.endswith("_per_second") else change
+        flag = ""
+        if worse > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:>40} {before:>12.4g} {after:>12.4g} {change:>+8.1%}{flag}")
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    if regressions:
+        sys.exit(1)
+
+
+# Sends one request and waits for its response
+async def call(reader, writer, request):
+    writer.write((json.dumps(request) + "\n").encode())
+    await writer.drain()
+    return json.loads(await reader.readline())
+
+
+# One load-generator client: signs up, logs in, then keeps `depth` requests in flight
+# The signup and login latencies are recorded apart, as they pay for the password hash
+async def load_client(host, port, index, clients, requests, depth, latencies, login_latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    username = f"load{index:06d}"
+    start = time.perf_counter()
+    await call(reader, writer, {"op": "signup", "username": username, "password": "password@1"})
+    token = (await call(reader, writer, {"op": "login", "username": username, "password": "password@1"}))["result"]
+    login_latencies.append(time.perf_counter() - start)
+    await call(reader, writer, {"op": "deposit", "token": token, "amount": 2000})
+
+    recipient = f"load{(index + 1) % clients:06d}"
+    mix = [{"op": "deposit", "amount": 10}, {"op": "withdraw", "amount": 5},
+           {"op": "transfer", "recipient": recipient, "amount": 1}, {"op": "check_balance"}]
+    sent = {}
+    window = asyncio.Semaphore(depth)
+
+    async def send():
+        for i in range(requests):
+            await window.acquire()
+            sent[i] = time.perf_counter()
+            writer.write((json.dumps(dict(mix[i % len(mix)], id=i, token=token)) + "\n").encode())
+            if i % depth == depth - 1:
+                await writer.drain()
+        await writer.drain()
+
+    async def receive():
+        for _ in range(requests):
+            response = json.loads(await reader.readline())
+            latencies.append(time.perf_counter() - sent.pop(response["id"]))
+            window.release()
+
+    await asyncio.gather(send(), receive())
+    writer.close()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Drives a Bank_Server with many pipelining clients and reports latency percentiles
+# Starts a server in this process unless --port points at a running one
+# Passwords are hashed at the real cost, which the server does off its event loop
+async def bench_server(clients, requests, depth, host, port, credential_workers):
+    server = None
+    folder = None
+    if port is None:
+        folder = tempfile.TemporaryDirectory()
+        service = Bank_Service(os.path.join(folder.name, "bank_users.csv"),
+                               Transaction_Journal(os.path.join(folder.name, "bank_users.journal"), sync=False))
+        server = Bank_Server(service, credential_workers=credential_workers)
+        listener = await server.start(host, 0)
+        port = listener.sockets[0].getsockname()[1]
+
+    # Measures how long the event loop goes without running a 10 ms timer, i.e. how long it is blocked
+    stalls = []
+    async def probe():
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stalls.append(time.perf_counter() - before - 0.01)
+
+    latencies = []
+    login_latencies = []
+    prober = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*(load_client(host, port, i, clients, requests, depth, latencies, login_latencies)
+                           for i in range(clients)))
+    seconds = time.perf_counter() - start
+    prober.cancel()
+
+    if server is not None:
+        await server.stop()
+        server.service.close()
+        folder.cleanup()
+
+    ordered = sorted(latencies)
+    print(f"clients={clients} depth={depth} requests={len(ordered)} throughput={len(ordered) / seconds:.0f} req/s")
+    for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p99.9", 0.999)):
+        print(f"{label:>6} {percentile(ordered, fraction) * 1e3:8.2f} ms")
+    logins = sorted(login_latencies)
+    print(f"signup+login p50={percentile(logins, 0.5) * 1e3:.0f} ms p99={percentile(logins, 0.99) * 1e3:.0f} ms")
+    print(f"event loop longest stall {max(stalls, default=0) * 1e3:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CapitEx benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    journal = commands.add_parser("journal", help="journal append vs full .csv rewrite")
+    journal.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    journal.add_argument("--operations", type=int, default=2000)
+    journal.add_argument("--rewrites", type=int, default=3)
+    journal.add_argument("--no-sync", action="store_true", help="skip fsync to measure CPU cost only")
+
+    lazy = commands.add_parser("lazy", help="lazy user table startup and lookups")
+    lazy.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000, 5000000])
+    lazy.add_argument("--lookups", type=int, default=20000)
+    lazy.add_argument("--capacity", type=int, default=10000)
+
+    store = commands.add_parser("store", help="memory per account and aggregate queries")
+    store.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+
+    stress = commands.add_parser("stress", help="parallel random transfers with a money conservation check")
+    stress.add_argument("--accounts", type=int, default=10000)
+    stress.add_argument("--transfers", type=int, default=1000000)
+    stress.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    stress.add_argument("--sync", action="store_true", help="fsync the journal after each transfer")
+
+    commit = commands.add_parser("commit", help="fsync per operation vs group commit")
+    commit.add_argument("--accounts", type=int, default=1000)
+    commit.add_argument("--deposits", type=int, default=20000)
+    commit.add_argument("--workers", type=int, default=8)
+    commit.add_argument("--interval", type=float, default=0.01)
+    commit.add_argument("--batch-size", type=int, default=1000)
+
+    credentials = commands.add_parser("credentials", help="logins/sec per password hash cost")
+    credentials.add_argument("--scheme", choices=["pbkdf2_sha256", "scrypt"], default="pbkdf2_sha256")
+    credentials.add_argument("--costs", type=int, nargs="+", default=[10000, 50000, 200000])
+    credentials.add_argument("--logins", type=int, default=20)
+    credentials.add_argument("--budget", type=float, help="also tune a cost to this login latency in seconds")
+
+    accounts = commands.add_parser("accounts", help="account number allocation and lookups by account number")
+    accounts.add_argument("--count", type=int, default=1000000)
+    accounts.add_argument("--lookups", type=int, default=100000)
+
+    money = commands.add_parser("money", help="integer-cent Money vs float balances: speed and drift")
+    money.add_argument("--operations", type=int, default=1000000)
+    money.add_argument("--replay", type=int, default=10000000)
+
+    payroll = commands.add_parser("payroll", help="per-call transfers vs one netted transfer_batch")
+    payroll.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000])
+    payroll.add_argument("--employees", type=int, default=50000)
+    payroll.add_argument("--sync", action="store_true", help="fsync the journal after each transfer")
+
+    storage = commands.add_parser("storage", help="startup, lookup and write latency of the .csv and SQLite storages")
+    storage.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    storage.add_argument("--lookups", type=int, default=20000)
+    storage.add_argument("--writes", type=int, default=2000)
+    storage.add_argument("--no-sync", action="store_true", help="skip fsync to measure CPU cost only")
+
+    metrics = commands.add_parser("metrics", help="metrics overhead and where a mixed load spends its time")
+    metrics.add_argument("--accounts", type=int, default=10000)
+    metrics.add_argument("--operations", type=int, default=200000)
+    metrics.add_argument("--sync", action="store_true", help="fsync the journal after each operation")
+
+    signups = commands.add_parser("import", help="rows/sec of one signup at a time vs import_signups")
+    signups.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    signups.add_argument("--cost", type=int, default=1000, help="PBKDF2 iterations per password")
+    signups.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="threads that hash passwords")
+    signups.add_argument("--single-limit", type=int, default=100000, help="largest size also run one signup at a time")
+
+    ledger = commands.add_parser("ledger", help="statement and balance-as-of queries vs a full ledger scan")
+    ledger.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    ledger.add_argument("--accounts", type=int, default=10000)
+    ledger.add_argument("--queries", type=int, default=2000)
+
+    shards = commands.add_parser("shards", help="mixed workload throughput in one process vs over shard processes")
+    shards.add_argument("--accounts", type=int, default=100000)
+    shards.add_argument("--operations", type=int, default=200000)
+    shards.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    shards.add_argument("--sync", action="store_true", help="fsync each shard's journal once per round")
+
+    idempotency = commands.add_parser("idempotency", help="deposit cost with idempotency keys, fresh and retried")
+    idempotency.add_argument("--accounts", type=int, default=10000)
+    idempotency.add_argument("--deposits", type=int, default=50000)
+    idempotency.add_argument("--sync", action="store_true", help="fsync the journal and the keys file after each deposit")
+
+    limits = commands.add_parser("limits", help="deposit cost with rate limits, and a flood from one account")
+    limits.add_argument("--accounts", type=int, default=100000)
+    limits.add_argument("--deposits", type=int, default=100000)
+
+    gui = commands.add_parser("gui", help="GUI startup time and page navigation latency (needs a display)")
+    gui.add_argument("--sizes", type=int, nargs="+", default=[1000, 1000000])
+    gui.add_argument("--navigations", type=int, default=200)
+    gui.add_argument("--lazy", action="store_true", help="load the users through the lazy user table")
+
+    interest = commands.add_parser("interest", help="end-of-period interest and fees over every account")
+    interest.add_argument("--sizes", type=int, nargs="+", default=[1000000, 10000000])
+    interest.add_argument("--save-limit", type=int, default=1000000, help="largest size also run through close_period")
+
+    snapshot = commands.add_parser("snapshot", help="time to first login from the .csv file vs the binary snapshot")
+    snapshot.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    snapshot.add_argument("--lookups", type=int, default=20000)
+
+    reads = commands.add_parser("reads", help="whole-bank reports during concurrent transfers: unlocked, locked and snapshot")
+    reads.add_argument("--accounts", type=int, default=10000)
+    reads.add_argument("--transfers", type=int, default=100000)
+    reads.add_argument("--workers", type=int, default=4)
+
+    reconcile = commands.add_parser("reconcile", help="rows/sec and worker memory of the reconciliation tool")
+    reconcile.add_argument("--sizes", type=int, nargs="+", default=[1000000, 10000000])
+    reconcile.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    reconcile.add_argument("--chunk-mb", type=int, default=64)
+
+    sessions = commands.add_parser("sessions", help="session create, validate and expire rates with a timing wheel")
+    sessions.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    sessions.add_argument("--validations", type=int, default=1000000)
+    sessions.add_argument("--idle-timeout", type=float, default=900)
+
+    generate = commands.add_parser("generate", help="write a seeded synthetic user file and operation workload")
+    generate.add_argument("--users", type=int, default=100000)
+    generate.add_argument("--users-file", default="bank_users.csv")
+    generate.add_argument("--workload-file", help="also write this many --operations as JSONL for the batch command")
+
+    suite = commands.add_parser("suite", help="startup, save_users and per-operation scenarios written as JSON")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    suite.add_argument("--modes", nargs="+", choices=["dict", "columnar", "lazy"], default=["dict", "columnar", "lazy"])
+    suite.add_argument("--repeat", type=int, default=3, help="runs per timing; the median is kept")
+    suite.add_argument("--workload-users", type=int, default=100000)
+    suite.add_argument("--workers", type=int, default=1)
+    suite.add_argument("--sync", action="store_true", help="fsync the journal after each operation")
+    suite.add_argument("--output", default="bench_results.json")
+
+    for workload in (generate, suite):
+        workload.add_argument("--seed", type=int, default=42)
+        workload.add_argument("--operations", type=int, default=100000)
+        workload.add_argument("--mix", default="deposit=40,withdraw=30,transfer=20,login=10",
+                              help="operation weights, e.g. deposit=40,withdraw=30,transfer=20,login=10")
+        workload.add_argument("--hot-accounts", type=float, default=0.01, help="fraction of users that are hot")
+        workload.add_argument("--hot-share", type=float, default=0.5, help="fraction of operations on hot users")
+
+    compare = commands.add_parser("compare", help="compare two suite results and fail on regressions")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.2, help="relative slowdown that counts as a regression")
+
+    server = commands.add_parser("server", help="load-generate against the asyncio server")
+    server.add_argument("--clients", type=int, default=200)
+    server.add_argument("--requests", type=int, default=500, help="requests per client")
+    server.add_argument("--depth", type=int, default=16, help="pipelined requests in flight per client")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, help="port of a running server; starts one in-process if omitted")
+    server.add_argument("--credential-workers", type=int, default=4, help="password hashing threads of the in-process server")
+
+    args = parser.parse_args()
+    if args.command == "journal":
+        bench_journal(args.sizes, args.operations, args.rewrites, not args.no_sync)
+    elif args.command == "lazy":
+        bench_lazy(args.sizes, args.lookups, args.capacity)
+    elif args.command == "store":
+        bench_store(args.sizes)
+    elif args.command == "stress":
+        bench_stress(args.accounts, args.transfers, args.workers, args.sync)
+    elif args.command == "commit":
+        bench_commit(args.accounts, args.deposits, args.workers, args.interval, args.batch_size)
+    elif args.command == "credentials":
+        bench_credentials(args.scheme, args.costs, args.logins, args.budget)
+    elif args.command == "accounts":
+        bench_accounts(args.count, args.lookups)
+    elif args.command == "money":
+        bench_money(args.operations, args.replay)
+    elif args.command == "payroll":
+        bench_payroll(args.sizes, args.employees, args.sync)
+    elif args.command == "storage":
+        bench_storage(args.sizes, args.lookups, args.writes, not args.no_sync)
+    elif args.command == "metrics":
+        bench_metrics(args.accounts, args.operations, args.sync)
+    elif args.command == "import":
+        bench_import(args.sizes, args.cost, args.workers, args.single_limit)
+    elif args.command == "ledger":
+        bench_ledger(args.sizes, args.accounts, args.queries)
+    elif args.command == "shards":
+        bench_shards(args.accounts, args.operations, args.shards, args.sync)
+    elif args.command == "idempotency":
+        bench_idempotency(args.accounts, args.deposits, args.sync)
+    elif args.command == "limits":
+        bench_limits(args.accounts, args.deposits)
+    elif args.command == "gui":
+        bench_gui(args.sizes, args.navigations, args.lazy)
+    elif args.command == "interest":
+        bench_interest(args.sizes, args.save_limit)
+    elif args.command == "snapshot":
+        bench_snapshot(args.sizes, args.lookups)
+    elif args.command == "reads":
+        bench_reads(args.accounts, args.transfers, args.workers)
+    elif args.command == "reconcile":
+        bench_reconcile(args.sizes, args.workers, args.chunk_mb)
+    elif args.command == "sessions":
+        bench_sessions(args.sizes, args.validations, args.idle_timeout)
+    elif args.command == "generate":
+        run_generate(args)
+    elif args.command == "suite":
+        run_suite(args)
+    elif args.command == "compare":
+        run_compare(args)
+    elif args.command == "server":
+        asyncio.run(bench_server(args.clients, args.requests, args.depth, args.host, args.port,
+                                 args.credential_workers))
+
+
+if __name__ == "__main__":
+    main()
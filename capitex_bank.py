@@ -2,277 +2,4576 @@
 from tkinter import *
 from tkinter import messagebox as msg
 import csv
-from random import randint
+import io
+import sqlite3
+import shutil
+from collections import OrderedDict
+from itertools import islice, accumulate
+from array import array
+from bisect import bisect_left, bisect_right
+import weakref
+import mmap
+import struct
+import zlib
+import hashlib
+import hmac
+import json
+import time
+import argparse
+import asyncio
+import multiprocessing
+import secrets
+import threading
+import tempfile
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+from fractions import Fraction
+from functools import total_ordering
+from math import lcm
+from datetime import datetime, timezone
+import sys
 import os
 import re
 
+""" The Money class is an exact amount of dollars kept as a whole number of cents
+    Amounts are parsed straight from text, so "0.10" is exactly ten cents
+    Compares with whole dollars exactly, and equal to the float nearest its value
+    so a balance of 700.10 still matches the float 700.10
+"""
+@total_ordering
+class Money:
+    __slots__ = ("cents",)
+
+    def __init__(self, cents=0):
+        self.cents = cents
+
+    # Turns a dollar amount given as Money, int, float or text into Money
+    @classmethod
+    def of(cls, amount):
+        if type(amount) is Money:
+            return amount
+        return cls(to_cents(amount))
+
+    # Parses dollar text such as "12", "12.5" or "-0.75"
+    # exact=False rounds amounts past the cent instead of rejecting them
+    @classmethod
+    def parse(cls, text, exact=True):
+        return cls(parse_cents(text, exact))
+
+    def __str__(self):
+        whole, cents = divmod(abs(self.cents), 100)
+        return f"{'-' if self.cents < 0 else ''}{whole}.{cents:02d}"
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+    # Formats through Decimal so f"{balance:.2f}" never goes through a float
+    def __format__(self, spec):
+        return format(Decimal(self.cents).scaleb(-2), spec)
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __hash__(self):
+        return hash(self.cents / 100)
+
+    # Puts self and other on one scale: cents for Money and whole dollars, dollars for floats
+    def scaled(self, other):
+        if type(other) is Money:
+            return self.cents, other.cents
+        if isinstance(other, int):
+            return self.cents, other * 100
+        if isinstance(other, float):
+            return self.cents / 100, other
+        return None
+
+    def __eq__(self, other):
+        pair = self.scaled(other)
+        return NotImplemented if pair is None else pair[0] == pair[1]
+
+    def __lt__(self, other):
+        pair = self.scaled(other)
+        return NotImplemented if pair is None else pair[0] < pair[1]
+
+    def __add__(self, other):
+        return Money(self.cents + to_cents(other))
+
+    # Lets sum() start from 0
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Money(self.cents - to_cents(other))
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+
+# Converts a dollar amount given as Money, int, float or text into whole cents
+# Floats are rounded to the nearest cent; text is parsed by parse_cents
+def to_cents(amount, exact=True):
+    kind = type(amount)
+    if kind is Money:
+        return amount.cents
+    if kind is str:
+        return parse_cents(amount, exact)
+    if kind is int:
+        return amount * 100
+    if kind is float:
+        # inf - inf and nan - nan are both nan
+        if amount - amount != 0:
+            raise ValueError("Please enter a valid amount")
+        return round(amount * 100)
+    return parse_cents(str(amount), exact)
+
+
+# Parses dollar text into whole cents
+# float() does the parsing in C: for text with at most two decimals, dollars * 100 is within
+# 3e-16 of the cent (relative), so rounding it is exact for anything below 1e15 cents
+# Text that does not land that close to a cent is settled exactly by Decimal instead
+# Amounts past the cent are rejected unless exact is False, which rounds them
+# (.csv files written before Money may hold float balances such as 100.30000000000001)
+def parse_cents(text, exact=True):
+    try:
+        scaled = float(text) * 100
+    except ValueError:
+        raise ValueError("Please enter a valid amount") from None
+    # Also false for nan and inf
+    if -1e15 < scaled < 1e15:
+        cents = round(scaled)
+        if abs(scaled - cents) <= abs(scaled) * 1e-15:
+            return cents
+    try:
+        value = Decimal(text).scaleb(2)
+    except InvalidOperation:
+        raise ValueError("Please enter a valid amount") from None
+    # Also keeps cents within the 64-bit balance columns
+    if not value.is_finite() or value.adjusted() > 17:
+        raise ValueError("Please enter a valid amount")
+    cents = value.to_integral_value(ROUND_HALF_EVEN)
+    if exact and cents != value:
+        raise ValueError("Amounts cannot have fractions of a cent")
+    return int(cents)
+
+
+
 """ This class serves as the base for the user's bank account
     Contains the main functions of a checking bank account
     Functions: withdrawing, depositing, transferring, checking balance
+    The balance is kept in whole cents; amounts can be Money, numbers or text
+"""
+class Bank_Account:
+    def __init__(self, account_number, balance=0):
+        self.account_number = account_number
+        self.cents = to_cents(balance)
+
+    @property
+    def balance(self):
+        return Money(self.cents)
+
+    @balance.setter
+    def balance(self, amount):
+        self.cents = to_cents(amount)
+
+    # User can only deposit any amount from 1 to 3000 in one function
+    # Money amounts skip the conversion call, which keeps this as fast as the old float balance
+    def deposit(self, amount):
+        cents = amount.cents if type(amount) is Money else to_cents(amount)
+        if 100 <= cents < 300000:
+            self.cents += cents
+            return True
+        return False
+
+    # User cannot overdraw from their checking account
+    def withdraw(self, amount):
+        cents = amount.cents if type(amount) is Money else to_cents(amount)
+        if 0 < cents <= self.cents:
+            self.cents -= cents
+            return True
+        return False
+
+    def check_balance(self):
+        return Money(self.cents)
+    
+    # Returns a bool function to determine if user can transfer money 
+    def can_transfer(self, amount):
+        return 0 < (amount.cents if type(amount) is Money else to_cents(amount)) <= self.cents
+
+
+
+""" The Admin_Bank class inherits username and password from Bank_Account class
+    This class is for setting up and authenticating a checking account
+    Assigns a special account number for the user's checking account
+    Works for signup and regular login by user
+    Initializes bank account balance at 0 for new users
+"""
+class Admin_Bank(Bank_Account):
+    def __init__(self, account_number, balance=0):
+        super().__init__(account_number, balance)
+
+
+
+""" The Account_User class manages user credentials
+    i.e username, account and password
+"""
+class Account_User:
+    def __init__(self, username, password, account):
+        self.username = username
+        self.password = password
+        self.account = account
+
+
+
+""" The Transaction_Journal class is an append-only log of balance changes
+    Each change is written as one full user row and fsync'd before returning
+    Replaying the journal on top of the .csv snapshot restores the latest state
+"""
+class Transaction_Journal:
+    def __init__(self, path="bank_users.journal", sync=True):
+        self.path = path
+        self.sync = sync
+        self.records = 0
+        self.journal_file = None
+        # Appends from several threads must not interleave their rows
+        self.lock = threading.Lock()
+
+    # Appends the rows in one write and forces them to disk
+    # A transfer journals both accounts together so they land as one record batch
+    # Returns the byte offset of each row so it can be read back later
+    # Rows are formatted in memory first, so the file position is asked for once per append
+    def append(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        sizes = [writer.writerow(row) for row in rows]
+        text = buffer.getvalue()
+        # Offsets count bytes, so text with non-ASCII usernames is measured encoded
+        if not text.isascii():
+            ends = list(accumulate(sizes))
+            sizes = [len(text[end - size:end].encode()) for end, size in zip(ends, sizes)]
+        with self.lock:
+            if self.journal_file is None:
+                self.journal_file = open(self.path, mode='a', newline='', encoding='utf-8')
+            offsets = list(accumulate(sizes, initial=self.journal_file.tell()))[:-1]
+            self.journal_file.write(text)
+            self.journal_file.flush()
+            if self.sync:
+                os.fsync(self.journal_file.fileno())
+            self.records += len(rows)
+        return offsets
+
+    # Applies every journaled row on top of the users loaded from the snapshot
+    # Rows are full user states, so replaying one twice is harmless
+    # A torn last row from a crash mid-append is skipped
+    def replay(self, users):
+        if not os.path.exists(self.path):
+            return 0
+        replayed = 0
+        with open(self.path, mode='r', newline='', encoding='utf-8') as journal_file:
+            for row in csv.reader(journal_file):
+                try:
+                    user = user_from_row(row)
+                except ValueError:
+                    continue
+                users[user.username] = user
+                replayed += 1
+        self.records = replayed
+        return replayed
+
+    # Empties the journal once its rows have been folded into a snapshot
+    def reset(self):
+        with self.lock:
+            self.close()
+            open(self.path, mode='w').close()
+            self.records = 0
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+
+
+# Builds a user from a username, password, account number, balance row
+def user_from_row(row):
+    username, password, account_number, balance = row
+    return Account_User(username, password, Bank_Account(account_number, Money.parse(balance, exact=False)))
+
+
+# Reads the .csv row that starts at the given byte offset of a binary file
+def read_row_at(user_file, offset):
+    user_file.seek(offset)
+    line = user_file.readline().decode()
+    return next(csv.reader([line]), [])
+
+
+# Stable 64-bit hash of an encoded username, used as the sort key of the lazy index
+def username_hash(name):
+    return zlib.crc32(name) | zlib.crc32(name, 0x9E3779B9) << 32
+
+
+
+# Turns a time given as epoch seconds, a datetime or an ISO-8601 string into epoch nanoseconds
+# None stays None, meaning an open end of a range
+def time_ns_of(when):
+    if when is None:
+        return None
+    if isinstance(when, str):
+        try:
+            when = datetime.fromisoformat(when)
+        except ValueError:
+            raise ValueError("Please enter a valid date") from None
+    if isinstance(when, datetime):
+        if when.tzinfo is None:
+            when = when.astimezone()
+        return int(when.timestamp() * 1000000) * 1000
+    return int(when * 1000000000)
+
+
+
+""" The Transaction_Ledger class keeps an append-only history of every balance change
+    Each record is a fixed 64-byte struct: time, signed amount and balance after in cents,
+    kind, account number and counterparty, so record n sits at byte 64 * n
+    Every record carries the running balance, so each one is a checkpoint and the balance
+    as of any time is the last record before it, without replaying anything
+    Reads go through a memory map, so the history is never loaded into memory; only a
+    per-account index of record numbers and times is, rebuilt by one scan when the ledger opens
+    Deferred records are buffered for a later write, e.g. one fsync per group commit batch,
+    and are not in the index until they are written
+"""
+class Transaction_Ledger:
+    RECORD = struct.Struct("<qqqB7x16s16s")
+    KINDS = ("deposit", "withdraw", "transfer_in", "transfer_out", "batch_in", "batch_out", "interest", "fee", "penalty")
+
+    def __init__(self, path="bank_users.ledger", sync=True):
+        self.path = path
+        self.sync = sync
+        self.lock = threading.Lock()
+        # Account number -> (record numbers, record times), both ascending
+        self.index = {}
+        self.records = 0
+        self.last_time = 0
+        self.view = None
+        self.mapped = 0
+        # Packed-to-be records of deferred appends, oldest first
+        self.unwritten = []
+        self.ledger_file = open(path, mode='a+b')
+        # A torn last record from a crash mid-append is cut off
+        size = os.path.getsize(path)
+        if size % self.RECORD.size:
+            self.ledger_file.truncate(size - size % self.RECORD.size)
+        self.scan()
+
+    # Builds the per-account index from the records on disk
+    def scan(self):
+        self.remap()
+        for number, (when, _, _, _, account, _) in enumerate(self.RECORD.iter_unpack(self.view or b"")):
+            self.add_to_index(number, when, account.rstrip(b"\0"))
+        self.records = self.mapped
+
+    def add_to_index(self, number, when, account):
+        entry = self.index.get(account)
+        if entry is None:
+            entry = self.index[account] = (array('q'), array('q'))
+        entry[0].append(number)
+        entry[1].append(when)
+        self.last_time = max(self.last_time, when)
+
+    # Maps the whole file again after it has grown
+    def remap(self):
+        if self.view is not None:
+            self.view.close()
+            self.view = None
+        self.ledger_file.flush()
+        size = os.path.getsize(self.path)
+        if size:
+            self.view = mmap.mmap(self.ledger_file.fileno(), size, access=mmap.ACCESS_READ)
+        self.mapped = size // self.RECORD.size
+
+    # Appends (account number, kind, amount cents, balance cents, counterparty) entries in one write
+    # A transfer records both legs together; times never go backwards, so the index stays sorted
+    # With defer, the records are only buffered, for a later write (e.g. by the group commit)
+    def append(self, entries, defer=False):
+        with self.lock:
+            when = self.last_time = max(time.time_ns(), self.last_time)
+            records = [(when, amount, balance, self.KINDS.index(kind), account_number.encode(), counterparty.encode())
+                       for account_number, kind, amount, balance, counterparty in entries]
+            if defer:
+                self.unwritten.extend(records)
+            else:
+                # Buffered records are older, so they go first to keep the file in time order
+                records, self.unwritten = self.unwritten + records, []
+                self.write_records(records)
+
+    # Hands over the buffered records
+    def take(self):
+        with self.lock:
+            records, self.unwritten = self.unwritten, []
+        return records
+
+    # Returns records handed over by take that could not be written, ahead of any buffered since
+    def put_back(self, records):
+        with self.lock:
+            self.unwritten[:0] = records
+
+    # Writes records handed over by take, with one fsync
+    def write(self, records):
+        if records:
+            with self.lock:
+                self.write_records(records)
+
+    # Called with the lock held
+    # A failed write is cut off the file and the records are indexed only once they are on disk,
+    # so writing them again does not leave them in the ledger twice
+    def write_records(self, records):
+        data = bytearray()
+        for record in records:
+            data += self.RECORD.pack(*record)
+        try:
+            self.ledger_file.write(data)
+            self.ledger_file.flush()
+            if self.sync:
+                os.fsync(self.ledger_file.fileno())
+        except Exception:
+            self.ledger_file.truncate(self.records * self.RECORD.size)
+            raise
+        for record in records:
+            self.add_to_index(self.records, record[0], record[4])
+            self.records += 1
+
+    # Reads record n back as a dictionary
+    def record(self, number):
+        if number >= self.mapped:
+            self.remap()
+        when, amount, balance, kind, account, counterparty = self.RECORD.unpack_from(self.view, number * self.RECORD.size)
+        return {"id": number,
+                "time": datetime.fromtimestamp(when / 1e9, timezone.utc).isoformat(),
+                "kind": self.KINDS[kind],
+                "amount": Money(amount),
+                "balance": Money(balance),
+                "account": account.rstrip(b"\0").decode(),
+                "counterparty": counterparty.rstrip(b"\0").decode()}
+
+    # Records of an account from start up to but not including end, oldest first
+    # Two binary searches find the range, so only the k matching records are read
+    def statement(self, account_number, start=None, end=None):
+        start, end = time_ns_of(start), time_ns_of(end)
+        with self.lock:
+            entry = self.index.get(account_number.encode())
+            if entry is None:
+                return []
+            numbers, times = entry
+            first = 0 if start is None else bisect_left(times, start)
+            last = len(times) if end is None else bisect_left(times, end)
+            return [self.record(numbers[i]) for i in range(first, last)]
+
+    # The account's balance at the given time, or None if the ledger has no record of the account
+    # Before its first record, that is the balance the account came into the ledger with
+    def balance_as_of(self, account_number, when):
+        when = time_ns_of(when)
+        with self.lock:
+            entry = self.index.get(account_number.encode())
+            if entry is None:
+                return None
+            numbers, times = entry
+            position = bisect_right(times, when)
+            if position == 0:
+                first = self.record(numbers[0])
+                return first["balance"] - first["amount"]
+            return self.record(numbers[position - 1])["balance"]
+
+    def close(self):
+        with self.lock:
+            if self.view is not None:
+                self.view.close()
+                self.view = None
+            self.ledger_file.close()
+
+
+
+""" The Lazy_User_Table class stands in for the users dictionary on very large .csv files
+    Startup only builds a username -> byte offset index, kept in a sidecar .idx file
+    Users are built from their row on first access and held in a bounded LRU cache
+    Rows changed since the last snapshot are read back from the journal instead
+    A second index over the account number column answers account_owner lookups
+"""
+class Lazy_User_Table:
+    INDEX_HEADER = struct.Struct("<8sQQQ")
+    INDEX_MAGIC = b"CPXIDX02"
+
+    def __init__(self, path, journal, capacity=10000):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.journal = journal
+        self.capacity = capacity
+
+        # Users currently in memory, most recently used last
+        self.cache = OrderedDict()
+        # Users still referenced elsewhere (e.g. current_user) after eviction
+        self.live = weakref.WeakValueDictionary()
+        # Users changed in memory that have not reached the journal yet
+        self.dirty = set()
+        # Latest journal row of each user changed since the last snapshot
+        self.journal_offsets = {}
+        # Users that are not in the .csv snapshot yet, and their account numbers
+        self.added = set()
+        self.added_accounts = {}
+        # The cache and file position are shared, so threads take turns
+        self.lock = threading.RLock()
+
+        self.base_file = None
+        self.reload()
+
+    # Re-reads the snapshot index and the journal, e.g. after save_users compacts
+    def reload(self):
+        if self.base_file is not None:
+            self.base_file.close()
+            self.base_file = None
+        self.clear_index()
+        if os.path.exists(self.path):
+            self.base_file = open(self.path, mode='rb')
+            if not self.load_index():
+                self.build_index()
+        self.journal_offsets.clear()
+        self.added.clear()
+        self.added_accounts.clear()
+        self.dirty.clear()
+        self.replay_journal()
+
+    # Loads the sidecar index if it matches the current .csv file
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return False
+        stat = os.stat(self.path)
+        with open(self.index_path, mode='rb') as index_file:
+            header = index_file.read(self.INDEX_HEADER.size)
+            if len(header) != self.INDEX_HEADER.size:
+                return False
+            magic, size, mtime, count = self.INDEX_HEADER.unpack(header)
+            if magic != self.INDEX_MAGIC or size != stat.st_size or mtime != stat.st_mtime_ns:
+                return False
+            try:
+                for column in (self.hashes, self.offsets, self.account_hashes, self.account_offsets):
+                    column.fromfile(index_file, count)
+            except EOFError:
+                self.clear_index()
+                return False
+        return True
+
+    def clear_index(self):
+        self.hashes = array('Q')
+        self.offsets = array('Q')
+        self.account_hashes = array('Q')
+        self.account_offsets = array('Q')
+
+    # Scans the .csv file once for row offsets, sorts them by username hash and saves the sidecar
+    def build_index(self):
+        hashes = array('Q')
+        account_hashes = array('Q')
+        offsets = array('Q')
+        offset = 0
+        self.base_file.seek(0)
+        for line in self.base_file:
+            fields = line.split(b',', 3)
+            if len(fields) == 4 and fields[0]:
+                hashes.append(username_hash(fields[0]))
+                account_hashes.append(username_hash(fields[2]))
+                offsets.append(offset)
+            offset += len(line)
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        self.hashes = array('Q', [hashes[i] for i in order])
+        self.offsets = array('Q', [offsets[i] for i in order])
+        order = sorted(range(len(account_hashes)), key=account_hashes.__getitem__)
+        self.account_hashes = array('Q', [account_hashes[i] for i in order])
+        self.account_offsets = array('Q', [offsets[i] for i in order])
+
+        stat = os.stat(self.path)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, mode='wb') as index_file:
+            index_file.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, stat.st_size, stat.st_mtime_ns, len(self.hashes)))
+            for column in (self.hashes, self.offsets, self.account_hashes, self.account_offsets):
+                column.tofile(index_file)
+        os.replace(temp_path, self.index_path)
+
+    # Records where each user's latest journal row is, without building the users
+    def replay_journal(self):
+        if not os.path.exists(self.journal.path):
+            return
+        offset = 0
+        with open(self.journal.path, mode='rb') as journal_file:
+            for line in journal_file:
+                comma = line.find(b',')
+                # Skips a torn last row from a crash mid-append
+                if comma > 0 and line.endswith(b'\n'):
+                    username = line[:comma].decode()
+                    self.journaled(username, offset)
+                    if username in self.added:
+                        self.added_accounts[line.split(b',', 3)[2].decode()] = username
+                offset += len(line)
+        self.journal.records = len(self.journal_offsets)
+
+    # Notes that a user's latest state is now at the given journal offset
+    def journaled(self, username, offset):
+        with self.lock:
+            self.journal_offsets[username] = offset
+            self.dirty.discard(username)
+            if username not in self.added and self.base_row(username) is None:
+                self.added.add(username)
+
+    # Reads the snapshot rows whose hash matches and returns the one holding the value in the column
+    def lookup(self, hashes, offsets, column, value):
+        if self.base_file is None:
+            return None
+        key = username_hash(value.encode())
+        i = bisect_left(hashes, key)
+        while i < len(hashes) and hashes[i] == key:
+            row = read_row_at(self.base_file, offsets[i])
+            if len(row) > column and row[column] == value:
+                return row
+            i += 1
+        return None
+
+    # Finds a user's row in the .csv snapshot through the hash index
+    def base_row(self, username):
+        return self.lookup(self.hashes, self.offsets, 0, username)
+
+    # Returns the username that owns an account number, or None
+    def account_owner(self, account_number):
+        with self.lock:
+            username = self.added_accounts.get(account_number)
+            if username is not None:
+                return username
+            row = self.lookup(self.account_hashes, self.account_offsets, 2, account_number)
+            return row[0] if row else None
+
+    # Builds a user from the journal or the snapshot, or returns the one already in memory
+    def materialize(self, username):
+        with self.lock:
+            user = self.cache.get(username)
+            if user is not None:
+                self.cache.move_to_end(username)
+                return user
+            user = self.live.get(username)
+            if user is None:
+                offset = self.journal_offsets.get(username)
+                if offset is not None:
+                    with open(self.journal.path, mode='rb') as journal_file:
+                        row = read_row_at(journal_file, offset)
+                else:
+                    row = self.base_row(username)
+                if row is None:
+                    return None
+                user = user_from_row(row)
+                self.live[username] = user
+            self.cache[username] = user
+            self.evict()
+            return user
+
+    # Drops the least recently used users, journaling any that are still dirty
+    def evict(self):
+        while len(self.cache) > self.capacity:
+            username, user = self.cache.popitem(last=False)
+            if username in self.dirty:
+                offset, = self.journal.append([[user.username, user.password, user.account.account_number, user.account.check_balance()]])
+                self.journaled(username, offset)
+
+    def get(self, username, default=None):
+        user = self.materialize(username)
+        return default if user is None else user
+
+    def __getitem__(self, username):
+        user = self.materialize(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+
+    def __setitem__(self, username, user):
+        with self.lock:
+            if username not in self:
+                self.added.add(username)
+                self.added_accounts[user.account.account_number] = username
+            self.cache[username] = user
+            self.live[username] = user
+            self.dirty.add(username)
+            self.evict()
+
+    # Adds many users, like dict.update
+    def update(self, users):
+        for username, user in users.items():
+            self[username] = user
+
+    def __contains__(self, username):
+        with self.lock:
+            return (username in self.cache or username in self.journal_offsets
+                    or username in self.live or self.base_row(username) is not None)
+
+    def __len__(self):
+        return len(self.hashes) + len(self.added)
+
+    def __iter__(self):
+        for user in self.values():
+            yield user.username
+
+    # Streams every user in snapshot order, then users added since the snapshot
+    # Users that are not in memory are built for the caller without entering the cache
+    def values(self):
+        seen = set()
+        if self.base_file is not None:
+            with open(self.path, mode='r', newline='') as user_file:
+                for row in csv.reader(user_file):
+                    if not row:
+                        continue
+                    username = row[0]
+                    if username in self.cache or username in self.live or username in self.journal_offsets:
+                        seen.add(username)
+                        yield self.current(username)
+                    else:
+                        yield user_from_row(row)
+        for username in list(self.added):
+            if username not in seen:
+                yield self.current(username)
+
+    # Returns the in-memory user if there is one, else builds it without caching
+    def current(self, username):
+        user = self.cache.get(username) or self.live.get(username)
+        if user is not None:
+            return user
+        with open(self.journal.path, mode='rb') as journal_file:
+            return user_from_row(read_row_at(journal_file, self.journal_offsets[username]))
+
+
+
+""" The Store_Account class is a lightweight view of one account in an Account_Store
+    Keeps the Bank_Account deposit, withdraw, can_transfer and check_balance rules
+    Amounts are given in dollars and applied to the store in whole cents
+    Balances are handed out as Money
+"""
+class Store_Account:
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def account_number(self):
+        return str(self.store.account_numbers[self.index])
+
+    @property
+    def cents(self):
+        return self.store.balances[self.index]
+
+    @property
+    def balance(self):
+        return Money(self.store.balances[self.index])
+
+    @balance.setter
+    def balance(self, amount):
+        self.store.balances[self.index] = to_cents(amount)
+
+    # User can only deposit any amount from 1 to 3000 in one function
+    def deposit(self, amount):
+        cents = amount.cents if type(amount) is Money else to_cents(amount)
+        if 100 <= cents < 300000:
+            self.store.balances[self.index] += cents
+            return True
+        return False
+
+    # User cannot overdraw from their checking account
+    def withdraw(self, amount):
+        cents = amount.cents if type(amount) is Money else to_cents(amount)
+        if 0 < cents <= self.store.balances[self.index]:
+            self.store.balances[self.index] -= cents
+            return True
+        return False
+
+    def check_balance(self):
+        return Money(self.store.balances[self.index])
+
+    # Returns a bool function to determine if user can transfer money
+    def can_transfer(self, amount):
+        return 0 < (amount.cents if type(amount) is Money else to_cents(amount)) <= self.store.balances[self.index]
+
+
+
+""" The Store_User class is a lightweight view of one user in an Account_Store
+    Has the same username, password and account attributes as Account_User
+"""
+class Store_User:
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def username(self):
+        return self.store.username_at(self.index)
+
+    @property
+    def password(self):
+        return self.store.password_at(self.index)
+
+    @password.setter
+    def password(self, password):
+        self.store.set_password(self.index, password)
+
+    @property
+    def account(self):
+        return Store_Account(self.store, self.index)
+
+
+
+""" The Account_Store class is a compact, column-based replacement for the users dictionary
+    Balances are kept as whole cents and account numbers as integers in parallel arrays
+    Usernames and passwords are packed into byte string tables instead of one object each
+    Open-addressing hash tables of row numbers find a username or an account number in O(1)
+    Lookups return Store_User views, so the rest of the app works unchanged
+"""
+class Account_Store:
+    def __init__(self):
+        self.balances = array('q')
+        self.account_numbers = array('q')
+        # Usernames never change, so each one ends where the next one starts
+        self.names = bytearray()
+        self.name_starts = array('q', [0])
+        # A changed password is appended to the table and its span re-pointed
+        self.secrets = bytearray()
+        self.secret_spans = array('q')
+        # Row number per slot, -1 when empty, kept at most half full
+        self.slots = array('i', [-1]) * 8
+        self.account_slots = array('i', [-1]) * 8
+
+    def username_at(self, index):
+        return self.names[self.name_starts[index]:self.name_starts[index + 1]].decode()
+
+    def password_at(self, index):
+        return self.secrets[self.secret_spans[2 * index]:self.secret_spans[2 * index + 1]].decode()
+
+    def set_password(self, index, password):
+        encoded = password.encode()
+        self.secret_spans[2 * index] = len(self.secrets)
+        self.secrets += encoded
+        self.secret_spans[2 * index + 1] = len(self.secrets)
+
+    # Returns the row of a username (or None) and the slot where it is or would go
+    def find(self, username):
+        encoded = username.encode()
+        mask = len(self.slots) - 1
+        slot = zlib.crc32(encoded) & mask
+        while True:
+            index = self.slots[slot]
+            if index < 0:
+                return None, slot
+            if self.names[self.name_starts[index]:self.name_starts[index + 1]] == encoded:
+                return index, slot
+            slot = (slot + 1) & mask
+
+    # Fibonacci hashing spreads sequential account numbers over the table
+    def account_slot(self, account_number, mask):
+        return (account_number * 11400714819323198485 >> 40) & mask
+
+    # Returns the username that owns an account number, or None
+    def account_owner(self, account_number):
+        try:
+            number = int(account_number)
+        except ValueError:
+            return None
+        mask = len(self.account_slots) - 1
+        slot = self.account_slot(number, mask)
+        while True:
+            index = self.account_slots[slot]
+            if index < 0:
+                return None
+            if self.account_numbers[index] == number:
+                return self.username_at(index)
+            slot = (slot + 1) & mask
+
+    def insert_account(self, index):
+        mask = len(self.account_slots) - 1
+        slot = self.account_slot(self.account_numbers[index], mask)
+        while self.account_slots[slot] >= 0:
+            slot = (slot + 1) & mask
+        self.account_slots[slot] = index
+
+    # Doubles the hash tables and re-inserts every row
+    def grow(self):
+        self.slots = array('i', [-1]) * (len(self.slots) * 2)
+        self.account_slots = array('i', [-1]) * len(self.slots)
+        mask = len(self.slots) - 1
+        for index in range(len(self.balances)):
+            slot = zlib.crc32(self.names[self.name_starts[index]:self.name_starts[index + 1]]) & mask
+            while self.slots[slot] >= 0:
+                slot = (slot + 1) & mask
+            self.slots[slot] = index
+            self.insert_account(index)
+
+    # Adds a user row, or overwrites the existing row of the same username
+    def add(self, username, password, account_number, balance):
+        index, slot = self.find(username)
+        if index is None:
+            index = len(self.balances)
+            self.slots[slot] = index
+            self.names += username.encode()
+            self.name_starts.append(len(self.names))
+            self.secret_spans.extend((0, 0))
+            self.balances.append(0)
+            self.account_numbers.append(int(account_number))
+            self.insert_account(index)
+            if 2 * len(self.balances) > len(self.slots):
+                self.grow()
+        self.set_password(index, password)
+        # Balances read from a .csv file may be older float text, so they are rounded to the cent
+        self.balances[index] = to_cents(balance, exact=False)
+
+    def get(self, username, default=None):
+        index = self.find(username)[0]
+        return default if index is None else Store_User(self, index)
+
+    def __getitem__(self, username):
+        index = self.find(username)[0]
+        if index is None:
+            raise KeyError(username)
+        return Store_User(self, index)
+
+    # Copies an Account_User (or any user-like object) into the columns
+    def __setitem__(self, username, user):
+        self.add(username, user.password, user.account.account_number, user.account.check_balance())
+
+    # Adds many users, like dict.update
+    def update(self, users):
+        for username, user in users.items():
+            self[username] = user
+
+    def __contains__(self, username):
+        return self.find(username)[0] is not None
+
+    def __len__(self):
+        return len(self.balances)
+
+    def __iter__(self):
+        return (self.username_at(index) for index in range(len(self.balances)))
+
+    def values(self):
+        return (Store_User(self, index) for index in range(len(self.balances)))
+
+    # Sum of every balance, added up in C over the cent column
+    def total_deposits(self):
+        return Money(sum(self.balances))
+
+    # Counts the balances that fall in each [edge, next edge) dollar bucket
+    # Sorts the cent column once, then needs only one binary search per edge
+    def balance_histogram(self, edges):
+        ordered = sorted(self.balances)
+        cuts = [bisect_left(ordered, to_cents(edge)) for edge in edges]
+        cuts.append(len(ordered))
+        return [cuts[i + 1] - cuts[i] for i in range(len(edges))]
+
+
+
+# Maps each digit to the digit sum of its double, as the Luhn check needs
+LUHN_DOUBLED = str.maketrans("0123456789", "0246813579")
+
+
+# Luhn check digit of a string of digits
+# Every other digit from the right is doubled, and the check digit tops the sum up to a multiple of 10
+def luhn_digit(digits):
+    total = sum(map(int, digits[::-2].translate(LUHN_DOUBLED))) + sum(map(int, digits[-2::-2]))
+    return str(-total % 10)
+
+
+
+""" The Account_Number_Allocator class hands out unique 9-digit account numbers in O(1)
+    A counter is run through a keyed Feistel permutation of the 8-digit range, so numbers
+    look random but can never repeat, and a Luhn check digit is appended
+    Counter values are reserved in blocks in a small sidecar file, so a restart never reuses one
+    A shard of a Shard_Router only takes the numbers that fall in its shard, so shards never collide
+"""
+class Account_Number_Allocator:
+    LOW = 10000000
+    SPAN = 90000000
+    # Each Feistel half is 14 bits; 2 ** 28 covers the 8-digit span
+    HALF_BITS = 14
+    ROUNDS = 4
+
+    def __init__(self, path, block=1000, shard=0, shards=1):
+        self.path = path
+        self.block = block
+        self.shard = shard
+        self.shards = shards
+        self.counter = 0
+        self.limit = 0
+        if os.path.exists(path):
+            with open(path, mode='r') as sequence_file:
+                limit, key = sequence_file.read().split()
+            self.counter = self.limit = int(limit)
+            self.key = int(key, 16)
+        else:
+            self.key = int.from_bytes(os.urandom(8), "big")
+        self.round_keys = [(self.key >> (16 * i)) & 0xFFFF for i in range(self.ROUNDS)]
+        self.lock = threading.Lock()
+
+    # Persists the end of the next block of counter values before any of them is used
+    def reserve(self, needed=0):
+        self.limit = self.counter + needed + self.block
+        with open(self.path + ".tmp", mode='w') as sequence_file:
+            sequence_file.write(f"{self.limit} {self.key:016x}\n")
+            sequence_file.flush()
+            os.fsync(sequence_file.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    # Bijection on range(SPAN): Feistel rounds on 28 bits, walking the cycle until the value fits
+    def permute(self, value):
+        mask = (1 << self.HALF_BITS) - 1
+        while True:
+            left, right = value >> self.HALF_BITS, value & mask
+            for round_key in self.round_keys:
+                left, right = right, left ^ ((((right ^ round_key) * 0x9E3779B1) >> 11) & mask)
+            value = left << self.HALF_BITS | right
+            if value < self.SPAN:
+                return value
+
+    def allocate(self):
+        return self.allocate_many(1)[0]
+
+    # Takes count counter values under one lock and at most one reservation
+    def allocate_many(self, count):
+        if self.shards > 1:
+            return self.allocate_in_shard(count)
+        with self.lock:
+            if self.counter + count > self.SPAN:
+                raise ValueError("No account numbers are left")
+            if self.counter + count > self.limit:
+                self.reserve(count)
+            first = self.counter
+            self.counter += count
+        numbers = []
+        for sequence in range(first, first + count):
+            body = str(self.LOW + self.permute(sequence))
+            numbers.append(body + luhn_digit(body))
+        return numbers
+
+    # Walks the counter until count numbers belong to this shard; about shards values are used per number
+    def allocate_in_shard(self, count):
+        numbers = []
+        with self.lock:
+            while len(numbers) < count:
+                if self.counter >= self.SPAN:
+                    raise ValueError("No account numbers are left")
+                if self.counter >= self.limit:
+                    self.reserve((count - len(numbers)) * self.shards)
+                body = self.LOW + self.permute(self.counter)
+                self.counter += 1
+                if body % self.shards == self.shard:
+                    numbers.append(str(body) + luhn_digit(str(body)))
+        return numbers
+
+
+
+""" The Credential_Hasher class turns passwords into salted, slow hashes for storage
+    Supports pbkdf2_sha256 (cost = iterations) and scrypt (cost = N) from hashlib
+    A stored hash records its scheme, cost and salt, e.g. pbkdf2_sha256$200000$<salt>$<hash>
+    Anything without a scheme prefix is a legacy plaintext password
+"""
+class Credential_Hasher:
+    DEFAULT_COST = {"pbkdf2_sha256": 200000, "scrypt": 2 ** 14}
+
+    def __init__(self, scheme="pbkdf2_sha256", cost=None):
+        if scheme not in self.DEFAULT_COST:
+            raise ValueError(f"Unknown password scheme: {scheme}")
+        self.scheme = scheme
+        self.cost = cost if cost is not None else self.DEFAULT_COST[scheme]
+
+    # Derives the hash of a password with the given scheme, cost and salt
+    def derive(self, scheme, cost, salt, password):
+        if scheme == "pbkdf2_sha256":
+            return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, cost)
+        return hashlib.scrypt(password.encode(), salt=salt, n=cost, r=8, p=1, maxmem=256 * cost * 8 + 2 ** 20)
+
+    # Hashes a password with a fresh per-user salt
+    def hash(self, password):
+        salt = os.urandom(16)
+        return f"{self.scheme}${self.cost}${salt.hex()}${self.derive(self.scheme, self.cost, salt, password).hex()}"
+
+    def is_hashed(self, stored):
+        return stored.split("$", 1)[0] in self.DEFAULT_COST
+
+    # Checks a password against a stored hash, or against a legacy plaintext password
+    def verify(self, password, stored):
+        if not self.is_hashed(stored):
+            return hmac.compare_digest(password.encode(), stored.encode())
+        try:
+            scheme, cost, salt, expected = stored.split("$")
+            derived = self.derive(scheme, int(cost), bytes.fromhex(salt), password)
+        except ValueError:
+            return False
+        return hmac.compare_digest(derived, bytes.fromhex(expected))
+
+    # A stored password needs rehashing if it is plaintext or uses another scheme or cost
+    def needs_upgrade(self, stored):
+        return not stored.startswith(f"{self.scheme}${self.cost}$")
+
+    # Picks the highest cost whose hash still fits in the login latency budget (seconds)
+    @classmethod
+    def tuned(cls, budget, scheme="pbkdf2_sha256"):
+        cost = 1000 if scheme == "pbkdf2_sha256" else 2 ** 10
+        hasher = cls(scheme, cost)
+        while True:
+            start = time.perf_counter()
+            hasher.hash("CapitEx@tune")
+            if 2 * (time.perf_counter() - start) > budget:
+                return hasher
+            hasher = cls(scheme, hasher.cost * 2)
+
+
+
+""" The Credential_Cache class remembers recent successful logins for a short time
+    A cached login is checked with one keyed HMAC instead of the slow password hash
+    Entries expire after ttl seconds, are dropped when the stored hash changes,
+    and the least recently used entry is evicted beyond capacity
+"""
+class Credential_Cache:
+    def __init__(self, ttl=30, capacity=100000):
+        self.ttl = ttl
+        self.capacity = capacity
+        # Random per process, so cached digests mean nothing outside it
+        self.key = os.urandom(32)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def digest(self, username, password):
+        return hmac.new(self.key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def check(self, username, password, stored):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return False
+            cached_stored, digest, expires = entry
+            if time.monotonic() >= expires or cached_stored != stored:
+                del self.entries[username]
+                return False
+            self.entries.move_to_end(username)
+        return hmac.compare_digest(digest, self.digest(username, password))
+
+    def remember(self, username, password, stored):
+        entry = (stored, self.digest(username, password), time.monotonic() + self.ttl)
+        with self.lock:
+            self.entries[username] = entry
+            self.entries.move_to_end(username)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+
+
+""" The Idempotency_Cache class remembers the outcome of operations sent with an idempotency key
+    A retried request with the same key gets the first outcome back instead of running again,
+    and a request that is still running makes its duplicates wait for it
+    Entries expire after ttl seconds and the least recently used one is evicted beyond capacity
+    Outcomes are appended to a .keys file next to the user data and loaded again on startup;
+    the file is rewritten with just the live entries once it holds twice the capacity
+"""
+class Idempotency_Cache:
+    def __init__(self, path, ttl=86400, capacity=100000, sync=True):
+        self.path = path
+        self.ttl = ttl
+        self.capacity = capacity
+        self.sync = sync
+        # Key -> (request, expires, ok, balance cents or error message)
+        self.entries = OrderedDict()
+        # Key -> Event of a request that is running now
+        self.running = {}
+        # Lines waiting to be written, and lines in the file
+        self.unwritten = []
+        self.lines = 0
+        self.keys_file = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.load()
+
+    # Loads the entries that have not expired yet
+    # A torn last line from a crash mid-append is skipped
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path, mode='r', encoding='utf-8') as keys_file:
+            for line in keys_file:
+                try:
+                    key, request, expires, ok, value = json.loads(line)
+                except ValueError:
+                    continue
+                self.lines += 1
+                if expires > now:
+                    self.entries[key] = (request, expires, ok, value)
+                    self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    # Runs operation() once per key and returns its result, or raises its ValueError
+    # A Limit_Exceeded refusal is not remembered, so a later retry with the key runs the operation
+    # request describes the operation; reusing a key for a different request is refused
+    # With defer, the outcome is only buffered, for a later write (e.g. by the group commit)
+    def run(self, key, request, operation, defer=False):
+        request = list(request)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[1] <= time.time():
+                    del self.entries[key]
+                    entry = None
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    break
+                waiting = self.running.get(key)
+                if waiting is None:
+                    self.running[key] = threading.Event()
+                    break
+            waiting.wait()
+
+        if entry is None:
+            try:
+                try:
+                    result = operation()
+                except Limit_Exceeded:
+                    raise
+                except ValueError as e:
+                    entry = self.remember(key, request, False, str(e), defer)
+                else:
+                    entry = self.remember(key, request, True, result.cents, defer)
+            finally:
+                with self.lock:
+                    self.running.pop(key).set()
+
+        cached_request, _, ok, value = entry
+        if cached_request != request:
+            raise ValueError("This idempotency key was already used for a different request")
+        if not ok:
+            raise ValueError(value)
+        return Money(value)
+
+    def remember(self, key, request, ok, value, defer):
+        entry = (request, time.time() + self.ttl, ok, value)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            self.unwritten.append(json.dumps([key, *entry]) + "\n")
+        if not defer:
+            self.write(self.take())
+        return entry
+
+    # Hands over the buffered lines
+    def take(self):
+        with self.lock:
+            lines, self.unwritten = self.unwritten, []
+        return lines
+
+    # Returns lines handed over by take that could not be written, ahead of any buffered since
+    # A line written twice is harmless, since a later line for a key replaces the earlier one
+    def put_back(self, lines):
+        with self.lock:
+            self.unwritten[:0] = lines
+
+    # Appends lines to the .keys file, or rewrites it with the live entries once it has grown too long
+    def write(self, lines):
+        if not lines:
+            return
+        with self.write_lock:
+            if self.lines + len(lines) > 2 * self.capacity:
+                self.rewrite()
+                return
+            if self.keys_file is None:
+                self.keys_file = open(self.path, mode='a', encoding='utf-8')
+            self.keys_file.write("".join(lines))
+            self.keys_file.flush()
+            if self.sync:
+                os.fsync(self.keys_file.fileno())
+            self.lines += len(lines)
+
+    # Writes every live entry (which includes any lines being written) to a new file
+    def rewrite(self):
+        with self.lock:
+            lines = [json.dumps([key, *entry]) + "\n" for key, entry in self.entries.items()]
+        self.close()
+        with open(self.path + ".tmp", mode='w', encoding='utf-8') as keys_file:
+            keys_file.write("".join(lines))
+            keys_file.flush()
+            os.fsync(keys_file.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        self.lines = len(lines)
+
+    def close(self):
+        if self.keys_file is not None:
+            self.keys_file.close()
+            self.keys_file = None
+
+
+
+""" The Limit_Exceeded error is a refusal by the rate limits that goes away with time
+    It is still a ValueError, but an idempotency key does not remember it, so a retry is tried again
+"""
+class Limit_Exceeded(ValueError):
+    pass
+
+
+
+""" The Rate_Limiter class limits how fast each account can act and how much it can send per day
+    Every operation takes a token from the account's bucket, which refills at rate tokens per second
+    up to burst; withdrawals and transfers also count against a rolling daily limit
+    The rolling day is two fixed days blended by how far into the current one we are, so only
+    two totals are kept per account
+    State lives in arrays indexed by a slot per account, taken on the account's first operation;
+    buckets are refilled lazily when checked, so idle accounts cost nothing
+"""
+class Rate_Limiter:
+    DAY = 86400
+
+    def __init__(self, rate=5, burst=20, daily_limit=10000):
+        self.rate = rate
+        self.burst = burst
+        self.daily_cents = to_cents(daily_limit)
+        self.clock = time.time
+        self.slots = {}
+        self.tokens = array('d')
+        self.refilled = array('d')
+        # Day number, and cents sent on that day and on the day before
+        self.days = array('q')
+        self.spent = array('q')
+        self.spent_before = array('q')
+        self.lock = threading.Lock()
+
+    def slot(self, account_number, now):
+        slot = self.slots.get(account_number)
+        if slot is None:
+            slot = self.slots[account_number] = len(self.tokens)
+            self.tokens.append(self.burst)
+            self.refilled.append(now)
+            self.days.append(int(now // self.DAY))
+            self.spent.append(0)
+            self.spent_before.append(0)
+        return slot
+
+    # Moves the daily totals along to today's day number
+    def roll(self, slot, now):
+        day = int(now // self.DAY)
+        if day != self.days[slot]:
+            self.spent_before[slot] = self.spent[slot] if day == self.days[slot] + 1 else 0
+            self.spent[slot] = 0
+            self.days[slot] = day
+
+    # Cents sent over the last 24 hours, estimated from today's and yesterday's totals
+    def sent_today(self, slot, now):
+        self.roll(slot, now)
+        return self.spent[slot] + int(self.spent_before[slot] * (1 - now % self.DAY / self.DAY))
+
+    # Takes one token for an operation, or refuses it if the bucket is empty
+    def admit(self, account_number):
+        now = self.clock()
+        with self.lock:
+            slot = self.slot(account_number, now)
+            tokens = min(self.burst, self.tokens[slot] + (now - self.refilled[slot]) * self.rate)
+            self.refilled[slot] = now
+            if tokens < 1:
+                self.tokens[slot] = tokens
+                raise Limit_Exceeded(f"Too many requests. Try again in {(1 - tokens) / self.rate:.1f} seconds")
+            self.tokens[slot] = tokens - 1
+
+    # Refuses an amount that would take the account past its daily limit
+    # Called under the account's lock, before the money moves
+    def check_daily(self, account_number, cents):
+        now = self.clock()
+        with self.lock:
+            sent = self.sent_today(self.slot(account_number, now), now)
+        if sent + cents > self.daily_cents:
+            raise Limit_Exceeded(f"This would exceed your daily limit of {Money(self.daily_cents)}. "
+                             f"You can send {Money(max(0, self.daily_cents - sent))} more today")
+
+    # Counts an amount that was sent
+    def spend(self, account_number, cents):
+        now = self.clock()
+        with self.lock:
+            slot = self.slot(account_number, now)
+            self.roll(slot, now)
+            self.spent[slot] += cents
+
+    # What the limits allow an account right now
+    def status(self, account_number):
+        now = self.clock()
+        with self.lock:
+            slot = self.slots.get(account_number)
+            if slot is None:
+                return {"requests_left": self.burst, "sent_today": Money(0), "left_today": Money(self.daily_cents)}
+            tokens = min(self.burst, self.tokens[slot] + (now - self.refilled[slot]) * self.rate)
+            sent = self.sent_today(slot, now)
+        return {"requests_left": int(tokens), "sent_today": Money(sent), "left_today": Money(max(0, self.daily_cents - sent))}
+
+
+
+""" The Session_Table class maps opaque session tokens to usernames for many logged-in users at once
+    A session expires after idle_timeout seconds without use; each use pushes its deadline back
+    Deadlines are kept in a hierarchical timing wheel: LEVELS wheels of SLOTS slots, each slot of a
+    level spanning SLOTS times the ticks of the level below, so adding a session is O(1)
+    As time passes, the slots of a higher level are cascaded into the lower ones, and sessions in a due
+    slot of the lowest level are expired, or put back at their new deadline if they were used meanwhile
+"""
+class Session_Table:
+    SLOTS = 64
+    BITS = 6
+    LEVELS = 4
+
+    # The wheels start at the clock's current tick, so a different clock is given up front
+    def __init__(self, idle_timeout=900, tick=1.0, clock=time.monotonic):
+        self.tick = tick
+        self.timeout = max(1, -int(-idle_timeout // tick))
+        self.clock = clock
+        # Token -> [username, deadline tick]
+        self.sessions = {}
+        # Tokens by deadline; a token is in exactly one slot while its session lasts
+        self.wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self.now = self.ticks()
+        # Sessions too far off for the wheels wait here until they come into range
+        self.overflow = []
+        self.lock = threading.Lock()
+
+    def ticks(self):
+        return int(self.clock() // self.tick)
+
+    # Puts a token in the slot of its deadline, on the lowest level whose span reaches it
+    def schedule(self, token, deadline):
+        delta = deadline - self.now
+        for level in range(self.LEVELS):
+            if delta < self.SLOTS << (self.BITS * level):
+                self.wheels[level][(deadline >> (self.BITS * level)) & (self.SLOTS - 1)].append(token)
+                return
+        self.overflow.append(token)
+
+    # Moves time on to the current tick, one tick at a time, and returns how many sessions expired
+    # Each tick cascades the higher slots that came due, then expires the lowest level's slot
+    def advance(self):
+        target = self.ticks()
+        # With no sessions every token left in the wheels belongs to an ended one, so time jumps ahead
+        if not self.sessions:
+            if self.now < target:
+                self.wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+                self.overflow = []
+                self.now = target
+            return 0
+        expired = 0
+        while self.now < target:
+            self.now += 1
+            for level in range(1, self.LEVELS + 1):
+                if self.now & ((1 << (self.BITS * level)) - 1):
+                    break
+                if level == self.LEVELS:
+                    tokens, self.overflow = self.overflow, []
+                else:
+                    slot = self.wheels[level]
+                    index = (self.now >> (self.BITS * level)) & (self.SLOTS - 1)
+                    tokens, slot[index] = slot[index], []
+                for token in tokens:
+                    session = self.sessions.get(token)
+                    if session is not None:
+                        self.schedule(token, session[1])
+            slot = self.wheels[0]
+            index = self.now & (self.SLOTS - 1)
+            tokens, slot[index] = slot[index], []
+            for token in tokens:
+                session = self.sessions.get(token)
+                # Ended sessions are skipped; used ones go back in at their later deadline
+                if session is None:
+                    continue
+                if session[1] > self.now:
+                    self.schedule(token, session[1])
+                else:
+                    del self.sessions[token]
+                    expired += 1
+        return expired
+
+    # Starts a session for a user and returns its token
+    def create(self, username):
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.advance()
+            deadline = self.now + self.timeout
+            self.sessions[token] = [username, deadline]
+            self.schedule(token, deadline)
+        return token
+
+    # Returns the username of a live session and pushes its deadline back, or None
+    # The token stays in its slot; the wheel moves it when that slot comes due
+    def validate(self, token):
+        with self.lock:
+            self.advance()
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            session[1] = self.now + self.timeout
+            return session[0]
+
+    # Ends a session, e.g. on logout; returns False if it had already ended or expired
+    def end(self, token):
+        with self.lock:
+            return self.sessions.pop(token, None) is not None
+
+    # Expires every session that is due, which create and validate also do as they go
+    def expire(self):
+        with self.lock:
+            return self.advance()
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+
+""" The Interest_Schedule class holds the end-of-period rules and applies them to every balance
+    Interest is tiered like tax brackets: each annual rate applies to the part of a balance above
+    its threshold, spread over periods_per_year periods
+    Interest is exact: rates are fractions over one common denominator, the sum stays an integer,
+    and only the final division to cents rounds, half to even
+    A monthly fee is charged below fee_waiver and a penalty below minimum_balance, both judged on
+    the opening balance; charges never take a balance below zero
+"""
+class Interest_Schedule:
+    def __init__(self, tiers=((0, "0.005"), (1000, "0.01"), (10000, "0.02")), periods_per_year=12,
+                 monthly_fee=5, fee_waiver=1000, minimum_balance=100, penalty=10):
+        tiers = sorted((to_cents(threshold), Fraction(Decimal(str(rate))) / periods_per_year) for threshold, rate in tiers)
+        if not tiers or tiers[0][0] != 0:
+            raise ValueError("The first interest tier must start at 0")
+        self.lows = [low for low, _ in tiers]
+        self.denominator = lcm(*(rate.denominator for _, rate in tiers))
+        self.numerators = [int(rate * self.denominator) for _, rate in tiers]
+        # Interest, times the denominator, earned by the balance below each threshold
+        self.bases = [0]
+        for k in range(1, len(tiers)):
+            self.bases.append(self.bases[-1] + (self.lows[k] - self.lows[k - 1]) * self.numerators[k - 1])
+        self.fee = to_cents(monthly_fee)
+        self.fee_waiver = to_cents(fee_waiver)
+        self.minimum = to_cents(minimum_balance)
+        self.penalty = to_cents(penalty)
+
+    # Interest in cents on one opening balance
+    def interest(self, cents):
+        k = bisect_right(self.lows, cents) - 1
+        if k < 0:
+            return 0
+        quotient, remainder = divmod(self.bases[k] + (cents - self.lows[k]) * self.numerators[k], self.denominator)
+        if 2 * remainder > self.denominator or (2 * remainder == self.denominator and quotient & 1):
+            quotient += 1
+        return quotient
+
+    # (interest, fee, penalty) in cents for one opening balance
+    # Fees and penalties take at most what is left, and nothing from a negative balance
+    def charges(self, cents):
+        interest = self.interest(cents)
+        balance = cents + interest
+        fee = max(0, min(self.fee, balance)) if cents < self.fee_waiver else 0
+        balance -= fee
+        penalty = max(0, min(self.penalty, balance)) if cents < self.minimum else 0
+        return interest, fee, penalty
+
+    # Returns the closing balances of an array of opening balances, and the interest, fee and penalty totals
+    # This is charges() inlined into one loop, with everything it reads held in locals
+    def apply(self, balances):
+        lows, bases, numerators, denominator = self.lows, self.bases, self.numerators, self.denominator
+        fee, fee_waiver, minimum, penalty = self.fee, self.fee_waiver, self.minimum, self.penalty
+        closing = array('q', bytes(8 * len(balances)))
+        interest_total = fee_total = penalty_total = 0
+        for i, cents in enumerate(balances):
+            k = bisect_right(lows, cents) - 1
+            # A balance below the first tier earns nothing, as in interest()
+            if k < 0:
+                quotient = 0
+            else:
+                quotient, remainder = divmod(bases[k] + (cents - lows[k]) * numerators[k], denominator)
+                remainder *= 2
+                if remainder > denominator or (remainder == denominator and quotient & 1):
+                    quotient += 1
+            balance = cents + quotient
+            interest_total += quotient
+            if cents < fee_waiver and balance > 0:
+                charge = fee if fee < balance else balance
+                balance -= charge
+                fee_total += charge
+            if cents < minimum and balance > 0:
+                charge = penalty if penalty < balance else balance
+                balance -= charge
+                penalty_total += charge
+            closing[i] = balance
+        return closing, interest_total, fee_total, penalty_total
+
+
+
+""" The Lock_Table class guards accounts with a fixed set of striped locks
+    An account always maps to the same stripe, picked from its account number
+    Stripes are taken in ascending order, so two transfers can never deadlock
+"""
+class Lock_Table:
+    def __init__(self, stripes=1024):
+        self.stripes = [threading.Lock() for _ in range(stripes)]
+
+    def stripe(self, account_number):
+        return zlib.crc32(str(account_number).encode()) % len(self.stripes)
+
+    # Holds the locks of every given account for the duration of the block
+    @contextmanager
+    def holding(self, *account_numbers):
+        locks = [self.stripes[i] for i in sorted({self.stripe(number) for number in account_numbers})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    # Holds every stripe, which stops all account changes, e.g. while a snapshot is written
+    @contextmanager
+    def holding_all(self):
+        for lock in self.stripes:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.stripes):
+                lock.release()
+
+
+
+""" The Version_Store class gives readers a point-in-time view of every balance without taking account locks
+    Each change (a deposit, a transfer, a batch...) publishes its accounts' new balances under one new version
+    While a reader is open, the balance a change replaces is kept, so readers that began earlier still see it
+    Versions no open reader can see are dropped by later changes, and all of them once the last reader closes
+"""
+class Version_Store:
+    def __init__(self):
+        # Version of the latest published change
+        self.version = 0
+        # Account number -> [version, cents, older node or None], newest first
+        # Only accounts being changed, or changed while readers were open, have a chain
+        self.chains = {}
+        # Account numbers being changed right now
+        self.pending = set()
+        # Version -> number of open readers at it
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    # Wraps a change to accounts whose locks the caller holds
+    # Their published balances are kept before the change starts, so no reader sees it half made
+    @contextmanager
+    def writing(self, accounts):
+        accounts = {account.account_number: account for account in accounts}
+        with self.lock:
+            for number, account in accounts.items():
+                # An account without a chain has not changed since every open reader began
+                if number not in self.chains:
+                    self.chains[number] = [0, account.cents, None]
+                self.pending.add(number)
+        try:
+            yield
+        finally:
+            self.publish(accounts)
+
+    # Gives the accounts' balances one new version
+    # Without open readers the chains are dropped, and readers go back to the accounts themselves
+    def publish(self, accounts):
+        with self.lock:
+            self.version += 1
+            oldest = min(self.readers) if self.readers else None
+            for number, account in accounts.items():
+                self.pending.discard(number)
+                if oldest is None:
+                    del self.chains[number]
+                    continue
+                older = self.chains[number]
+                # The oldest reader needs nothing below the first version it can see
+                node = older
+                while node[0] > oldest:
+                    node = node[2]
+                node[2] = None
+                self.chains[number] = [self.version, account.cents, older]
+
+    # Opens a reader at the latest version and returns that version
+    def open(self):
+        with self.lock:
+            version = self.version
+            self.readers[version] = self.readers.get(version, 0) + 1
+        return version
+
+    # Closes a reader; after the last one only the chains of accounts being changed are kept
+    def close(self, version):
+        with self.lock:
+            if self.readers[version] > 1:
+                self.readers[version] -= 1
+                return
+            del self.readers[version]
+            if not self.readers:
+                self.chains = {number: [0, self.chains[number][1], None] for number in self.pending}
+
+    # Balance in cents of an account as of a reader's version
+    # An account without a chain was not being changed when its balance was read, since
+    # writers add the chain before changing it; that is checked again after reading
+    def read(self, account, version):
+        number = account.account_number
+        while True:
+            node = self.chains.get(number)
+            if node is None:
+                cents = account.cents
+                if number not in self.chains:
+                    return cents
+                continue
+            while node[0] > version:
+                node = node[2]
+            return node[1]
+
+    # Balances in cents of many accounts as of a reader's version, read like read does
+    # A reader holds the chains dictionary in place, so it is looked up once
+    def read_all(self, accounts, version):
+        chains = self.chains
+        for account in accounts:
+            number = account.account_number
+            node = chains.get(number)
+            if node is None:
+                cents = account.cents
+                if number not in chains:
+                    yield cents
+                    continue
+                node = chains[number]
+            while node[0] > version:
+                node = node[2]
+            yield node[1]
+
+
+
+""" The Balance_View class is one reader of a Version_Store
+    Every balance it reads, and every report it runs, is as of the moment it was opened
+    Close it (or use it in a with block) so the versions it holds can be dropped
+"""
+class Balance_View:
+    def __init__(self, service):
+        self.service = service
+        self.versions = service.versions
+        self.version = self.versions.open()
+
+    def balance(self, username):
+        return Money(self.versions.read(self.service.find_user(username).account, self.version))
+
+    # Streams (username, balance) for every user
+    def balances(self):
+        read, version = self.versions.read, self.version
+        for user in self.users():
+            yield user.username, Money(read(user.account, version))
+
+    # Sum of every balance, which transfers between users never change
+    def total_deposits(self):
+        return Money(sum(self.versions.read_all((user.account for user in self.users()), self.version)))
+
+    # Every user; a users dictionary is copied first, since signups may add to it meanwhile
+    def users(self):
+        users = self.service.users
+        return list(users.values()) if isinstance(users, dict) else users.values()
+
+    def close(self):
+        if self.versions is not None:
+            self.versions.close(self.version)
+            self.versions = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+""" The Group_Commit class coalesces journal writes from many operations into one fsync
+    Operations only mark their users dirty and get a ticket back
+    A background thread commits every dirty user once per interval, or sooner
+    when batch_size users are waiting, and callers may wait for their ticket,
+    or await it on an event loop through durable_future
+    A user changed many times between commits is written once, with its latest state
+    Other journal rows (e.g. a shard's transaction records) may be queued with the users,
+    and are written in the same append as the users of their batch
+"""
+class Group_Commit:
+    # Seconds the flusher waits before trying a failed batch again
+    RETRY_DELAY = 0.1
+
+    def __init__(self, service, interval=0.01, batch_size=1000):
+        self.service = service
+        self.interval = interval
+        self.batch_size = batch_size
+
+        # Dirty users by username, other rows queued with them, and the ticket numbers handed out and made durable
+        self.pending = {}
+        self.records = []
+        self.issued = 0
+        self.committed = 0
+        self.condition = threading.Condition()
+        # Set by a waiter so the flusher commits now instead of at the end of the interval
+        self.flush_requested = False
+        # Only one batch is written at a time, so tickets become durable in order
+        self.commit_lock = threading.Lock()
+        # Asyncio futures by the ticket they wait for, resolved on their own loop after each commit
+        self.waiters = []
+        # The last failed commit: the error, the ticket it would have made durable, and how many have failed
+        self.error = None
+        self.failed = 0
+        self.failures = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="capitex-group-commit", daemon=True)
+        self.thread.start()
+
+    # Queues the users, and any other rows, for the next commit and returns the ticket that covers them
+    def mark_dirty(self, users, records=()):
+        with self.condition:
+            for user in users:
+                self.pending[user.username] = user
+            self.records.extend(records)
+            self.issued += 1
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+            return self.issued
+
+    # Blocks until the ticket (by default everything queued so far) is on disk
+    # Raises the error of a commit of the ticket that fails meanwhile; the batch is tried again later
+    def wait(self, ticket=None, timeout=None):
+        with self.condition:
+            if ticket is None:
+                ticket = self.issued
+            if self.committed < ticket:
+                self.flush_requested = True
+                self.condition.notify_all()
+            failures = self.failures
+            done = self.condition.wait_for(lambda: self.committed >= ticket
+                                           or (self.failures > failures and self.failed >= ticket), timeout)
+            if self.committed < ticket and self.failures > failures:
+                raise self.error
+            return done
+
+    # Returns a future of the running event loop that is done once the ticket (by default everything
+    # queued so far) is on disk; unlike wait it does not hurry the flusher, so waiters still share a commit
+    def durable_future(self, ticket=None):
+        future = asyncio.get_running_loop().create_future()
+        with self.condition:
+            if ticket is None:
+                ticket = self.issued
+            if self.committed >= ticket:
+                future.set_result(True)
+            else:
+                self.waiters.append((ticket, future))
+        return future
+
+    # A failed commit has already failed its waiters and put its batch back,
+    # so the flusher keeps running and tries the batch again after RETRY_DELAY
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or self.flush_requested
+                                        or len(self.pending) >= self.batch_size, self.interval)
+                self.flush_requested = False
+                running = self.running
+            try:
+                self.commit()
+            except Exception:
+                if running:
+                    with self.condition:
+                        self.condition.wait_for(lambda: not self.running, self.RETRY_DELAY)
+                    continue
+            if not running:
+                return
+
+    # Writes every pending user to storage in one write, i.e. one journal fsync or one SQLite transaction
+    # Rows are built while the accounts are locked, so a transfer is never half-written
+    # Idempotency keys and ledger records buffered before the users are taken belong to changes
+    # in this batch, so they are written after it and neither is on disk before its change
+    def commit(self):
+        with self.commit_lock:
+            keys = self.service.idempotency.take()
+            ledger = self.service.ledger
+            records = ledger.take() if ledger is not None else None
+            with self.condition:
+                users = list(self.pending.values())
+                extra, self.records = self.records, []
+                self.pending = {}
+                ticket = self.issued
+            # Each part is dropped once it is written, so a failure puts back only what is not on disk
+            try:
+                if users or extra:
+                    with self.service.locks.holding(*(user.account.account_number for user in users)):
+                        rows = [self.service.user_row(user) for user in users]
+                    # The other rows go after the users', which a lazy table matches to their offsets
+                    self.service.write_users(users, rows + extra)
+                    users, extra = [], []
+                if records:
+                    ledger.write(records)
+                    records = []
+                self.service.idempotency.write(keys)
+            except Exception as error:
+                self.put_back(users, extra, records, keys)
+                with self.condition:
+                    self.error = error
+                    self.failed = max(self.failed, ticket)
+                    self.failures += 1
+                    self.condition.notify_all()
+                    done = [future for waited, future in self.waiters if waited <= ticket]
+                    self.waiters = [(waited, future) for waited, future in self.waiters if waited > ticket]
+                self.notify(done, error)
+                raise
+            with self.condition:
+                self.committed = max(self.committed, ticket)
+                self.condition.notify_all()
+                done = [future for waited, future in self.waiters if waited <= self.committed]
+                self.waiters = [(waited, future) for waited, future in self.waiters if waited > self.committed]
+            self.notify(done)
+
+    # Queues the unwritten part of a failed batch again, ahead of anything queued since
+    def put_back(self, users, extra, records, keys):
+        with self.condition:
+            for user in users:
+                self.pending.setdefault(user.username, user)
+            self.records[:0] = extra
+        if records:
+            self.service.ledger.put_back(records)
+        self.service.idempotency.put_back(keys)
+
+    # Resolves the futures on their own loops, or fails them with error
+    def notify(self, futures, error=None):
+        for future in futures:
+            # The loop may already be closed, e.g. when a server stopped before its clients' changes committed
+            try:
+                future.get_loop().call_soon_threadsafe(self.resolve, future, error)
+            except RuntimeError:
+                pass
+
+    # Runs on the future's own loop
+    def resolve(self, future, error=None):
+        if future.done():
+            return
+        if error is None:
+            future.set_result(True)
+        else:
+            future.set_exception(error)
+
+    # Commits whatever is left and stops the background thread
+    # Raises the error of the last commit if it failed, since its batch is then not on disk
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        if self.committed < self.issued and self.error is not None:
+            raise self.error
+
+
+
+""" The CSV_Storage class keeps the users in bank_users.csv plus a Transaction_Journal
+    Changed users are appended to the journal and save folds everything into a new .csv snapshot
+    The users are loaded into a dictionary, an Account_Store (columnar) or a Lazy_User_Table (lazy)
+    Storages share one interface: exists, load, save, write, needs_compaction and close
+"""
+class CSV_Storage:
+    def __init__(self, path="bank_users.csv", journal=None, lazy=False, columnar=False):
+        self.path = path
+        self.journal = journal if journal is not None else Transaction_Journal()
+        self.lazy = lazy
+        self.columnar = columnar
+        self.users = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    # Reads the .csv snapshot and replays the journal on top
+    def load(self):
+        if self.lazy:
+            self.users = Lazy_User_Table(self.path, self.journal)
+            return self.users
+
+        self.users = Account_Store() if self.columnar else {}
+        if self.exists():
+            with open(self.path, mode='r') as user_file:
+                reader = csv.reader(user_file)
+                for row in reader:
+                    # The store copies rows straight into its columns
+                    if self.columnar:
+                        self.users.add(*row)
+                        continue
+                    username, password, account_number, balance = row
+                    account = Bank_Account(account_number, Money.parse(balance, exact=False))
+                    self.users[username] = Account_User(username, password, account)
+        self.journal.replay(self.users)
+        return self.users
+
+    # Writes a full snapshot of the rows and empties the journal
+    # The snapshot is written to a temporary file first, so a lazy table can keep reading the old one
+    # before_replace runs once the new snapshot is on disk, just before it replaces the old one
+    def save(self, rows, before_replace=None):
+        with open(self.path + ".tmp", mode='w', newline='') as user_file:
+            writer = csv.writer(user_file)
+            for row in rows:
+                writer.writerow(row)
+            user_file.flush()
+            os.fsync(user_file.fileno())
+        if before_replace is not None:
+            before_replace()
+        os.replace(self.path + ".tmp", self.path)
+        self.journal.reset()
+        if self.lazy:
+            self.users.reload()
+
+    # Appends the changed users' rows to the journal instead of rewriting the whole .csv file
+    def write(self, users, rows):
+        offsets = self.journal.append(rows)
+        if self.lazy:
+            for user, offset in zip(users, offsets):
+                self.users.journaled(user.username, offset)
+
+    # The journal is folded into a snapshot once it outgrows the user table,
+    # so each operation stays O(1) amortized
+    def needs_compaction(self, users, threshold):
+        return self.journal.records >= max(threshold, len(users))
+
+    def close(self):
+        self.journal.close()
+
+
+
+""" The SQLite_User_Table class stands in for the users dictionary on an SQLite database
+    Lookups by username or account number go through the table's indexes
+    Users are held in a bounded LRU cache, and users still referenced elsewhere
+    are handed out again, so every caller changes the same object
+"""
+class SQLite_User_Table:
+    def __init__(self, storage, capacity=10000):
+        self.storage = storage
+        self.capacity = capacity
+        # Users currently in memory, most recently used last
+        self.cache = OrderedDict()
+        # Users still referenced elsewhere (e.g. current_user) after eviction
+        self.live = weakref.WeakValueDictionary()
+
+    # Builds a user from its row, or returns the one already in memory
+    def materialize(self, username):
+        with self.storage.lock:
+            user = self.cache.get(username)
+            if user is not None:
+                self.cache.move_to_end(username)
+                return user
+            user = self.live.get(username)
+            if user is None:
+                row = self.storage.connection.execute(self.storage.SELECT_USER, (username,)).fetchone()
+                if row is None:
+                    return None
+                user = Account_User(username, row[0], Bank_Account(row[1], Money(row[2])))
+                self.live[username] = user
+            self.cache[username] = user
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+            return user
+
+    # Returns the username that owns an account number, or None
+    def account_owner(self, account_number):
+        with self.storage.lock:
+            row = self.storage.connection.execute(self.storage.SELECT_OWNER, (account_number,)).fetchone()
+        return row[0] if row else None
+
+    def get(self, username, default=None):
+        user = self.materialize(username)
+        return default if user is None else user
+
+    def __getitem__(self, username):
+        user = self.materialize(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+
+    # New users are inserted straight away, so len and lookups by account number see them
+    def __setitem__(self, username, user):
+        with self.storage.lock:
+            self.storage.write([user], [[username, user.password, user.account.account_number, user.account.check_balance()]])
+            self.cache[username] = user
+            self.live[username] = user
+
+    # Adds many users in a single transaction
+    def update(self, users):
+        users = dict(users)
+        with self.storage.lock:
+            self.storage.write(list(users.values()), [[username, user.password, user.account.account_number, user.account.check_balance()]
+                                                      for username, user in users.items()])
+            for username, user in users.items():
+                self.cache[username] = user
+                self.live[username] = user
+
+    def __contains__(self, username):
+        return self.materialize(username) is not None
+
+    def __len__(self):
+        with self.storage.lock:
+            return self.storage.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def __iter__(self):
+        return (row[0] for row in self.rows())
+
+    # Streams every user in insertion order, handing out the in-memory user where there is one
+    def values(self):
+        for username, password, account_number, cents in self.rows():
+            user = self.live.get(username)
+            yield user if user is not None else Account_User(username, password, Bank_Account(account_number, Money(cents)))
+
+    # Pages through the table by rowid, so no cursor stays open between pages
+    def rows(self, page=1000):
+        last = 0
+        while True:
+            with self.storage.lock:
+                rows = self.storage.connection.execute(self.storage.SELECT_PAGE, (last, page)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            last = rows[-1][0]
+
+
+
+""" The SQLite_Storage class keeps the users in an SQLite database in WAL mode
+    The users table is indexed by username (primary key) and account number (unique)
+    Each operation updates only the changed users' rows, so nothing is ever rewritten in full
+    The statements are fixed strings, so sqlite3 prepares each one once and reuses it
+"""
+class SQLite_Storage:
+    CREATE_TABLE = ("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT NOT NULL, "
+                    "account_number TEXT NOT NULL UNIQUE, balance_cents INTEGER NOT NULL)")
+    SELECT_USER = "SELECT password, account_number, balance_cents FROM users WHERE username = ?"
+    SELECT_OWNER = "SELECT username FROM users WHERE account_number = ?"
+    SELECT_PAGE = ("SELECT rowid, username, password, account_number, balance_cents FROM users "
+                   "WHERE rowid > ? ORDER BY rowid LIMIT ?")
+    UPSERT = ("INSERT INTO users (username, password, account_number, balance_cents) VALUES (?, ?, ?, ?) "
+              "ON CONFLICT(username) DO UPDATE SET password = excluded.password, "
+              "account_number = excluded.account_number, balance_cents = excluded.balance_cents")
+
+    def __init__(self, path="bank_users.db", sync=True, capacity=10000):
+        self.path = path
+        self.capacity = capacity
+        # Worker threads and the group commit thread share the connection, so they take turns
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # FULL syncs the WAL on every commit, like the journal's fsync; NORMAL may lose the last commits on power loss
+        self.connection.execute(f"PRAGMA synchronous={'FULL' if sync else 'NORMAL'}")
+        self.connection.execute(self.CREATE_TABLE)
+        self.users = None
+
+    # True once the database holds any user
+    def exists(self):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+
+    # Nothing is read up front; the table looks users up as they are needed
+    def load(self):
+        self.users = SQLite_User_Table(self, self.capacity)
+        return self.users
+
+    # Upserts every row, e.g. when migrating from a .csv file
+    # The rows are collected first, since they may be streamed from this same database
+    # before_replace runs once the rows are written, just before the transaction commits
+    def save(self, rows, before_replace=None):
+        self.write(None, list(rows), before_replace)
+
+    # Updates the changed users' rows in one transaction
+    def write(self, users, rows, before_commit=None):
+        rows = [(username, password, account_number, to_cents(balance))
+                for username, password, account_number, balance in rows]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(self.UPSERT, rows)
+                if before_commit is not None:
+                    before_commit()
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    # SQLite checkpoints its own WAL, so there is never anything to compact
+    def needs_compaction(self, users, threshold):
+        return False
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+
+""" The Snapshot_User_Table class stands in for the users dictionary on a memory-mapped binary snapshot
+    Opening it reads only the header; lookups bisect the sorted hash index in the mapped pages
+    Users are held in a bounded LRU cache, and users still referenced elsewhere are handed out again
+    Users journaled since the snapshot was written are read back from their latest journal row,
+    like the Lazy_User_Table, so only their offsets are kept until the next save
+"""
+class Snapshot_User_Table:
+    def __init__(self, storage, capacity=10000):
+        self.storage = storage
+        self.capacity = capacity
+        # Users currently in memory, most recently used last
+        self.cache = OrderedDict()
+        # Users still referenced elsewhere (e.g. current_user) after eviction
+        self.live = weakref.WeakValueDictionary()
+        # Latest journal row of each user changed since the snapshot
+        self.journal_offsets = {}
+        # Users that are not in the snapshot yet, and their account numbers
+        self.added = set()
+        self.added_accounts = {}
+        # The cache and the mapping are shared, so threads take turns
+        self.lock = threading.RLock()
+
+        self.mapping = None
+        self.views = ()
+        self.strings = 0
+        self.count = 0
+        self.reload()
+
+    # Maps the current snapshot, e.g. after save writes a new one, and replays the journal on top
+    # The old mapping is dropped rather than closed, so a values() still reading it can finish
+    def reload(self):
+        with self.lock:
+            self.unmap()
+            if os.path.exists(self.storage.path):
+                self.open()
+            self.journal_offsets.clear()
+            self.added.clear()
+            self.added_accounts.clear()
+            self.replay_journal()
+
+    # Records where each user's latest journal row is, without building the users
+    def replay_journal(self):
+        journal = self.storage.journal
+        if not os.path.exists(journal.path):
+            return
+        replayed = offset = 0
+        with open(journal.path, mode='rb') as journal_file:
+            for line in journal_file:
+                fields = line.rstrip(b"\r\n").split(b',')
+                # Skips a torn last row from a crash mid-append, and rows that are not users
+                if len(fields) == 4 and fields[0] and line.endswith(b'\n'):
+                    self.journaled_at(fields[0].decode(), fields[2].decode(), offset)
+                    replayed += 1
+                offset += len(line)
+        journal.records = replayed
+
+    # Checks the header and takes views of the index blocks; the records are not read
+    def open(self):
+        path = self.storage.path
+        header, record = self.storage.HEADER, self.storage.RECORD
+        with open(path, mode='rb') as snapshot_file:
+            size = os.fstat(snapshot_file.fileno()).st_size
+            if size < header.size:
+                raise ValueError(f"{path} is not a CapitEx snapshot")
+            self.mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.checksum, count, strings_size = header.unpack_from(self.mapping)
+        if magic != self.storage.MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a CapitEx snapshot")
+        if version != self.storage.VERSION:
+            self.close()
+            raise ValueError(f"{path} is snapshot version {version}, this version reads {self.storage.VERSION}")
+        if size != header.size + count * (record.size + 24) + strings_size:
+            self.close()
+            raise ValueError(f"{path} is truncated")
+
+        view = memoryview(self.mapping)
+        start = header.size + count * record.size
+        self.name_hashes = view[start:start + 8 * count].cast('Q')
+        self.account_hashes = view[start + 8 * count:start + 16 * count].cast('Q')
+        self.name_records = view[start + 16 * count:start + 20 * count].cast('I')
+        self.account_records = view[start + 20 * count:start + 24 * count].cast('I')
+        self.views = (view, self.name_hashes, self.account_hashes, self.name_records, self.account_records)
+        self.strings = start + 24 * count
+        self.count = count
+
+    # Compares the checksum in the header with the body, reading the whole file once
+    def verify(self):
+        with self.lock:
+            if self.mapping is None:
+                return True
+            checksum = 0
+            for start in range(self.storage.HEADER.size, len(self.mapping), 1 << 20):
+                checksum = zlib.crc32(self.views[0][start:start + (1 << 20)], checksum)
+            return checksum == self.checksum
+
+    # Reads the username, password, account number and balance in cents of a record
+    # of the current mapping, or of the given one whose string table starts at strings
+    def row(self, record, mapping=None, strings=None):
+        if mapping is None:
+            mapping, strings = self.mapping, self.strings
+        offset, name_size, password_size, account_size, cents = self.storage.RECORD.unpack_from(
+            mapping, self.storage.HEADER.size + record * self.storage.RECORD.size)
+        start = strings + offset
+        password_start = start + name_size
+        account_start = password_start + password_size
+        return (mapping[start:password_start].decode(), mapping[password_start:account_start].decode(),
+                mapping[account_start:account_start + account_size].decode(), cents)
+
+    # Reads the snapshot records whose hash matches and returns the one holding the value in the column
+    def lookup(self, hashes, records, column, value):
+        if self.count == 0:
+            return None
+        key = username_hash(value.encode())
+        i = bisect_left(hashes, key)
+        while i < self.count and hashes[i] == key:
+            row = self.row(records[i])
+            if row[column] == value:
+                return row
+            i += 1
+        return None
+
+    # Finds a user's record in the snapshot through the username index
+    def base_row(self, username):
+        return self.lookup(self.name_hashes, self.name_records, 0, username)
+
+    # Returns the username that owns an account number, or None
+    def account_owner(self, account_number):
+        with self.lock:
+            username = self.added_accounts.get(account_number)
+            if username is not None:
+                return username
+            row = self.lookup(self.account_hashes, self.account_records, 2, account_number)
+            return row[0] if row else None
+
+    # Builds a user from its snapshot record, or returns the one already in memory
+    def materialize(self, username):
+        with self.lock:
+            user = self.cache.get(username)
+            if user is not None:
+                self.cache.move_to_end(username)
+                return user
+            user = self.live.get(username)
+            if user is None:
+                offset = self.journal_offsets.get(username)
+                if offset is not None:
+                    user = self.journal_user(offset)
+                else:
+                    row = self.base_row(username)
+                    if row is None:
+                        return None
+                    user = Account_User(username, row[1], Bank_Account(row[2], Money(row[3])))
+                self.live[username] = user
+            self.cache[username] = user
+            self.evict()
+            return user
+
+    # Builds a user from its journal row
+    def journal_user(self, offset):
+        with open(self.storage.journal.path, mode='rb') as journal_file:
+            return user_from_row(read_row_at(journal_file, offset))
+
+    # Drops the least recently used users; changed ones are read back from the journal
+    def evict(self):
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    # Notes where the users' rows were written in the journal
+    def journaled(self, users, offsets):
+        with self.lock:
+            for user, offset in zip(users, offsets):
+                self.journaled_at(user.username, user.account.account_number, offset)
+
+    def journaled_at(self, username, account_number, offset):
+        self.track(username, account_number)
+        self.journal_offsets[username] = offset
+
+    # Notes a user that is not in the snapshot, so len and lookups by account number see it
+    def track(self, username, account_number):
+        if username not in self.added and username not in self.journal_offsets and self.base_row(username) is None:
+            self.added.add(username)
+            self.added_accounts[account_number] = username
+
+    def get(self, username, default=None):
+        user = self.materialize(username)
+        return default if user is None else user
+
+    def __getitem__(self, username):
+        user = self.materialize(username)
+        if user is None:
+            raise KeyError(username)
+        return user
+
+    # New users are tracked straight away, so len and lookups by account number see them
+    # before their journal row is written
+    def __setitem__(self, username, user):
+        with self.lock:
+            self.track(username, user.account.account_number)
+            self.cache[username] = user
+            self.live[username] = user
+            self.evict()
+
+    # Adds many users, like dict.update
+    def update(self, users):
+        for username, user in users.items():
+            self[username] = user
+
+    def __contains__(self, username):
+        return self.materialize(username) is not None
+
+    def __len__(self):
+        return self.count + len(self.added)
+
+    def __iter__(self):
+        for user in self.values():
+            yield user.username
+
+    # Streams every user in snapshot order, then users added since the snapshot
+    # Users that are not in memory are built for the caller without entering the cache
+    # The mapping is taken under the lock, so a reload meanwhile cannot pull it away
+    def values(self):
+        with self.lock:
+            mapping, strings, count = self.mapping, self.strings, self.count
+            added = list(self.added)
+        for record in range(count):
+            username, password, account_number, cents = self.row(record, mapping, strings)
+            user = self.current(username)
+            yield user if user is not None else Account_User(username, password, Bank_Account(account_number, Money(cents)))
+        for username in added:
+            user = self.get(username)
+            if user is not None:
+                yield user
+
+    # Returns the in-memory user, or builds a changed one from the journal without caching it
+    # Returns None for a user unchanged since the snapshot
+    def current(self, username):
+        with self.lock:
+            user = self.cache.get(username) or self.live.get(username)
+            if user is None and username in self.journal_offsets:
+                user = self.journal_user(self.journal_offsets[username])
+            return user
+
+    # Releases the views and drops the mapping; it is unmapped once nothing reads it any more
+    def unmap(self):
+        with self.lock:
+            for view in reversed(self.views):
+                view.release()
+            self.views = ()
+            self.mapping = None
+            self.strings = 0
+            self.count = 0
+
+    # Releases the views before unmapping, which mmap requires
+    def close(self):
+        with self.lock:
+            mapping = self.mapping
+            self.unmap()
+            if mapping is not None:
+                mapping.close()
+
+
+
+""" The Snapshot_Storage class keeps the users in a versioned binary snapshot plus a Transaction_Journal
+    The file is a header (magic, version, body checksum, row count, string table size), fixed-width records,
+    the username and account number hash indexes sorted by hash, their record numbers, and the string table
+    A record holds its strings' offset and lengths in the string table and the balance in cents
+    The snapshot is memory-mapped, so startup takes the same time for ten users or ten million
+"""
+class Snapshot_Storage:
+    HEADER = struct.Struct("<8sIIQQ")
+    RECORD = struct.Struct("<QHHHxxq")
+    MAGIC = b"CPXSNAP\x00"
+    VERSION = 1
+
+    def __init__(self, path="bank_users.snap", journal=None, capacity=10000):
+        self.path = path
+        self.journal = journal if journal is not None else Transaction_Journal(path + ".journal")
+        self.capacity = capacity
+        self.users = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    # Maps the snapshot and replays the journal on top; no user is built up front
+    def load(self):
+        if self.users is not None:
+            self.users.close()
+        self.users = Snapshot_User_Table(self, self.capacity)
+        return self.users
+
+    # Writes a full snapshot of the rows and empties the journal
+    # The file is written next to the old one and swapped in, so the table reads the old one until it reloads
+    # before_replace runs once the new file is on disk, just before it replaces the old one
+    def save(self, rows, before_replace=None):
+        records, strings = bytearray(), bytearray()
+        name_hashes, account_hashes = array('Q'), array('Q')
+        for username, password, account_number, balance in rows:
+            name, secret, number = username.encode(), password.encode(), str(account_number).encode()
+            records += self.RECORD.pack(len(strings), len(name), len(secret), len(number), to_cents(balance, exact=False))
+            strings += name + secret + number
+            name_hashes.append(username_hash(name))
+            account_hashes.append(username_hash(number))
+        by_name = array('I', sorted(range(len(name_hashes)), key=name_hashes.__getitem__))
+        by_account = array('I', sorted(range(len(account_hashes)), key=account_hashes.__getitem__))
+        sections = (records, array('Q', map(name_hashes.__getitem__, by_name)),
+                    array('Q', map(account_hashes.__getitem__, by_account)), by_name, by_account, strings)
+        checksum = 0
+        for section in sections:
+            checksum = zlib.crc32(section, checksum)
+
+        with open(self.path + ".tmp", mode='wb') as snapshot_file:
+            snapshot_file.write(self.HEADER.pack(self.MAGIC, self.VERSION, checksum, len(name_hashes), len(strings)))
+            for section in sections:
+                snapshot_file.write(section)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        if before_replace is not None:
+            before_replace()
+        os.replace(self.path + ".tmp", self.path)
+        self.journal.reset()
+        if self.users is not None:
+            self.users.reload()
+
+    # Appends the changed users' rows to the journal, like CSV_Storage
+    def write(self, users, rows):
+        offsets = self.journal.append(rows)
+        self.users.journaled(users, offsets)
+
+    # The journal is folded into a snapshot once it outgrows the user table
+    def needs_compaction(self, users, threshold):
+        return self.journal.records >= max(threshold, len(users))
+
+    def close(self):
+        self.journal.close()
+        if self.users is not None:
+            self.users.close()
+
+
+
+# Checks one byte range of a .csv user file for the Reconciler, in a worker process
+# Returns the range's row count, crc32 and total, with examples of malformed and negative rows,
+# and writes the sorted hashes of its usernames and account numbers to the work folder
+def scan_chunk(path, index, start, end, folder, samples):
+    with open(path, mode='rb') as user_file:
+        user_file.seek(start)
+        data = user_file.read(end - start)
+    names, accounts = array('Q'), array('Q')
+    report = {"index": index, "start": start, "end": end, "rows": 0, "crc32": zlib.crc32(data), "cents": 0,
+              "malformed": 0, "negative": 0, "examples": []}
+    offset = start
+    for line in io.BytesIO(data):
+        row_offset = offset
+        offset += len(line)
+        line = line.rstrip(b"\r\n")
+        if not line:
+            continue
+        report["rows"] += 1
+        try:
+            text = line.decode()
+            # Rows the app writes need no quoting, so the csv module is only used when there are quotes
+            row = next(csv.reader([text])) if '"' in text else text.split(",")
+            reason = check_row(row)
+        except UnicodeDecodeError:
+            reason = "not UTF-8"
+        if reason is not None:
+            report["malformed"] += 1
+        else:
+            cents = parse_cents(row[3], exact=False)
+            report["cents"] += cents
+            names.append(username_hash(row[0].encode()))
+            accounts.append(username_hash(row[2].encode()))
+            if cents < 0:
+                report["negative"] += 1
+                reason = "negative balance"
+        if reason is not None and len(report["examples"]) < samples:
+            report["examples"].append({"offset": row_offset, "reason": reason, "row": line[:200].decode(errors="replace")})
+    for kind, hashes in (("names", names), ("accounts", accounts)):
+        with open(os.path.join(folder, f"{index}.{kind}"), mode='wb') as hash_file:
+            array('Q', sorted(hashes)).tofile(hash_file)
+    return report
+
+
+# Returns why a username, password, account number, balance row is malformed, or None
+def check_row(row):
+    if len(row) != 4:
+        return f"{len(row)} fields instead of 4"
+    username, password, account_number, balance = row
+    if not Bank_Service.USERNAME_PATTERN.fullmatch(username):
+        return "invalid username"
+    if not password:
+        return "empty password"
+    if not (account_number.isascii() and account_number.isdigit()):
+        return "invalid account number"
+    try:
+        parse_cents(balance, exact=False)
+    except ValueError:
+        return "invalid balance"
+    return None
+
+
+# Finds the hashes that occur more than once in [low, high) over every chunk's sorted hash file
+# Each chunk's part of the range is found by bisecting its mapped file, so only the range is read
+# Returns how many rows repeat an earlier one and up to samples of the repeated hashes
+def find_duplicates(folder, chunks, kind, low, high, samples):
+    parts = array('Q')
+    for index in range(chunks):
+        path = os.path.join(folder, f"{index}.{kind}")
+        if os.path.getsize(path) == 0:
+            continue
+        with open(path, mode='rb') as hash_file, mmap.mmap(hash_file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            hashes = memoryview(mapping).cast('Q')
+            parts.extend(hashes[bisect_left(hashes, low):bisect_left(hashes, high)])
+            hashes.release()
+    repeated = 0
+    examples = []
+    previous = None
+    for value in sorted(parts):
+        if value == previous:
+            repeated += 1
+            if len(examples) < samples and (not examples or examples[-1] != value):
+                examples.append(value)
+        previous = value
+    return kind, repeated, examples
+
+
+# Lists the usernames and account numbers in a byte range whose hash is one of the given ones
+def find_rows(path, start, end, names, accounts):
+    with open(path, mode='rb') as user_file:
+        user_file.seek(start)
+        data = user_file.read(end - start)
+    found = []
+    offset = start
+    for line in io.BytesIO(data):
+        row_offset = offset
+        offset += len(line)
+        text = line.rstrip(b"\r\n").decode(errors="replace")
+        row = next(csv.reader([text])) if '"' in text else text.split(",")
+        if check_row(row) is not None:
+            continue
+        if username_hash(row[0].encode()) in names:
+            found.append(("usernames", row[0], row_offset))
+        if username_hash(row[2].encode()) in accounts:
+            found.append(("accounts", row[2], row_offset))
+    return found
+
+
+
+""" The Reconciler class verifies a persisted .csv user file without loading it
+    The file is split into byte ranges at row boundaries and streamed through a process pool
+    Each range reports its rows, crc32, total and bad rows, and spills its hashes to a work folder;
+    duplicates are then found per hash range across every chunk, so memory stays bounded by the chunk size
+    Duplicate examples are confirmed by reading the rows back, so a hash collision is never reported
+"""
+class Reconciler:
+    def __init__(self, path="bank_users.csv", workers=None, chunk_size=64 << 20, samples=20, folder=None):
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.samples = samples
+        self.folder = folder
+
+    # Byte ranges of about chunk_size, each ending after a newline
+    def chunks(self):
+        size = os.path.getsize(self.path)
+        bounds = [0]
+        with open(self.path, mode='rb') as user_file:
+            while bounds[-1] < size:
+                user_file.seek(bounds[-1] + self.chunk_size)
+                user_file.readline()
+                bounds.append(min(user_file.tell(), size))
+        return list(zip(bounds, bounds[1:]))
+
+    # Runs every check and returns the report; ok is True when nothing was found
+    # expected_total is the control total in dollars that every balance should add up to
+    def run(self, expected_total=None):
+        start = time.perf_counter()
+        chunks = self.chunks()
+        with tempfile.TemporaryDirectory(dir=self.folder) as folder, ProcessPoolExecutor(self.workers) as pool:
+            scans = [pool.submit(scan_chunk, self.path, index, low, high, folder, self.samples)
+                     for index, (low, high) in enumerate(chunks)]
+            reports = [scan.result() for scan in scans]
+            rows = sum(report["rows"] for report in reports)
+
+            # About a million hashes per range, so each range sorts in well under a second
+            ranges = max(self.workers, rows >> 20)
+            bounds = [(1 << 64) * i // ranges for i in range(ranges + 1)]
+            searches = [pool.submit(find_duplicates, folder, len(chunks), kind, low, high, self.samples)
+                        for kind in ("names", "accounts") for low, high in zip(bounds, bounds[1:])]
+            duplicates = {"usernames": {"count": 0, "examples": {}}, "accounts": {"count": 0, "examples": {}}}
+            candidates = {"names": set(), "accounts": set()}
+            for search in searches:
+                kind, repeated, examples = search.result()
+                duplicates["usernames" if kind == "names" else "accounts"]["count"] += repeated
+                candidates[kind].update(examples[:self.samples - len(candidates[kind])])
+
+            if candidates["names"] or candidates["accounts"]:
+                found = [pool.submit(find_rows, self.path, low, high, candidates["names"], candidates["accounts"])
+                         for low, high in chunks]
+                offsets = {"usernames": {}, "accounts": {}}
+                for result in found:
+                    for kind, value, offset in result.result():
+                        offsets[kind].setdefault(value, []).append(offset)
+                for kind, values in offsets.items():
+                    duplicates[kind]["examples"] = {value: places for value, places in values.items() if len(places) > 1}
+
+        total = sum(report["cents"] for report in reports)
+        # A file cut off mid-row, e.g. by a crash during a rewrite, does not end with a newline
+        truncated = False
+        if chunks:
+            with open(self.path, mode='rb') as user_file:
+                user_file.seek(-1, os.SEEK_END)
+                truncated = user_file.read(1) != b"\n"
+        seconds = time.perf_counter() - start
+        report = {
+            "path": self.path, "rows": rows, "bytes": chunks[-1][1] if chunks else 0, "truncated": truncated,
+            "malformed": sum(report["malformed"] for report in reports),
+            "negative": sum(report["negative"] for report in reports),
+            "duplicate_usernames": duplicates["usernames"]["count"], "duplicate_accounts": duplicates["accounts"]["count"],
+            "total": Money(total), "expected_total": None if expected_total is None else Money.of(expected_total),
+            "examples": {"rows": [example for report in reports for example in report["examples"]][:self.samples],
+                         "usernames": duplicates["usernames"]["examples"], "accounts": duplicates["accounts"]["examples"]},
+            "chunks": [{key: report[key] for key in ("start", "end", "rows", "crc32", "cents")} for report in reports],
+            "seconds": seconds, "rows_per_second": rows / seconds if seconds else 0,
+        }
+        report["ok"] = not (truncated or report["malformed"] or report["negative"] or report["duplicate_usernames"]
+                            or report["duplicate_accounts"]
+                            or (expected_total is not None and report["total"] != report["expected_total"]))
+        return report
+
+
+
+""" The Metrics class records per-operation counters and latency histograms
+    Histograms are HDR-style: log-linear buckets with 64 steps per power of two,
+    so any latency from 1 ns to about 18 minutes is kept within 1.6%
+    Each thread records into its own shard, so recording takes no lock; snapshots add the shards up
+    Outcomes are ok, rejected (a ValueError, i.e. failed validation) and error (anything else)
+"""
+class Metrics:
+    # record() inlines these numbers
+    SUB_BITS = 7
+    HALF = 64
+    BUCKETS = 64 * 36
+    OUTCOMES = ("ok", "rejected", "error")
+    # Bucket bounds of the Prometheus export, in seconds
+    EXPORT_BOUNDS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4,
+                     1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        # Only taken when a thread records for the first time
+        self.lock = threading.Lock()
+
+    # Returns this thread's op -> (histogram, counts) dictionary
+    # counts holds the calls per outcome, then the total nanoseconds
+    # Plain lists are used because incrementing a list item is cheaper than an array item
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    # Adds one call of op that took ns nanoseconds; outcome indexes OUTCOMES
+    def record(self, op, ns, outcome):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.shard()
+        stats = shard.get(op)
+        if stats is None:
+            stats = shard[op] = ([0] * self.BUCKETS, [0, 0, 0, 0])
+        histogram, counts = stats
+        exponent = ns.bit_length() - 7
+        index = ns if exponent <= 0 else exponent * 64 + (ns >> exponent)
+        histogram[index if index < 2304 else 2303] += 1
+        counts[outcome] += 1
+        counts[3] += ns
+
+    # Lowest latency in nanoseconds that falls in a bucket
+    def bucket_floor(self, index):
+        if index < 2 * self.HALF:
+            return index
+        exponent = index // self.HALF - 1
+        return (index - exponent * self.HALF) << exponent
+
+    # Wraps a function so each call is recorded under op
+    def timed(self, op, function):
+        record = self.record
+        clock = time.perf_counter_ns
+
+        def timed_call(*args, **kwargs):
+            start = clock()
+            try:
+                result = function(*args, **kwargs)
+            except ValueError:
+                record(op, clock() - start, 1)
+                raise
+            except BaseException:
+                record(op, clock() - start, 2)
+                raise
+            record(op, clock() - start, 0)
+            return result
+        return timed_call
+
+    # Adds the shards up into op -> (histogram, counts)
+    def merged(self):
+        with self.lock:
+            shards = list(self.shards)
+        merged = {}
+        for shard in shards:
+            for op, (histogram, counts) in list(shard.items()):
+                if op not in merged:
+                    merged[op] = (list(histogram), list(counts))
+                    continue
+                total, total_counts = merged[op]
+                for i, count in enumerate(histogram):
+                    if count:
+                        total[i] += count
+                for i in range(4):
+                    total_counts[i] += counts[i]
+        return merged
+
+    # Latency in nanoseconds below which the given fraction of calls fall
+    def quantile(self, histogram, calls, fraction):
+        rank = fraction * calls
+        seen = 0
+        for index, count in enumerate(histogram):
+            seen += count
+            if count and seen >= rank:
+                return self.bucket_floor(index + 1)
+        return 0
+
+    # Summary of every operation, ready to be written as JSON
+    def snapshot(self):
+        report = {}
+        for op, (histogram, counts) in sorted(self.merged().items()):
+            calls = counts[0] + counts[1] + counts[2]
+            report[op] = {"calls": calls, "ok": counts[0], "rejected": counts[1], "error": counts[2],
+                          "seconds": counts[3] / 1e9, "mean_us": counts[3] / calls / 1e3}
+            for label, fraction in (("p50_us", 0.5), ("p90_us", 0.9), ("p99_us", 0.99), ("p999_us", 0.999), ("max_us", 1)):
+                report[op][label] = self.quantile(histogram, calls, fraction) / 1e3
+        return report
+
+    # Metrics in the Prometheus text exposition format
+    def prometheus(self):
+        lines = ["# HELP capitex_operations_total Banking operations by outcome",
+                 "# TYPE capitex_operations_total counter"]
+        merged = sorted(self.merged().items())
+        for op, (histogram, counts) in merged:
+            for outcome, name in enumerate(self.OUTCOMES):
+                lines.append(f'capitex_operations_total{{op="{op}",outcome="{name}"}} {counts[outcome]}')
+        lines += ["# HELP capitex_operation_seconds Latency of banking operations",
+                  "# TYPE capitex_operation_seconds histogram"]
+        for op, (histogram, counts) in merged:
+            index = 0
+            seen = 0
+            for bound in self.EXPORT_BOUNDS:
+                while index < self.BUCKETS and self.bucket_floor(index + 1) <= bound * 1e9:
+                    seen += histogram[index]
+                    index += 1
+                lines.append(f'capitex_operation_seconds_bucket{{op="{op}",le="{bound}"}} {seen}')
+            calls = counts[0] + counts[1] + counts[2]
+            lines.append(f'capitex_operation_seconds_bucket{{op="{op}",le="+Inf"}} {calls}')
+            lines.append(f'capitex_operation_seconds_sum{{op="{op}"}} {counts[3] / 1e9}')
+            lines.append(f'capitex_operation_seconds_count{{op="{op}"}} {calls}')
+        return "\n".join(lines) + "\n"
+
+    # Writes a .json snapshot, or a Prometheus text file for any other extension
+    # The file is replaced in one step, so a collector never reads half of it
+    def write(self, path):
+        text = json.dumps(self.snapshot(), indent=2) if path.endswith(".json") else self.prometheus()
+        with open(path + ".tmp", mode='w') as metrics_file:
+            metrics_file.write(text)
+        os.replace(path + ".tmp", path)
+
+
+
+""" The Bank_Service class holds the banking rules without any GUI
+    Signup, login, deposit, withdraw, transfer and balance work on usernames
+    Invalid requests raise ValueError with the message the GUI shows the user
+    Also owns loading, journaling and saving of the users through a storage
+    (CSV_Storage unless another one such as SQLite_Storage is given)
+    Operations are thread-safe: each one holds the locks of the accounts it changes
+"""
+class Bank_Service:
+    # Operations that enable_metrics times, besides the storage's save and write
+    TIMED_OPERATIONS = ("signup", "login", "check_password", "deposit", "withdraw",
+                        "transfer", "transfer_batch", "balance", "save_users", "import_signups",
+                        "statement", "balance_as_of", "close_period")
+
+    # Precompiled signup rules
+    USERNAME_PATTERN = re.compile(r"[a-zA-Z0-9_]{8,12}")
+    PASSWORD_PATTERN = re.compile(r"[a-zA-Z0-9_@$#!%]{8,12}")
+    USERNAME_RULES = "Username must be 8-12 letters and can only include letters, numbers and underscores"
+    PASSWORD_RULES = "Password must be 8-12 characters and can only contain letters, numbers, and @, %, #, $, !"
+
+    def __init__(self, path="bank_users.csv", journal=None, lazy=False, columnar=False, storage=None, ledger=None):
+        self.storage = storage if storage is not None else CSV_Storage(path, journal, lazy, columnar)
+        self.path = self.storage.path
+        self.lazy = lazy
+        self.columnar = columnar
+        # Use a dictionary to store user account information
+        # Lazy mode swaps it for a Lazy_User_Table on very large user files
+        # Columnar mode swaps it for a compact Account_Store
+        # A plain dictionary gets an account number -> username dictionary next to it
+        self.accounts = {}
+        self.users = {}
+        # New account numbers come from a collision-free counter kept next to the user data
+        self.allocator = Account_Number_Allocator(self.path + ".seq")
+
+        # With the .csv storage, balance changes are appended to the journal and folded into
+        # the .csv file once the journal holds at least as many rows as there are users
+        self.journal = getattr(self.storage, "journal", None)
+        self.compact_threshold = 1000
+
+        self.locks = Lock_Table()
+        # Signups are serialized so two threads cannot take the same username
+        self.signup_lock = threading.Lock()
+
+        # Set by enable_group_commit, after which journal writes are batched in the background
+        self.group_commit = None
+
+        # Passwords are stored as salted hashes; recent logins skip the slow hash
+        self.credentials = Credential_Hasher()
+        self.login_cache = Credential_Cache()
+        # Set by load_users while plaintext passwords are hashed in the background
+        self.migration = None
+        self.migrating = False
+
+        # Set by enable_metrics
+        self.metrics = None
+
+        # With a Transaction_Ledger, every balance change is also recorded in the transaction history
+        self.ledger = ledger
+
+        # Set by enable_rate_limits
+        self.limits = None
+
+        # Set by enable_snapshot_reads, after which changes are published to readers as versions
+        self.versions = None
+
+        # Logged-in users by session token; operations take the username a token stands for
+        self.sessions = Session_Table()
+
+        # Outcomes of deposits, withdrawals and transfers sent with an idempotency key
+        self.idempotency = Idempotency_Cache(self.path + ".keys", sync=getattr(self.journal, "sync", True))
+
+
+    # Replacing the users rebuilds the account number index
+    @property
+    def users(self):
+        return self.user_table
+
+    @users.setter
+    def users(self, users):
+        self.user_table = users
+        self.index_accounts()
+
+
+    # Rebuilds the account number -> username dictionary of a plain users dictionary
+    # Account_Store and Lazy_User_Table keep their own account index
+    def index_accounts(self):
+        self.accounts = {}
+        if isinstance(self.user_table, dict):
+            for username, user in self.user_table.items():
+                self.accounts[user.account.account_number] = username
+
+
+    # Returns the username that owns an account number, or None
+    def account_owner(self, account_number):
+        if isinstance(self.users, dict):
+            return self.accounts.get(account_number)
+        return self.users.account_owner(account_number)
+
+
+    # Finds a user by username, or else by account number
+    def find_recipient(self, identifier):
+        user = self.users.get(identifier)
+        if user is None:
+            owner = self.account_owner(identifier)
+            if owner is not None:
+                user = self.users.get(owner)
+        return user
+
+
+    # Function loads the users from storage
+    # Returns False if there was no user data yet
+    def load_users(self):
+        found = self.storage.exists()
+        self.users = self.storage.load()
+        # Plaintext passwords are hashed in the background, so startup does not wait for every slow hash
+        # Tables that read users on demand are not scanned; their users are upgraded when they next log in
+        if isinstance(self.users, (dict, Account_Store)):
+            self.migrating = True
+            self.migration = threading.Thread(target=self.migrate_passwords, name="capitex-password-migration", daemon=True)
+            self.migration.start()
+        return found
+
+
+    # Replaces legacy plaintext passwords with hashes and returns how many were migrated
+    # Hashes are made without locks and journaled a batch at a time; a password changed meanwhile,
+    # e.g. upgraded at login, is left alone
+    # Stopped early by close, the remaining users are migrated on the next start
+    def migrate_passwords(self, batch_size=100):
+        with self.signup_lock:
+            users = [user for user in self.users.values() if not self.credentials.is_hashed(user.password)]
+        migrated = 0
+        for start in range(0, len(users), batch_size):
+            if not self.migrating:
+                break
+            batch = [(user, user.password) for user in users[start:start + batch_size]]
+            hashes = [self.credentials.hash(password) for _, password in batch]
+            changed = []
+            with self.locks.holding(*(user.account.account_number for user, _ in batch)):
+                for (user, password), hashed in zip(batch, hashes):
+                    if user.password == password:
+                        user.password = hashed
+                        changed.append(user)
+                if changed:
+                    self.record_users(*changed)
+            migrated += len(changed)
+            self.compact_if_needed()
+        return migrated
+
+
+    # Blocks until the password migration started by load_users has finished
+    def wait_migrated(self):
+        if self.migration is not None:
+            self.migration.join()
+
+
+    # Builds the .csv row that stores a user
+    def user_row(self, user):
+        return [user.username, user.password, user.account.account_number, user.account.check_balance()]
+
+
+    # Saves a full snapshot of the users, e.g. to a new .csv file
+    # All account locks are held, so no change can slip in between the snapshot and the journal reset
+    # before_replace runs once the new snapshot is on disk, as in the storages' save
+    def save_users(self, before_replace=None):
+        with self.holding_commits(), self.locks.holding_all():
+            self.storage.save((self.user_row(user) for user in self.users.values()), before_replace=before_replace)
+
+
+    # Keeps group commit from writing a batch while a full snapshot is made
+    # Its rows were built earlier, so written after the snapshot they would replace newer balances
+    # Taken before the account locks, in the same order as Group_Commit.commit takes them
+    def holding_commits(self):
+        return nullcontext() if self.group_commit is None else self.group_commit.commit_lock
+
+
+    # Writes the changed users to storage instead of saving everything
+    # Called while the users' account locks are held
+    # With group commit the users are only marked dirty, and the commit ticket is returned
+    def record_users(self, *users):
+        if self.group_commit is not None:
+            return self.group_commit.mark_dirty(users)
+        self.write_users(users)
+
+
+    # Writes the users' rows to storage, building them now unless they are given
+    def write_users(self, users, rows=None):
+        if rows is None:
+            rows = [self.user_row(user) for user in users]
+        self.storage.write(users, rows)
+
+
+    # Switches to group commit: one fsync per interval or batch instead of one per operation
+    def enable_group_commit(self, interval=0.01, batch_size=1000):
+        if self.group_commit is None:
+            self.group_commit = Group_Commit(self, interval, batch_size)
+        return self.group_commit
+
+
+    # Starts recording counters and latencies of every operation and storage write
+    # The methods are wrapped on this instance only, so a service without metrics runs unchanged code
+    def enable_metrics(self, metrics=None):
+        if self.metrics is None:
+            self.metrics = metrics if metrics is not None else Metrics()
+            for op in self.TIMED_OPERATIONS:
+                setattr(self, op, self.metrics.timed(op, getattr(self, op)))
+            for op in ("save", "write"):
+                setattr(self.storage, op, self.metrics.timed(f"storage_{op}", getattr(self.storage, op)))
+        return self.metrics
+
+
+    # Removes the wrappers again; the recorded metrics are kept by the Metrics object
+    def disable_metrics(self):
+        if self.metrics is not None:
+            for op in self.TIMED_OPERATIONS:
+                del self.__dict__[op]
+            for op in ("save", "write"):
+                del self.storage.__dict__[op]
+            self.metrics = None
+
+
+    # Limits each account to rate operations per second (with bursts of up to burst)
+    # and its withdrawals and transfers to daily_limit over any day
+    def enable_rate_limits(self, rate=5, burst=20, daily_limit=10000):
+        if self.limits is None:
+            self.limits = Rate_Limiter(rate, burst, daily_limit)
+        return self.limits
+
+
+    # Keeps versions of the balances, so read_view can give reports a point-in-time view
+    # that writers never wait for; call it before operations start
+    def enable_snapshot_reads(self):
+        if self.versions is None:
+            self.versions = Version_Store()
+        return self.versions
+
+
+    # Wraps a change to the accounts, publishing it as one version once snapshot reads are on
+    # Called while the accounts' locks are held
+    def writing(self, *accounts):
+        return nullcontext() if self.versions is None else self.versions.writing(accounts)
+
+
+    # Opens a Balance_View of every balance as of now
+    def read_view(self):
+        if self.versions is None:
+            raise ValueError("Snapshot reads are not enabled")
+        return Balance_View(self)
+
+
+    # Blocks until every change made so far is on disk
+    # Without group commit each operation is already durable when it returns
+    def wait_durable(self, timeout=None):
+        if self.group_commit is None:
+            return True
+        return self.group_commit.wait(timeout=timeout)
+
+
+    # Commits outstanding changes and closes the storage
+    def close(self):
+        if self.migration is not None:
+            self.migrating = False
+            self.migration.join()
+        if self.group_commit is not None:
+            self.group_commit.close()
+            self.group_commit = None
+        self.storage.close()
+        self.idempotency.close()
+        if self.ledger is not None:
+            self.ledger.close()
+
+
+    # Saves a new snapshot when the storage asks for one
+    # Called after an operation has released its account locks
+    def compact_if_needed(self):
+        if self.storage.needs_compaction(self.users, self.compact_threshold):
+            self.save_users()
+
+
+    # Use regular expression to check if username is valid
+    # The length is checked first, and plain ASCII letters and digits pass without running the pattern
+    # fullmatch also rejects a trailing newline, which re.match with $ let through
+    def validate_username(self, username):
+        return (8 <= len(username) <= 12 and username.isascii()
+                and (username.isalnum() or self.USERNAME_PATTERN.fullmatch(username) is not None))
+
+    # Regex to check if the password is valid (letters, numbers, @, #, $, ! only accepted)
+    def validate_password(self, password):
+        return (8 <= len(password) <= 12 and password.isascii()
+                and (password.isalnum() or self.PASSWORD_PATTERN.fullmatch(password) is not None))
+
+
+    # Creates a new checking account with a balance of 0
+    def signup(self, username, password):
+        if not self.validate_username(username):
+            raise ValueError(self.USERNAME_RULES)
+        if not self.validate_password(password):
+            raise ValueError(self.PASSWORD_RULES)
+
+        # Hashing is slow, so it happens before the signup lock is taken
+        hashed = self.credentials.hash(password)
+        with self.signup_lock:
+            if username in self.users:
+                raise ValueError("Username is already taken. Choose a different username.")
+
+            # Generate a unique account number, skipping any older random one it could meet
+            account_number = self.allocator.allocate()
+            while self.account_owner(account_number) is not None:
+                account_number = self.allocator.allocate()
+            self.users[username] = Account_User(username, hashed, Admin_Bank(account_number))
+            if isinstance(self.users, dict):
+                self.accounts[account_number] = username
+            user = self.users[username]
+            self.record_users(user) # Journals the new user
+        self.compact_if_needed()
+        return user
+
+
+    # Signs up many (username, password) records at once, e.g. from an import file
+    # Records are validated and checked for duplicates against the users and the rest of
+    # the batch in one pass, passwords are hashed on `workers` threads (hashlib releases the GIL),
+    # and every new account is created and persisted as one batch
+    # Each rejected record is written to rejects as a JSON line, if given; returns a report
+    def import_signups(self, records, rejects=None, workers=1):
+        start = time.perf_counter()
+        report = {"rows": 0, "created": 0, "invalid_username": 0, "invalid_password": 0,
+                  "duplicate": 0, "duplicate_in_batch": 0}
+        seen = set()
+        accepted = []
+
+        def reject(row, username, reason, error):
+            report[reason] += 1
+            if rejects is not None:
+                rejects.write(json.dumps({"row": row, "username": username, "error": error}) + "\n")
+
+        for row, (username, password) in enumerate(records, 1):
+            report["rows"] += 1
+            if not self.validate_username(username):
+                reject(row, username, "invalid_username", self.USERNAME_RULES)
+            elif not self.validate_password(password):
+                reject(row, username, "invalid_password", self.PASSWORD_RULES)
+            elif username in seen:
+                reject(row, username, "duplicate_in_batch", "Username appears earlier in this import.")
+            else:
+                seen.add(username)
+                if username in self.users:
+                    reject(row, username, "duplicate", "Username is already taken. Choose a different username.")
+                else:
+                    accepted.append((row, username, password))
+
+        passwords = [password for _, _, password in accepted]
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                hashes = list(pool.map(self.credentials.hash, passwords))
+        else:
+            hashes = list(map(self.credentials.hash, passwords))
+
+        created = {}
+        with self.signup_lock:
+            numbers = iter(self.allocator.allocate_many(len(accepted)))
+            for (row, username, password), hashed in zip(accepted, hashes):
+                # A signup may have taken the name while the passwords were hashed
+                if username in self.users:
+                    reject(row, username, "duplicate", "Username is already taken. Choose a different username.")
+                    continue
+                account_number = next(numbers)
+                while self.account_owner(account_number) is not None:
+                    account_number = self.allocator.allocate()
+                created[username] = Account_User(username, hashed, Admin_Bank(account_number))
+            self.users.update(created)
+            if isinstance(self.users, dict):
+                self.accounts.update((user.account.account_number, username) for username, user in created.items())
+            if created:
+                self.record_users(*created.values())
+        self.compact_if_needed()
+
+        report["created"] = len(created)
+        report["seconds"] = time.perf_counter() - start
+        report["rows_per_second"] = report["rows"] / report["seconds"] if report["seconds"] else 0.0
+        return report
+
+
+    # Returns the user if the username and password match
+    def login(self, username, password):
+        user = self.users.get(username)
+        if user and self.check_password(user, password):
+            return user
+        raise ValueError("Try again. Either your name or password is invalid")
+
+
+    # Verifies a password, through the login cache when the user logged in recently
+    # A password stored as plaintext or with an old cost is rehashed once it is verified
+    def check_password(self, user, password):
+        stored = user.password
+        if self.login_cache.check(user.username, password, stored):
+            return True
+        if not self.credentials.verify(password, stored):
+            return False
+        if self.credentials.needs_upgrade(stored):
+            hashed = self.credentials.hash(password)
+            with self.locks.holding(user.account.account_number):
+                user.password = hashed
+                self.record_users(user)
+            stored = hashed
+        self.login_cache.remember(user.username, password, stored)
+        return True
+
+
+    # Logs a user in and returns a new session token
+    def open_session(self, username, password):
+        return self.sessions.create(self.login(username, password).username)
+
+
+    # Returns the username behind a session token, which also keeps the session alive
+    def session_user(self, token):
+        username = self.sessions.validate(token) if token is not None else None
+        if username is None:
+            raise ValueError("Please log in first")
+        return username
+
+
+    def close_session(self, token):
+        return self.sessions.end(token)
+
+
+    # Looks up the user an operation acts on
+    def find_user(self, username):
+        user = self.users.get(username)
+        if user is None:
+            raise ValueError("Account does not exist.")
+        return user
+
+
+    # Runs an operation once per idempotency key, so a retry gets the first outcome back
+    # Keys belong to a user; with group commit the outcome is written in the same commit as the change
+    # Operations call the class's method, so with metrics enabled a keyed call is only timed once
+    def idempotent(self, key, request, operation):
+        return self.idempotency.run(f"{request[1]}/{key}", request, operation, defer=self.group_commit is not None)
+
+
+    # Deposits between 1 and 3000 and returns the new balance
+    def deposit(self, username, amount, key=None):
+        amount = Money.of(amount)
+        if key is not None:
+            return self.idempotent(key, ("deposit", username, amount.cents), lambda: Bank_Service.deposit(self, username, amount))
+        user = self.find_user(username)
+        if self.limits is not None:
+            self.limits.admit(user.account.account_number)
+        with self.locks.holding(user.account.account_number), self.writing(user.account):
+            if not user.account.deposit(amount):
+                raise ValueError("Deposit amount must be between 1 and 3,000")
+            balance = user.account.check_balance()
+            self.record_users(user)
+            if self.ledger is not None:
+                self.record_ledger([(user.account.account_number, "deposit", amount.cents, balance.cents, "")])
+        self.compact_if_needed()
+        return balance
+
+
+    # Withdraws without overdrawing and returns the new balance
+    def withdraw(self, username, amount, key=None):
+        amount = Money.of(amount)
+        if key is not None:
+            return self.idempotent(key, ("withdraw", username, amount.cents), lambda: Bank_Service.withdraw(self, username, amount))
+        user = self.find_user(username)
+        if self.limits is not None:
+            self.limits.admit(user.account.account_number)
+        with self.locks.holding(user.account.account_number), self.writing(user.account):
+            if self.limits is not None:
+                self.limits.check_daily(user.account.account_number, amount.cents)
+            if not user.account.withdraw(amount):
+                raise ValueError("You have insufficient funds in your account or you entered an invalid amount")
+            if self.limits is not None:
+                self.limits.spend(user.account.account_number, amount.cents)
+            balance = user.account.check_balance()
+            self.record_users(user)
+            if self.ledger is not None:
+                self.record_ledger([(user.account.account_number, "withdraw", -amount.cents, balance.cents, "")])
+        self.compact_if_needed()
+        return balance
+
+
+    # Moves money to another user and returns the sender's new balance
+    # The recipient may be given by username or by account number
+    # The recipient is credited first through the deposit rules, so a rejected
+    # credit never leaves money withdrawn from the sender
+    def transfer(self, username, recipient, amount, key=None):
+        amount = Money.of(amount)
+        if key is not None:
+            return self.idempotent(key, ("transfer", username, recipient, amount.cents),
+                                   lambda: Bank_Service.transfer(self, username, recipient, amount))
+        user = self.find_user(username)
+        if self.limits is not None:
+            self.limits.admit(user.account.account_number)
+        recipient_user = self.find_recipient(recipient)
+        accounts = [user.account]
+        if recipient_user is not None:
+            accounts.append(recipient_user.account)
+
+        with self.locks.holding(*[account.account_number for account in accounts]), self.writing(*accounts):
+            if not user.account.can_transfer(amount):
+                raise ValueError("Transfer amount must be between 1 and your current balance")
+            if recipient_user is None:
+                raise ValueError("Recipient account does not exist.")
+            if self.limits is not None:
+                self.limits.check_daily(user.account.account_number, amount.cents)
+
+            if not recipient_user.account.deposit(amount):
+                raise ValueError("Transfer amount must be between 1 and 3,000")
+            user.account.withdraw(amount)
+            if self.limits is not None:
+                self.limits.spend(user.account.account_number, amount.cents)
+            balance = user.account.check_balance()
+            self.record_users(user, recipient_user)
+            if self.ledger is not None:
+                sender, receiver = user.account, recipient_user.account
+                self.record_ledger([
+                    (sender.account_number, "transfer_out", -amount.cents, balance.cents, receiver.account_number),
+                    (receiver.account_number, "transfer_in", amount.cents, receiver.check_balance().cents, sender.account_number)])
+        self.compact_if_needed()
+        return balance
+
+
+    # Applies many (sender, recipient, amount) transfer legs, e.g. a payroll run, all or nothing
+    # Legs may come from a list or a stream; each one is checked against the transfer rules and
+    # netted per account, so only the net debit of each account has to fit its balance
+    # The net changes are applied in one pass under the locks and journaled once
+    # With rate limits, the batch takes one operation from each net sender, and its net debit
+    # counts against the sender's daily limit
+    # Returns how many legs and accounts the batch touched and the total amount moved
+    def transfer_batch(self, legs):
+        # Identifier -> account number, account number -> user and net change in cents
+        resolved = {}
+        users = {}
+        nets = {}
+        moved = 0
+        count = 0
+        # With a ledger, the legs are kept so each one can be recorded
+        history = [] if self.ledger is not None else None
+        for count, (sender, recipient, amount) in enumerate(legs, 1):
+            try:
+                cents = to_cents(amount)
+                if not 100 <= cents < 300000:
+                    raise ValueError("Transfer amount must be between 1 and 3,000")
+                source = resolved.get(sender)
+                if source is None:
+                    user = self.find_user(sender)
+                    source = resolved[sender] = user.account.account_number
+                    users[source] = user
+                target = resolved.get(recipient)
+                if target is None:
+                    user = self.find_recipient(recipient)
+                    if user is None:
+                        raise ValueError("Recipient account does not exist.")
+                    target = resolved[recipient] = user.account.account_number
+                    users[target] = user
+            except ValueError as e:
+                raise ValueError(f"Leg {count}: {e}") from None
+            nets[source] = nets.get(source, 0) - cents
+            nets[target] = nets.get(target, 0) + cents
+            moved += cents
+            if history is not None:
+                history.append((source, target, cents))
+
+        changed = [number for number, net in nets.items() if net]
+        senders = [number for number in changed if nets[number] < 0]
+        if self.limits is not None:
+            for number in senders:
+                self.limits.admit(number)
+        with self.locks.holding(*changed), self.writing(*[users[number].account for number in changed]):
+            for number in senders:
+                if not users[number].account.can_transfer(Money(-nets[number])):
+                    raise ValueError(f"{users[number].username} has insufficient funds for this batch")
+                if self.limits is not None:
+                    self.limits.check_daily(number, -nets[number])
+            entries = self.batch_entries(history, users) if history else None
+            # Debits go through withdraw; a net credit may add up past the per-deposit
+            # limit, which applies to each leg instead, so it is set directly
+            for number in changed:
+                account = users[number].account
+                if nets[number] < 0:
+                    account.withdraw(Money(-nets[number]))
+                else:
+                    account.balance = Money(account.check_balance().cents + nets[number])
+            if self.limits is not None:
+                for number in senders:
+                    self.limits.spend(number, -nets[number])
+            if changed:
+                self.record_users(*[users[number] for number in changed])
+            if entries:
+                self.record_ledger(entries)
+        self.compact_if_needed()
+        return {"legs": count, "accounts": len(changed), "moved": Money(moved)}
+
+
+    # Builds a ledger entry for each leg of a batch, with running balances from before the batch
+    # Balances in between may dip below zero, since only the net change of each account is checked
+    def batch_entries(self, legs, users):
+        balances = {number: user.account.check_balance().cents for number, user in users.items()}
+        entries = []
+        for source, target, cents in legs:
+            balances[source] -= cents
+            balances[target] += cents
+            entries.append((source, "batch_out", -cents, balances[source], target))
+            entries.append((target, "batch_in", cents, balances[target], source))
+        return entries
+
+
+    # Appends an operation's ledger entries; with group commit they are written with its next batch
+    # Called after record_users under the same locks, so an entry is never on disk before its change
+    def record_ledger(self, entries):
+        self.ledger.append(entries, defer=self.group_commit is not None)
+
+
+    def balance(self, username):
+        return self.find_user(username).account.check_balance()
+
+
+    # Applies an Interest_Schedule's interest, fees and penalties to every account for one period
+    # All balances go through one pass under all the account locks and are saved as one snapshot
+    # (an atomic file replace, or one SQLite transaction); the ledger then gets an entry per charge
+    # Each period can be closed once; closed periods are listed in a .periods file
+    # The check and the marker are made under all the locks, so two closes of one period cannot both run
+    # The marker is written once the new balances are on disk and just before they replace the old ones,
+    # so a re-run after a crash never charges twice (a crash between the two leaves the charges unapplied)
+    def close_period(self, schedule, period):
+        period = str(period)
+        start = time.perf_counter()
+        with self.holding_commits(), self.locks.holding_all():
+            if period in self.closed_periods():
+                raise ValueError(f"Period {period} is already closed")
+            if isinstance(self.users, Account_Store):
+                users = None
+                opening = self.users.balances
+            else:
+                users = list(self.users.values())
+                opening = array('q', [user.account.cents for user in users])
+            closing, interest, fees, penalties = schedule.apply(opening)
+            # The snapshot is written from the closing balances, which replace the opening ones only once
+            # it is saved, so a failed save leaves every balance as it was and the period open
+            self.storage.save(([user.username, user.password, user.account.account_number, Money(cents)]
+                               for user, cents in zip(users if users is not None else self.users.values(), closing)),
+                              before_replace=lambda: self.mark_period_closed(period))
+            with self.writing(*[user.account for user in (users if users is not None else self.users.values())]):
+                if users is None:
+                    self.users.balances = closing
+                else:
+                    for user, cents in zip(users, closing):
+                        user.account.cents = cents
+            if self.ledger is not None:
+                numbers = (user.account.account_number for user in (users if users is not None else self.users.values()))
+                self.record_period(schedule, numbers, opening, closing)
+        return {"period": period, "accounts": len(closing), "interest": Money(interest), "fees": Money(fees),
+                "penalties": Money(penalties), "seconds": time.perf_counter() - start}
+
+
+    def closed_periods(self):
+        if not os.path.exists(self.path + ".periods"):
+            return set()
+        with open(self.path + ".periods", mode='r') as periods_file:
+            return set(periods_file.read().split())
+
+
+    # Adds a period to the .periods file through a temporary file, so the file is replaced in one step
+    def mark_period_closed(self, period):
+        periods = []
+        if os.path.exists(self.path + ".periods"):
+            with open(self.path + ".periods", mode='r') as periods_file:
+                periods = periods_file.read().split()
+        with open(self.path + ".periods.tmp", mode='w') as periods_file:
+            periods_file.write("".join(closed + "\n" for closed in periods + [period]))
+            periods_file.flush()
+            os.fsync(periods_file.fileno())
+        os.replace(self.path + ".periods.tmp", self.path + ".periods")
+
+
+    # Writes a ledger entry for each non-zero interest, fee and penalty, in chunks
+    def record_period(self, schedule, numbers, opening, closing):
+        entries = []
+        for number, cents, balance in zip(numbers, opening, closing):
+            if cents == balance and cents >= schedule.minimum and cents >= schedule.fee_waiver:
+                continue
+            interest, fee, penalty = schedule.charges(cents)
+            balance = cents
+            for kind, amount in (("interest", interest), ("fee", -fee), ("penalty", -penalty)):
+                if amount:
+                    balance += amount
+                    entries.append((number, kind, amount, balance, ""))
+            if len(entries) >= 100000:
+                self.ledger.append(entries)
+                entries = []
+        if entries:
+            self.ledger.append(entries)
+
+
+    # Looks up the ledger, which only services opened with one have
+    def history(self):
+        if self.ledger is None:
+            raise ValueError("Transaction history is not enabled")
+        return self.ledger
+
+
+    # Lists a user's transactions from start up to end (epoch seconds, datetimes or ISO dates)
+    def statement(self, username, start=None, end=None):
+        return self.history().statement(self.find_user(username).account.account_number, start, end)
+
+
+    # Returns a user's balance at a past time
+    # Accounts with no recorded transactions have had their current balance all along
+    def balance_as_of(self, username, when):
+        user = self.find_user(username)
+        balance = self.history().balance_as_of(user.account.account_number, when)
+        return balance if balance is not None else user.account.check_balance()
+
+
+
+""" The Batch_Engine class drives a Bank_Service from a stream of JSON operations
+    Each line is an object such as {"op": "deposit", "username": "lennyzhe", "amount": 200}
+    A transfer_batch line carries its legs, e.g. {"op": "transfer_batch", "legs": [["lennyzhe", "tinotendam", 50]]}
+    Deposits, withdrawals and transfers may carry an idempotency "key", so a retried line is not applied twice
+    Rejected operations are counted, not raised, and a summary report is returned
+    With more than one worker, operations run on a thread pool in chunks
 """
-class Bank_Account:
-    def __init__(self, account_number, balance=0):
-        self.account_number = account_number
-        self.balance = balance
+class Batch_Engine:
+    def __init__(self, service, workers=1, chunk_size=1000):
+        self.service = service
+        self.workers = workers
+        self.chunk_size = chunk_size
 
-    # User can only deposit any amount from 1 to 3000 in one function
-    def deposit(self, amount):
-        if 1 <= amount < 3000:
-            self.balance += amount
-            return True
-        return False
+    # Runs one operation and returns its result
+    def apply(self, operation):
+        op = operation["op"]
+        if op == "signup":
+            return self.service.signup(operation["username"], operation["password"]).account.account_number
+        if op == "login":
+            return self.service.login(operation["username"], operation["password"]).username
+        if op == "deposit":
+            return self.service.deposit(operation["username"], Money.of(operation["amount"]), operation.get("key"))
+        if op == "withdraw":
+            return self.service.withdraw(operation["username"], Money.of(operation["amount"]), operation.get("key"))
+        if op == "transfer":
+            return self.service.transfer(operation["username"], operation["recipient"], Money.of(operation["amount"]),
+                                         operation.get("key"))
+        if op == "balance":
+            return self.service.balance(operation["username"])
+        if op == "transfer_batch":
+            return self.service.transfer_batch(operation["legs"])
+        if op == "statement":
+            return self.service.statement(operation["username"], operation.get("start"), operation.get("end"))
+        if op == "balance_as_of":
+            return self.service.balance_as_of(operation["username"], operation["time"])
+        raise ValueError(f"Unknown operation: {op}")
 
-    # User cannot overdraw from their checking account
-    def withdraw(self, amount):
-        if 0 < amount <= self.balance:
-            self.balance -= amount
+    # Parses and runs one JSON line, returning its op name and outcome
+    def execute(self, line):
+        try:
+            operation = json.loads(line)
+            op = str(operation["op"])
+        except (ValueError, KeyError, TypeError):
+            return "malformed", {"ok": False, "error": "Malformed operation"}
+        try:
+            return op, {"ok": True, "result": self.apply(operation)}
+        except (ValueError, KeyError, TypeError) as e:
+            return op, {"ok": False, "error": str(e)}
+
+    def execute_all(self, lines):
+        return [self.execute(line) for line in lines]
+
+    # Yields (op, outcome) in input order
+    # Workers each take a contiguous slice of a chunk, so operations inside one chunk
+    # may run in any order; only independent operations should share a parallel run
+    def outcomes(self, lines):
+        lines = (line for line in lines if line.strip())
+        if self.workers <= 1:
+            yield from map(self.execute, lines)
+            return
+        with ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                chunk = list(islice(lines, self.chunk_size * self.workers))
+                if not chunk:
+                    return
+                step = -(-len(chunk) // self.workers)
+                for part in pool.map(self.execute_all, [chunk[i:i + step] for i in range(0, len(chunk), step)]):
+                    yield from part
+
+    # Runs every JSON line and reports counts and throughput
+    # Each outcome is written to results as a JSON line, if given
+    def run(self, lines, results=None):
+        by_op = {}
+        start = time.perf_counter()
+        for op, outcome in self.outcomes(lines):
+            counts = by_op.setdefault(op, {"succeeded": 0, "failed": 0})
+            counts["succeeded" if outcome["ok"] else "failed"] += 1
+            if results is not None:
+                # Balances are Money, written out as JSON numbers
+                results.write(json.dumps(outcome, default=float) + "\n")
+
+        seconds = time.perf_counter() - start
+        succeeded = sum(counts["succeeded"] for counts in by_op.values())
+        failed = sum(counts["failed"] for counts in by_op.values())
+        return {
+            "operations": succeeded + failed,
+            "succeeded": succeeded,
+            "failed": failed,
+            "by_op": by_op,
+            "seconds": seconds,
+            "workers": self.workers,
+            "ops_per_second": (succeeded + failed) / seconds if seconds else 0.0,
+        }
+
+
+
+""" The Sharded_Batch_Engine class runs a stream of JSON operations through a Shard_Router
+    Each chunk of lines is sent to the shards in one round, so the shards work on it in parallel
+    As with a parallel Batch_Engine, operations inside one chunk may run in any order
+"""
+class Sharded_Batch_Engine(Batch_Engine):
+    def __init__(self, router, chunk_size=1000):
+        super().__init__(router, 1, chunk_size)
+
+    def outcomes(self, lines):
+        lines = (line for line in lines if line.strip())
+        while True:
+            chunk = list(islice(lines, self.chunk_size))
+            if not chunk:
+                return
+            parsed = []
+            for line in chunk:
+                try:
+                    operation = json.loads(line)
+                    parsed.append((str(operation["op"]), operation))
+                except (ValueError, KeyError, TypeError):
+                    parsed.append(("malformed", None))
+            results = iter(self.service.execute_all([operation for _, operation in parsed if operation is not None]))
+            for op, operation in parsed:
+                yield op, next(results) if operation is not None else {"ok": False, "error": "Malformed operation"}
+
+
+
+# The shard that owns a username
+def username_shard(username, shards):
+    return zlib.crc32(username.encode()) % shards
+
+
+# Process entry point of one shard: answers lists of requests from the router until it sends None
+def run_shard(connection, path, journal, shard, shards, sync):
+    worker = Shard_Worker(path, journal, shard, shards, sync)
+    try:
+        while True:
+            requests = connection.recv()
+            if requests is None:
+                break
+            connection.send(worker.handle(requests))
+    finally:
+        worker.close()
+        connection.close()
+
+
+
+""" The Shard_Worker class owns one shard of the users in its own process, with its own
+    .csv file, journal and account numbers
+    Requests arrive as lists of (op, args); each list is made durable with one group commit
+    before the replies go back
+    Cross-shard transfers use two phases: prepare holds the debit or checks the credit,
+    and commit or abort then applies or drops it
+    Money held by a prepared debit cannot be spent by anything else until it is resolved
+    Every prepare, commit and abort is journaled as a #2pc row in the same append as the balances
+    it changes, and the prepared ones are checkpointed to <path>.2pc when the journal is compacted,
+    so a restarted worker still holds them until the router resolves them
+"""
+class Shard_Worker:
+    RECORD = "#2pc"
+
+    def __init__(self, path, journal, shard=0, shards=1, sync=True):
+        self.path = path
+        self.sync = sync
+        self.service = Bank_Service(path, Transaction_Journal(journal, sync=sync))
+        self.service.allocator = Account_Number_Allocator(path + ".seq", shard=shard, shards=shards)
+        self.service.load_users()
+        # The worker commits and compacts after each request list itself, so a commit never splits
+        # a transfer's records from its balances and a compaction never drops unwritten records
+        self.service.enable_group_commit(interval=None, batch_size=sys.maxsize)
+        self.service.compact_threshold = sys.maxsize
+        self.compact_threshold = 1000
+        # Username -> cents held, and (transaction id, debit or credit) -> (username, cents)
+        # A transfer may prepare both sides on the same shard
+        self.holds = {}
+        self.prepared = {}
+        self.recover()
+
+    # Rebuilds the prepared transactions from the checkpoint and the #2pc rows journaled after it
+    # A torn last row is skipped, like the journal's replay does
+    def recover(self):
+        records = []
+        if os.path.exists(self.path + ".2pc"):
+            with open(self.path + ".2pc", mode='r') as checkpoint_file:
+                records = [[self.RECORD, transaction, side, "prepared", username, cents]
+                           for transaction, side, username, cents in json.load(checkpoint_file)]
+        if os.path.exists(self.service.journal.path):
+            with open(self.service.journal.path, mode='r', newline='', encoding='utf-8') as journal_file:
+                records.extend(row for row in csv.reader(journal_file) if len(row) == 6 and row[0] == self.RECORD)
+        for _, transaction, side, state, username, cents in records:
+            key = (int(transaction), side)
+            if state == "prepared" and key not in self.prepared:
+                self.prepared[key] = (username, int(cents))
+                if side == "debit":
+                    self.holds[username] = self.holds.get(username, 0) + int(cents)
+            elif state != "prepared" and key in self.prepared:
+                username, cents = self.prepared.pop(key)
+                if side == "debit":
+                    self.release(username, cents)
+
+    # Queues a #2pc row for the commit at the end of the request list
+    def record(self, transaction, side, state, username, cents):
+        self.service.group_commit.mark_dirty([], [[self.RECORD, transaction, side, state, username, cents]])
+
+    # Runs every request and returns (True, result) or (False, error message) for each
+    def handle(self, requests):
+        replies = []
+        for op, args in requests:
+            try:
+                replies.append((True, self.apply(op, *args)))
+            except (ValueError, KeyError, TypeError) as e:
+                replies.append((False, str(e)))
+        self.service.group_commit.commit()
+        if self.service.storage.needs_compaction(self.service.users, self.compact_threshold):
+            self.service.save_users(before_replace=self.checkpoint)
+        return replies
+
+    # Writes the prepared transactions next to the new snapshot, since the journal holding their rows is emptied
+    def checkpoint(self):
+        with open(self.path + ".2pc.tmp", mode='w') as checkpoint_file:
+            json.dump([[transaction, side, username, cents]
+                       for (transaction, side), (username, cents) in self.prepared.items()], checkpoint_file)
+            checkpoint_file.flush()
+            if self.sync:
+                os.fsync(checkpoint_file.fileno())
+        os.replace(self.path + ".2pc.tmp", self.path + ".2pc")
+
+    def apply(self, op, *args):
+        service = self.service
+        if op == "signup":
+            return service.signup(*args).account.account_number
+        if op == "login":
+            return service.login(*args).username
+        if op == "deposit":
+            return service.deposit(*args)
+        if op == "withdraw":
+            self.check_available(args[0], args[1], "You have insufficient funds in your account or you entered an invalid amount")
+            return service.withdraw(*args)
+        if op == "transfer":
+            self.check_available(args[0], args[2], "Transfer amount must be between 1 and your current balance")
+            return service.transfer(*args)
+        if op == "balance":
+            return service.balance(*args)
+        if op == "prepare_debit":
+            return self.prepare_debit(*args)
+        if op == "prepare_credit":
+            return self.prepare_credit(*args)
+        if op == "commit":
+            return self.commit(*args)
+        if op == "abort":
+            return self.abort(*args)
+        if op == "in_doubt":
+            return list(self.prepared)
+        raise ValueError(f"Unknown operation: {op}")
+
+    # Refuses to spend money that a prepared transfer is holding
+    def check_available(self, username, amount, error):
+        held = self.holds.get(username)
+        if held and self.service.find_user(username).account.check_balance().cents - held < Money.of(amount).cents:
+            raise ValueError(error)
+
+    # Phase one on the sender's shard: holds the amount, checked against the balance less earlier holds
+    def prepare_debit(self, transaction, username, cents):
+        user = self.service.find_user(username)
+        held = self.holds.get(username, 0)
+        if cents <= 0 or not user.account.can_transfer(Money(cents + held)):
+            raise ValueError("Transfer amount must be between 1 and your current balance")
+        self.holds[username] = held + cents
+        self.prepared[transaction, "debit"] = (username, cents)
+        self.record(transaction, "debit", "prepared", username, cents)
+        return True
+
+    # Phase one on the recipient's shard: the recipient must exist and the amount must pass the deposit rules
+    def prepare_credit(self, transaction, recipient, cents):
+        user = self.service.find_recipient(recipient)
+        if user is None:
+            raise ValueError("Recipient account does not exist.")
+        if not 100 <= cents < 300000:
+            raise ValueError("Transfer amount must be between 1 and 3,000")
+        self.prepared[transaction, "credit"] = (user.username, cents)
+        self.record(transaction, "credit", "prepared", user.username, cents)
+        return True
+
+    # Phase two: applies a prepared debit or credit and returns the new balance
+    # A side that is not prepared was already resolved, e.g. before a restart, and is left alone
+    def commit(self, transaction, side):
+        if (transaction, side) not in self.prepared:
+            return None
+        username, cents = self.prepared.pop((transaction, side))
+        self.record(transaction, side, "committed", username, cents)
+        if side == "credit":
+            return self.service.deposit(username, Money(cents))
+        self.release(username, cents)
+        return self.service.withdraw(username, Money(cents))
+
+    # Phase two of a transfer that did not go through
+    def abort(self, transaction, side):
+        if (transaction, side) not in self.prepared:
             return True
-        return False
+        username, cents = self.prepared.pop((transaction, side))
+        self.record(transaction, side, "aborted", username, cents)
+        if side == "debit":
+            self.release(username, cents)
+        return True
 
-    def check_balance(self):
-        return self.balance
-    
-    # Returns a bool function to determine if user can transfer money 
-    def can_transfer(self, amount):
-        return 0 < amount <= self.balance
+    def release(self, username, cents):
+        held = self.holds.pop(username) - cents
+        if held:
+            self.holds[username] = held
 
+    def close(self):
+        self.service.close()
 
 
-""" The Admin_Bank class inherits username and password from Bank_Account class
-    This class is for setting up and authenticating a checking account
-    Assigns a special account number for the user's checking account
-    Works for signup and regular login by user
-    Initializes bank account balance at 0 for new users
+
+""" The Shard_Router class spreads the users over several processes, so operations use every core
+    Users are assigned to a shard by a hash of their username, and each shard's account numbers
+    are numbers that divide to the shard's index, so either identifier finds the shard
+    Shard i keeps its users in bank_users.shard<i>.csv and bank_users.shard<i>.journal
+    Operations on one shard are sent straight to it; a transfer between shards is prepared on both
+    and then committed on both, or aborted if either side refused it
+    Each round's decisions are logged to bank_users.transfers before any commit is sent, so after a
+    crash the next router commits what was decided and aborts what was only prepared
+    The shards start empty; accounts of an unsharded bank_users.csv are not split into them
 """
-class Admin_Bank(Bank_Account):
-    def __init__(self, account_number, balance=0):
-        super().__init__(account_number, balance)
+class Shard_Router:
+    def __init__(self, path="bank_users.csv", shards=2, sync=True):
+        self.shards = shards
+        root, extension = os.path.splitext(path)
+        self.connections = []
+        self.processes = []
+        for shard in range(shards):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_shard, name=f"capitex-shard-{shard}", daemon=True,
+                                              args=(child, f"{root}.shard{shard}{extension}",
+                                                    f"{root}.shard{shard}.journal", shard, shards, sync))
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        # One round of requests is in flight at a time, and transaction ids are unique per round
+        self.lock = threading.Lock()
+        self.transactions = 0
+        self.sync = sync
+        self.log_path = root + ".transfers"
+        self.recover()
 
+    # Resolves every transfer a shard still holds prepared from before a restart
+    # Decided ones are committed on the side the decision chose; undecided ones are aborted,
+    # which is safe because no commit is sent before its decision is logged
+    def recover(self):
+        decisions = {}
+        if os.path.exists(self.log_path):
+            with open(self.log_path, mode='r') as log_file:
+                for line in log_file:
+                    try:
+                        transaction, commit, chosen = json.loads(line)
+                    except ValueError:
+                        continue
+                    decisions[transaction] = (commit, chosen)
+        with self.lock:
+            doubts = self.exchange({shard: [("in_doubt", ())] for shard in range(self.shards)})
+            batches = {}
+            for shard, [(_, prepared)] in doubts.items():
+                for transaction, side in prepared:
+                    commit, chosen = decisions.get(transaction, (False, None))
+                    decided = commit and (side == "debit" or shard == chosen)
+                    batches.setdefault(shard, []).append(("commit" if decided else "abort", (transaction, side)))
+                    self.transactions = max(self.transactions, transaction)
+            if batches:
+                self.exchange(batches)
+            self.clear_log()
 
+    # Logs whether each transfer of a round commits, and on which shard its credit does
+    def log_decisions(self, decisions):
+        with open(self.log_path, mode='a') as log_file:
+            log_file.write("".join(json.dumps(decision) + "\n" for decision in decisions))
+            log_file.flush()
+            if self.sync:
+                os.fsync(log_file.fileno())
 
-""" The Account_User class manages user credentials
-    i.e username, account and password
+    # Empties the log once every decision in it has been applied by the shards
+    def clear_log(self):
+        if os.path.exists(self.log_path):
+            open(self.log_path, mode='w').close()
+
+    def shard_of(self, username):
+        return username_shard(username, self.shards)
+
+    # The shard that would own an identifier if it is an account number, or None
+    def account_shard(self, identifier):
+        if len(identifier) == 9 and identifier.isdigit() and luhn_digit(identifier[:-1]) == identifier[-1]:
+            return int(identifier[:-1]) % self.shards
+        return None
+
+    # Sends each shard its list of requests, then collects every shard's replies
+    # All requests go out before any reply is read, so the shards work at the same time
+    def exchange(self, batches):
+        for shard, requests in batches.items():
+            self.connections[shard].send(requests)
+        return {shard: self.connections[shard].recv() for shard in batches}
+
+    # Runs one request on one shard and returns its result
+    def call(self, shard, op, *args):
+        with self.lock:
+            ok, result = self.exchange({shard: [(op, args)]})[shard][0]
+        if not ok:
+            raise ValueError(result)
+        return result
+
+    def signup(self, username, password):
+        return self.call(self.shard_of(username), "signup", username, password)
+
+    def login(self, username, password):
+        return self.call(self.shard_of(username), "login", username, password)
+
+    def deposit(self, username, amount):
+        return self.call(self.shard_of(username), "deposit", username, Money.of(amount))
+
+    def withdraw(self, username, amount):
+        return self.call(self.shard_of(username), "withdraw", username, Money.of(amount))
+
+    def balance(self, username):
+        return self.call(self.shard_of(username), "balance", username)
+
+    # Moves money to another user, across shards if needed, and returns the sender's new balance
+    def transfer(self, username, recipient, amount):
+        outcome = self.execute_all([{"op": "transfer", "username": username, "recipient": recipient, "amount": amount}])[0]
+        if not outcome["ok"]:
+            raise ValueError(outcome["error"])
+        return outcome["result"]
+
+    # Runs a list of operations (objects like the Batch_Engine's) and returns their outcomes in order
+    # Single-shard operations and the prepare phase of every cross-shard transfer share the first
+    # round, and the commits and aborts go out in a second round, only if there are transfers
+    def execute_all(self, operations):
+        outcomes = [None] * len(operations)
+        batches = {}
+        # What each request of the first round is for: (position, None) or (transfer, side)
+        purposes = {}
+        transfers = []
+
+        def send(shard, purpose, op, *args):
+            batches.setdefault(shard, []).append((op, args))
+            purposes.setdefault(shard, []).append(purpose)
+
+        with self.lock:
+            for position, operation in enumerate(operations):
+                try:
+                    op = operation["op"]
+                    if op in ("signup", "login"):
+                        send(self.shard_of(operation["username"]), (position, None), op, operation["username"], operation["password"])
+                    elif op in ("deposit", "withdraw"):
+                        send(self.shard_of(operation["username"]), (position, None), op, operation["username"], Money.of(operation["amount"]))
+                    elif op == "balance":
+                        send(self.shard_of(operation["username"]), (position, None), op, operation["username"])
+                    elif op == "transfer":
+                        username, recipient, amount = operation["username"], str(operation["recipient"]), Money.of(operation["amount"])
+                        sender = self.shard_of(username)
+                        # A recipient that looks like an account number may be either, so both shards are asked
+                        targets = [self.shard_of(recipient)]
+                        account = self.account_shard(recipient)
+                        if account is not None and account != targets[0]:
+                            targets.append(account)
+                        if targets == [sender]:
+                            send(sender, (position, None), op, username, recipient, amount)
+                            continue
+                        self.transactions += 1
+                        transfer = {"position": position, "id": self.transactions, "credits": dict.fromkeys(targets)}
+                        transfers.append(transfer)
+                        send(sender, (transfer, "debit"), "prepare_debit", transfer["id"], username, amount.cents)
+                        for target in targets:
+                            send(target, (transfer, target), "prepare_credit", transfer["id"], recipient, amount.cents)
+                    else:
+                        raise ValueError(f"Unknown operation: {op}")
+                except (ValueError, KeyError, TypeError) as e:
+                    outcomes[position] = {"ok": False, "error": str(e)}
+
+            for shard, replies in self.exchange(batches).items():
+                for (ok, result), (purpose, side) in zip(replies, purposes[shard]):
+                    if side is None:
+                        outcomes[purpose] = {"ok": True, "result": result} if ok else {"ok": False, "error": result}
+                    elif side == "debit":
+                        purpose["debit"] = (ok, result, shard)
+                    else:
+                        purpose["credits"][side] = (ok, result)
+
+            if transfers:
+                self.resolve(transfers, outcomes)
+        return outcomes
+
+    # Second round: commits the transfers both sides agreed to and aborts the rest
+    # The username match wins over an account number match, as in Bank_Service.find_recipient
+    # The decisions are logged before they are sent; the shards apply them before replying
+    def resolve(self, transfers, outcomes):
+        batches = {}
+        debits = {}
+        decisions = []
+        for transfer in transfers:
+            debit_ok, debit_result, sender = transfer["debit"]
+            credits = transfer["credits"]
+            chosen = next((shard for shard, (ok, _) in credits.items() if ok), None)
+            if not debit_ok:
+                outcomes[transfer["position"]] = {"ok": False, "error": debit_result}
+            elif chosen is None:
+                outcomes[transfer["position"]] = {"ok": False, "error": next(iter(credits.values()))[1]}
+            commit = debit_ok and chosen is not None
+            decisions.append([transfer["id"], commit, chosen])
+            if debit_ok:
+                batches.setdefault(sender, []).append(("commit" if commit else "abort", (transfer["id"], "debit")))
+                if commit:
+                    debits[transfer["id"]] = (sender, len(batches[sender]) - 1, transfer["position"])
+            for shard, (ok, _) in credits.items():
+                if ok:
+                    batches.setdefault(shard, []).append(("commit" if commit and shard == chosen else "abort", (transfer["id"], "credit")))
+        self.log_decisions(decisions)
+        replies = self.exchange(batches)
+        self.clear_log()
+        # The sender's commit returns its new balance, which is the transfer's result
+        for sender, index, position in debits.values():
+            ok, result = replies[sender][index]
+            outcomes[position] = {"ok": True, "result": result} if ok else {"ok": False, "error": result}
+
+    # Stops every shard after its last changes are on disk
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.send(None)
+            for process in self.processes:
+                process.join()
+            for connection in self.connections:
+                connection.close()
+
+
+
+""" The Bank_Server class serves a Bank_Service to many clients over TCP with asyncio
+    Each request and response is one JSON line, e.g. {"id": 1, "op": "deposit", "token": "...", "amount": 200}
+    Login returns a session token that later requests carry instead of a current_user;
+    sessions live in the service's Session_Table and expire when left idle
+    Deposits, withdrawals and transfers may carry an idempotency "key" that makes retries safe
+    Clients may pipeline requests; responses come back in the same order
+    Changes are persisted through the service's group commit, flushed every flush_interval;
+    a signup, deposit, withdrawal or transfer is only answered once its change is on disk
+    Signup and login hash passwords on a pool of credential_workers threads, so the event loop keeps serving
+    A metrics request returns the service's metrics snapshot, if metrics are enabled
+    A limits request returns what the rate limits still allow the session's account
 """
-class Account_User:
-    def __init__(self, username, password, account):
-        self.username = username
-        self.password = password
-        self.account = account
+class Bank_Server:
+    # Operations that hash a password and so run off the event loop
+    CREDENTIAL_OPERATIONS = ("signup", "login")
+    # Operations whose response waits until their change is durable
+    DURABLE_OPERATIONS = ("signup", "deposit", "withdraw", "transfer")
+
+    def __init__(self, service, flush_interval=0.01, credential_workers=4):
+        self.service = service
+        self.service.enable_group_commit(interval=flush_interval)
+        self.server = None
+        self.credential_pool = ThreadPoolExecutor(credential_workers, thread_name_prefix="capitex-credentials")
+        # The reader of every open connection by the task handling it
+        self.connections = {}
+
+    async def start(self, host="127.0.0.1", port=8642):
+        self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server
+
+    # Stops accepting clients and makes every change durable
+    # Open connections end after the requests already read, which are still answered once durable
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for reader in self.connections.values():
+            reader.feed_eof()
+        while self.connections:
+            handlers = list(self.connections)
+            await asyncio.get_running_loop().run_in_executor(None, self.service.group_commit.wait)
+            await asyncio.wait(handlers, timeout=self.service.group_commit.interval)
+        self.credential_pool.shutdown()
+        self.service.group_commit.commit()
+
+    # Runs every request line of one connection in order
+    # The responses are queued for send_responses, so a request does not wait for the commit of the one before it
+    async def handle_client(self, reader, writer):
+        responses = asyncio.Queue()
+        sender = asyncio.create_task(self.send_responses(responses, writer))
+        self.connections[asyncio.current_task()] = reader
+        try:
+            while not sender.done():
+                line = await reader.readline()
+                if not line:
+                    break
+                responses.put_nowait(await self.handle_request(line))
+            responses.put_nowait((None, None))
+            await sender
+        except ConnectionError:
+            pass
+        finally:
+            del self.connections[asyncio.current_task()]
+            sender.cancel()
+            writer.close()
+
+    # Writes the responses of one connection in order, each once its change is durable
+    # Responses are only drained once the write buffer fills up, so pipelined requests batch their writes
+    async def send_responses(self, responses, writer):
+        try:
+            while True:
+                response, durable = await responses.get()
+                if response is None:
+                    break
+                if durable is not None:
+                    # The change is applied but not on disk; it is written again with the next batch
+                    try:
+                        await durable
+                    except Exception as e:
+                        response = {"id": response.get("id"), "ok": False, "error": f"The change could not be saved yet: {e}"}
+                # Balances are Money, written out as JSON numbers
+                writer.write((json.dumps(response, default=float) + "\n").encode())
+                if writer.transport.get_write_buffer_size() > 65536:
+                    await writer.drain()
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    # Turns one request line into a response object, and the future of its change becoming durable
+    # The future is None when there is nothing to wait for
+    async def handle_request(self, line):
+        try:
+            request = json.loads(line)
+            op = request["op"]
+        except (ValueError, KeyError, TypeError):
+            return {"ok": False, "error": "Malformed request"}, None
+        response = {"id": request.get("id")}
+        try:
+            if op in self.CREDENTIAL_OPERATIONS:
+                response["result"] = await asyncio.get_running_loop().run_in_executor(
+                    self.credential_pool, self.dispatch, op, request)
+            else:
+                response["result"] = self.dispatch(op, request)
+            response["ok"] = True
+        except (ValueError, KeyError, TypeError) as e:
+            response["ok"] = False
+            response["error"] = str(e)
+            return response, None
+        if op in self.DURABLE_OPERATIONS:
+            return response, self.service.group_commit.durable_future()
+        return response, None
+
+    # Looks up the user behind a session token
+    def session_user(self, request):
+        return self.service.session_user(request.get("token"))
+
+    def dispatch(self, op, request):
+        if op == "signup":
+            return self.service.signup(request["username"], request["password"]).account.account_number
+        if op == "login":
+            return self.service.open_session(request["username"], request["password"])
+        if op == "logout":
+            if not self.service.close_session(request.get("token")):
+                raise ValueError("Please log in first")
+            return True
+        if op == "deposit":
+            return self.service.deposit(self.session_user(request), Money.of(request["amount"]), request.get("key"))
+        if op == "withdraw":
+            return self.service.withdraw(self.session_user(request), Money.of(request["amount"]), request.get("key"))
+        if op == "transfer":
+            return self.service.transfer(self.session_user(request), request["recipient"], Money.of(request["amount"]),
+                                         request.get("key"))
+        if op in ("check_balance", "balance"):
+            return self.service.balance(self.session_user(request))
+        if op == "statement":
+            return self.service.statement(self.session_user(request), request.get("start"), request.get("end"))
+        if op == "balance_as_of":
+            return self.service.balance_as_of(self.session_user(request), request["time"])
+        if op == "limits":
+            if self.service.limits is None:
+                raise ValueError("Rate limits are not enabled")
+            return self.service.limits.status(self.service.find_user(self.session_user(request)).account.account_number)
+        if op == "metrics":
+            if self.service.metrics is None:
+                raise ValueError("Metrics are not enabled")
+            return self.service.metrics.snapshot()
+        raise ValueError(f"Unknown operation: {op}")
 
 
 
 """ The CapitEx_App class defines the banking application with a GUI
     Contains user authentication measures to protect user accounts
+    The banking rules and persistence are delegated to a Bank_Service
+    Pages are frames built once and swapped on navigation; users load on a background thread
 """
 class CapitEx_App:
-    def __init__(self, root):
+    def __init__(self, root, lazy=False, columnar=False):
         self.root = root
         self.root.title("CapitEx Banking Application")
         self.root.geometry("500x550")
 
+        self.service = Bank_Service(lazy=lazy, columnar=columnar)
+        # The window's session; every operation passes it to the service instead of a current_user
+        self.token = None
+
+        # Each page is a frame built on its first visit and kept, so navigating only swaps frames
+        self.pages = {}
+        self.page = None
+        self.clear_windows()
+
         # Loads the main screen for the app
         self.login_page()
 
-        # Use a dictionary to store user account information
-        self.users = {}
-        self.current_user = None
-
-        # Loads the users from the .csv file
+        # Loads the users from the .csv file in the background, so the window shows at once
         self.load_users()
 
         self.root.protocol("WM_DELETE_WINDOW", self.quit_program)
 
 
+    # The users live in the service, so the GUI and headless callers share one table
+    # Both wait for the background load, so nothing reads or replaces a half-loaded table
+    @property
+    def users(self):
+        self.finish_loading()
+        return self.service.users
+
+    @users.setter
+    def users(self, users):
+        self.finish_loading()
+        self.service.users = users
+
+
+    # The user the window's session belongs to, or None once logged out or expired
+    # Setting it starts a session for that user, ending the window's previous one
+    @property
+    def current_user(self):
+        username = self.service.sessions.validate(self.token) if self.token is not None else None
+        return None if username is None else self.users.get(username)
+
+    @current_user.setter
+    def current_user(self, user):
+        if self.token is not None:
+            self.service.close_session(self.token)
+        self.token = None if user is None else self.service.sessions.create(user.username)
+
+
     # Handles the closing of a window
     def quit_program(self):
         if msg.askyesno("Quit", "Do you want to exit the program?"):
             self.root.destroy()
 
 
-    # Function loads the users from .csv file
-    # Raises an error if the user data file does not exist
+    # Starts loading the users from the .csv file on a background thread
+    # The login page shows a loading message and its buttons wait until the users are in
     def load_users(self):
-        if os.path.exists("bank_users.csv"):
-            with open("bank_users.csv", mode='r') as user_file:
-                reader = csv.reader(user_file)
-                for row in reader:
-                    username, password, account_number, balance = row
-                    account = Bank_Account(account_number, float(balance))
-                    # Re-encode the password for security purposes
-                    self.users[username] = Account_User(username, password, account)
+        self.load_result = None
+        self.load_started = time.perf_counter()
+        self.loader = threading.Thread(target=self.read_users, name="capitex-load-users", daemon=True)
+        self.status_label.config(text="Loading accounts...")
+        self.login_button.config(state="disabled")
+        self.signup_button.config(state="disabled")
+        self.loader.start()
+        self.root.after(50, self.poll_loading)
+
+
+    # Runs on the loader thread, so it must not touch any widget
+    def read_users(self):
+        try:
+            self.load_result = self.service.load_users()
+        except Exception as e:
+            self.load_result = e
+
+
+    # Checks back on the loader from the Tk event loop until it is done
+    def poll_loading(self):
+        if self.loader is not None and self.loader.is_alive():
+            self.root.after(50, self.poll_loading)
         else:
+            self.finish_loading()
+
+
+    # Waits for the loader, if it is still running, and then enables the login page
+    # Raises an error if the user data file does not exist
+    def finish_loading(self):
+        if self.loader is None:
+            return
+        self.loader.join()
+        self.loader = None
+        self.load_seconds = time.perf_counter() - self.load_started
+        self.status_label.config(text="")
+        self.login_button.config(state="normal")
+        self.signup_button.config(state="normal")
+        if isinstance(self.load_result, Exception):
+            msg.showerror("Error", f"The user data could not be loaded: {self.load_result}")
+        elif not self.load_result:
             msg.showerror("Error", "The user data file does not exist. Maybe make a new .csv file")
 
 
-    # Saves new users to the .csv file with user information
+    # Saves a full snapshot of the users to the .csv file
     def save_users(self):
-        with open("bank_users.csv", mode='w', newline='') as user_file:
-            writer = csv.writer(user_file)
-            for user in self.users.values():
-                # Converts the hashed password to string before saving
-                writer.writerow([user.username, user.password, user.account.account_number, user.account.check_balance()])
+        self.service.save_users()
 
-    # Clears the window
+    # Clears the window, along with the cached pages
     def clear_windows(self):
         for widget in self.root.winfo_children():
             widget.destroy()
+        self.pages = {}
+        self.page = None
+
+
+    # Shows a page, building its frame on the first visit
+    # The page shown before is taken off the grid but kept for next time
+    def show_page(self, name, build):
+        page = self.pages.get(name)
+        if page is None:
+            page = self.pages[name] = Frame(self.root)
+            build(page)
+        if self.page is not None and self.page is not page:
+            self.page.grid_remove()
+        page.grid(row=0, column=0, sticky="nsew")
+        page.tkraise()
+        self.page = page
+
 
     # Displays the login page
+    # A page that is shown again starts empty, as it did when it was rebuilt on every visit
     def login_page(self):
-        # Clears the windows
-        self.clear_windows()
+        self.show_page("login", self.build_login_page)
+        self.username_input.delete(0, END)
+        self.password_input.delete(0, END)
+        self.root.update_idletasks()
+
 
-        Label(self.root, text="Account Login").grid(row=0, column=0, columnspan=2, padx=20, pady=20)
+    def build_login_page(self, page):
+        Label(page, text="Account Login").grid(row=0, column=0, columnspan=2, padx=20, pady=20)
 
         # Label and input for username
-        Label(self.root, text="Username:").grid(row=1, column=0, padx=10, pady=10)
-        self.username_input = Entry(self.root)
+        Label(page, text="Username:").grid(row=1, column=0, padx=10, pady=10)
+        self.username_input = Entry(page)
         self.username_input.grid(row=1, column=1, padx=10, pady=10)
 
         # Label and input for password
-        Label(self.root, text="Password:").grid(row=2, column=0, padx=10, pady=10)
-        self.password_input = Entry(self.root, show="*")
+        Label(page, text="Password:").grid(row=2, column=0, padx=10, pady=10)
+        self.password_input = Entry(page, show="*")
         self.password_input.grid(row=2, column=1, padx=10, pady=10)
 
         # Authenticates the user's login input
-        Button(self.root, text="Login", command=self.authenticate_login).grid(row=3, columnspan=2, padx=20, pady=20)
+        self.login_button = Button(page, text="Login", command=self.authenticate_login)
+        self.login_button.grid(row=3, columnspan=2, padx=20, pady=20)
 
         # Directs user to the sign up page
-        Button(self.root, text="Don't have an account? Sign up", command=self.signup_page).grid(row=4, columnspan=2, padx=20, pady=20)
+        self.signup_button = Button(page, text="Don't have an account? Sign up", command=self.signup_page)
+        self.signup_button.grid(row=4, columnspan=2, padx=20, pady=20)
 
-        self.root.update_idletasks()
+        # Shows that the users are still loading
+        self.status_label = Label(page, text="")
+        self.status_label.grid(row=5, columnspan=2, padx=20, pady=10)
 
 
     # Displays the signup page
     def signup_page(self):
-        # Clears current screen for signup page to open
-        self.clear_windows()
+        self.show_page("signup", self.build_signup_page)
+        self.signup_username.delete(0, END)
+        self.signup_password.delete(0, END)
 
-        Label(self.root, text="Set up a new checking account").grid(row=0, column=0, columnspan=2, padx=20, pady=20)
+
+    def build_signup_page(self, page):
+        Label(page, text="Set up a new checking account").grid(row=0, column=0, columnspan=2, padx=20, pady=20)
 
         # Input username
-        Label(self.root, text="Choose your username:").grid(row=1, column=0, padx=10, pady=10)
-        self.signup_username = Entry(self.root)
+        Label(page, text="Choose your username:").grid(row=1, column=0, padx=10, pady=10)
+        self.signup_username = Entry(page)
         self.signup_username.grid(row=1, column=1, padx=10, pady=10)
 
         # Input password
-        Label(self.root, text="Create a password:").grid(row=2, column=0, padx=10, pady=10)
-        self.signup_password = Entry(self.root, show="*")
+        Label(page, text="Create a password:").grid(row=2, column=0, padx=10, pady=10)
+        self.signup_password = Entry(page, show="*")
         self.signup_password.grid(row=2, column=1, padx=10, pady=10)
 
         # Sign up button
-        Button(self.root, text="Sign up", command=self.authenticate_signup).grid(row=3, columnspan=2, padx=20, pady=20)
+        Button(page, text="Sign up", command=self.authenticate_signup).grid(row=3, columnspan=2, padx=20, pady=20)
 
         # Directs user to login page
-        Button(self.root, text="Already have an account? Log in", command=self.login_page).grid(row=4, columnspan=2, padx=20, pady=20)
+        Button(page, text="Already have an account? Log in", command=self.login_page).grid(row=4, columnspan=2, padx=20, pady=20)
 
     # Use regular expression to check if username is valid
     def validate_username(self, username):
-        return bool(re.match(r"^[a-zA-Z0-9_]{8,12}$", username))
+        return self.service.validate_username(username)
 
     # Regex to check if the password is valid (letters, numbers, @, #, $, ! only accepted)
     def validate_password(self, password):
-        return bool(re.match(r"^[a-zA-Z0-9_@$#!%]{8,12}$", password))
+        return self.service.validate_password(password)
         
     # Validates the creation of a new checking account    
+    # Directs the user back to the login page
     def authenticate_signup(self):
+        self.finish_loading()
         username = self.signup_username.get()
         password = self.signup_password.get()
-        
-        # Validates username
-        if not self.validate_username(username):
-            msg.showerror("Error", "Username must be 8-12 letters and can only include letters, numbers and underscores")
-            return
-        
-        # Vaidates password
-        if not self.validate_password(password):
-            msg.showerror("Error", "Password must be 8-12 characters and can only contain letters, numbers, and @, %, #, $, !")
-            return
 
-        if username in self.users:
-            msg.showerror("Error", "Username is already taken. Choose a different username.")
-        elif not username or not password:
-            msg.showerror("Error", "The username and/or password field(s) are empty")
-        else:
-            # Generate an account with a random 8-number ID (account number)
-            # Directs the user back to the login page
-            account_number = str(randint(10000000, 999999999))
-            new_account = Admin_Bank(account_number)
-            self.users[username] = Account_User(username, password, new_account)
-            msg.showinfo("Success", f"Welcome to CapitEx, {username}. You can login.")
-            self.save_users() # Saves the new user to the .csv file
-            self.login_page()
+        try:
+            self.service.signup(username, password)
+        except ValueError as e:
+            msg.showerror("Error", str(e))
+            return
+        msg.showinfo("Success", f"Welcome to CapitEx, {username}. You can login.")
+        self.login_page()
 
 
     def authenticate_login(self):
+        self.finish_loading()
         username = self.username_input.get()
         password = self.password_input.get()
 
-        user = self.users.get(username)
-
-        if user and user.password == password:
-            self.current_user = user
-            msg.showinfo("Success", "Login successful!")
-            self.home_page()
-        else:
-            msg.showerror("Error", "Try again. Either your name or password is invalid")
+        try:
+            token = self.service.open_session(username, password)
+        except ValueError as e:
+            msg.showerror("Error", str(e))
+            return
+        if self.token is not None:
+            self.service.close_session(self.token)
+        self.token = token
+        msg.showinfo("Success", "Login successful!")
+        self.home_page()
 
 
     def home_page(self):
-        # Clears current screen for home page to open
-        self.clear_windows()
+        self.show_page("home", self.build_home_page)
+        self.welcome_label.config(text=f"Welcome to CapitEx, {self.service.session_user(self.token)}")
+        for entry in (self.deposit_log, self.withdraw_log, self.transfer_amount_log, self.transfer_recipient_log):
+            entry.delete(0, END)
+
 
-        Label(self.root, text=f"Welcome to CapitEx, {self.current_user.username}").grid(row=0, column=0, columnspan=2, padx=20, pady=20)
+    def build_home_page(self, page):
+        self.welcome_label = Label(page, text="")
+        self.welcome_label.grid(row=0, column=0, columnspan=2, padx=20, pady=20)
 
         # Initializes the "Deposit Amount" button and entry for input
-        Label(self.root, text="Deposit Amount:").grid(row=1, column=0, padx=10, pady=10)
-        self.deposit_log = Entry(self.root)
+        Label(page, text="Deposit Amount:").grid(row=1, column=0, padx=10, pady=10)
+        self.deposit_log = Entry(page)
         self.deposit_log.grid(row=1, column=1, padx=10, pady=10)
 
-        Button(self.root, text="Deposit", command=self.deposit_money).grid(row=2, columnspan=2, padx=20, pady=20)
+        Button(page, text="Deposit", command=self.deposit_money).grid(row=2, columnspan=2, padx=20, pady=20)
 
         # Initializes the "Withdraw Amount" button and entry for input
-        Label(self.root, text="Withdraw Amount:").grid(row=3, column=0, padx=10, pady=10)
-        self.withdraw_log = Entry(self.root)
+        Label(page, text="Withdraw Amount:").grid(row=3, column=0, padx=10, pady=10)
+        self.withdraw_log = Entry(page)
         self.withdraw_log.grid(row=3, column=1, padx=10, pady=10)
 
-        Button(self.root, text="Withdraw Money", command=self.withdraw_money).grid(row=4, columnspan=2, padx=20, pady=20)
+        Button(page, text="Withdraw Money", command=self.withdraw_money).grid(row=4, columnspan=2, padx=20, pady=20)
 
         # Initializes the "Transfer Amount" button and entry for amount and recipient
-        Label(self.root, text="Transfer Amount:").grid(row=5, column=0, padx=10, pady=10)
-        self.transfer_amount_log = Entry(self.root)
+        Label(page, text="Transfer Amount:").grid(row=5, column=0, padx=10, pady=10)
+        self.transfer_amount_log = Entry(page)
         self.transfer_amount_log.grid(row=5, column=1, padx=10, pady=10)
 
-        Label(self.root, text="Recipient Account:").grid(row=6, column=0, padx=10, pady=10)
-        self.transfer_recipient_log = Entry(self.root)
+        Label(page, text="Recipient Account:").grid(row=6, column=0, padx=10, pady=10)
+        self.transfer_recipient_log = Entry(page)
         self.transfer_recipient_log.grid(row=6, column=1, padx=10, pady=10)
 
-        Button(self.root, text="Transfer Money", command=self.transfer_money).grid(row=7, columnspan=2, padx=20, pady=20)
+        Button(page, text="Transfer Money", command=self.transfer_money).grid(row=7, columnspan=2, padx=20, pady=20)
 
         # Initializes the "Check Balance" button
-        Button(self.root, text="Check Balance", command=self.check_balance).grid(row=8, column=0, columnspan=2, padx=20, pady=20)
+        Button(page, text="Check Balance", command=self.check_balance).grid(row=8, column=0, columnspan=2, padx=20, pady=20)
 
         # Initialize the "Log Out" button
-        Button(self.root, text="Log Out", command=self.logout).grid(row=8, column=2, columnspan=2, padx=20, pady=20)
+        Button(page, text="Log Out", command=self.logout).grid(row=8, column=2, columnspan=2, padx=20, pady=20)
 
 
     # Checks if the deposit money is between 1 and 3000
     # Clears the entry box and prompts the user again, if otherwise
     def deposit_money_logic(self, amount):
-        if self.current_user is None:
+        if self.token is None:
             raise ValueError("You must be logged in to access account")
 
-        if self.current_user.account.deposit(amount):
-            self.save_users()
-            return self.current_user.account.check_balance()
-        else:
-            raise ValueError("Deposit amount must be between 1 and 3,000")
+        return self.service.deposit(self.service.session_user(self.token), amount)
         
 
     # Deposits money into the bank
     def deposit_money(self):
         try:
-            amount = float(self.deposit_log.get())
+            amount = Money.parse(self.deposit_log.get())
             new_balance = self.deposit_money_logic(amount)
             msg.showinfo("Success", f"Deposited ${amount:.2f}. New balance is ${new_balance:.2f}")
             self.deposit_log.delete(0, END) 
@@ -285,86 +4584,398 @@ class CapitEx_App:
     # Should not overdraw from the bank account
     # Clears the entry box for withdrawl if input is valid
     def withdraw_money(self):
-        if self.current_user is None:
+        if self.token is None:
             msg.showerror("Error", "Please log in first")
             return
 
 
         # Validates the withdrawal amount
         try:
-            amount = float(self.withdraw_log.get())
-            if self.current_user.account.withdraw(amount):
-                msg.showinfo("Success", f"Withdrew ${amount:.2f}. New balance is ${self.current_user.account.check_balance():.2f}")
-                self.save_users()
-            else:
-                msg.showerror("Error", "You have insufficient funds in your account or you entered an invalid amount")
-            self.withdraw_log.delete(0, END)
+            amount = Money.parse(self.withdraw_log.get())
         except ValueError:
             msg.showerror("Error", "Please enter a valid amount for withdrawal")
             self.withdraw_log.delete(0, END)
+            return
+
+        try:
+            new_balance = self.service.withdraw(self.service.session_user(self.token), amount)
+            msg.showinfo("Success", f"Withdrew ${amount:.2f}. New balance is ${new_balance:.2f}")
+        except ValueError as e:
+            msg.showerror("Error", str(e))
+        self.withdraw_log.delete(0, END)
 
 
     # Transfers money to a valid recipient account
     # Clears the entry boxes if there is invalid input
     def transfer_money(self):
-        if self.current_user is None:
+        if self.token is None:
             msg.showerror("Error", "Please log in first")
             return
 
 
         # Validates the transfer amount
         try:
-            amount = float(self.transfer_amount_log.get())
+            amount = Money.parse(self.transfer_amount_log.get())
             recipient_username = self.transfer_recipient_log.get()
-
-            if not self.current_user.account.can_transfer(amount):
-                msg.showerror("Error", "Transfer amount must be between 1 and your current balance")
-                self.transfer_amount_log.delete(0, END)
-                self.transfer_recipient_log.delete(0, END)
-                return
-            
-            recipient_user = self.users.get(recipient_username)
-            if recipient_user is None:
-                msg.showerror("Error", "Recipient account does not exist.")
-                self.transfer_amount_log.delete(0, END)
-                self.transfer_recipient_log.delete(0, END)
-                return
-
-            # Proceeds with the transfer
-            if self.current_user.account.withdraw(amount):
-                recipient_user.account.deposit(amount)
-                msg.showinfo("Success", f"Transferred ${amount:.2f} to {recipient_username}.")
-                self.save_users()
-            else:
-                msg.showerror("Error", "You either have insufficient funds or you entered an invalid amount.")
-            self.transfer_amount_log.delete(0, END)
-            self.transfer_recipient_log.delete(0, END)
         except ValueError:
             msg.showerror("Error", "Please enter a valid amount.")
+            self.transfer_amount_log.delete(0, END)
+            self.transfer_recipient_log.delete(0, END)
+            return
+
+        try:
+            self.service.transfer(self.service.session_user(self.token), recipient_username, amount)
+            msg.showinfo("Success", f"Transferred ${amount:.2f} to {recipient_username}.")
+        except ValueError as e:
+            msg.showerror("Error", str(e))
         self.transfer_amount_log.delete(0, END)
         self.transfer_recipient_log.delete(0, END)
 
 
     # Prints out the user's balance when prompted
     def check_balance(self):
-        if self.current_user is None:
+        if self.token is None:
             msg.showerror("Error", "You need to log in to access your account.")
             return
-        msg.showinfo("Balance", f"Your bank balance is: ${self.current_user.account.check_balance():.2f}")
+        try:
+            balance = self.service.balance(self.service.session_user(self.token))
+        except ValueError as e:
+            msg.showerror("Error", str(e))
+            return
+        msg.showinfo("Balance", f"Your bank balance is: ${balance:.2f}")
 
 
     # Handles logging out
     def logout(self):
-        self.current_user = None
+        if self.token is not None:
+            self.service.close_session(self.token)
+            self.token = None
         msg.showinfo("Logged out", "You have been logged out successfully")
         self.login_page()
 
    
 
+# Builds the service over bank_users.csv, or over an SQLite database if --db is given
+# A --ledger file, where the command has one, records the transaction history
+def open_service(args, sync=True):
+    ledger = Transaction_Ledger(args.ledger, sync=sync) if getattr(args, "ledger", None) else None
+    if args.db:
+        return Bank_Service(storage=SQLite_Storage(args.db, sync=sync), ledger=ledger)
+    if getattr(args, "snapshot", None):
+        return Bank_Service(storage=Snapshot_Storage(args.snapshot, Transaction_Journal(args.snapshot + ".journal", sync=sync)),
+                            ledger=ledger)
+    return Bank_Service(journal=Transaction_Journal(sync=sync), ledger=ledger)
+
+
+# Runs a JSONL file of operations through the headless service and prints the report
+def run_batch(args):
+    if args.shards:
+        run_sharded_batch(args)
+        return
+    service = open_service(args, sync=not args.no_sync)
+    service.load_users()
+    if args.group_commit:
+        service.enable_group_commit()
+    if args.metrics:
+        service.enable_metrics()
+    if args.rate_limit:
+        service.enable_rate_limits(args.rate_limit, args.burst, args.daily_limit)
+    engine = Batch_Engine(service, workers=args.workers)
+
+    operations = sys.stdin if args.operations == "-" else open(args.operations, mode='r')
+    results = open(args.results, mode='w') if args.results else None
+    try:
+        report = engine.run(operations, results)
+    finally:
+        if operations is not sys.stdin:
+            operations.close()
+        if results is not None:
+            results.close()
+        service.close()
+        if args.metrics:
+            service.metrics.write(args.metrics)
+    print(json.dumps(report, indent=2))
+
+
+# Runs a JSONL file of operations through a Shard_Router, one process per shard
+def run_sharded_batch(args):
+    router = Shard_Router(shards=args.shards, sync=not args.no_sync)
+    engine = Sharded_Batch_Engine(router)
+    operations = sys.stdin if args.operations == "-" else open(args.operations, mode='r')
+    results = open(args.results, mode='w') if args.results else None
+    try:
+        report = engine.run(operations, results)
+    finally:
+        if operations is not sys.stdin:
+            operations.close()
+        if results is not None:
+            results.close()
+        router.close()
+    print(json.dumps(report, indent=2))
+
+
+# Serves the users over TCP until interrupted
+def run_server(args):
+    service = open_service(args)
+    service.load_users()
+    service.sessions = Session_Table(args.idle_timeout)
+    server = Bank_Server(service, flush_interval=args.flush_interval, credential_workers=args.credential_workers)
+    if args.metrics:
+        service.enable_metrics()
+    if args.rate_limit:
+        service.enable_rate_limits(args.rate_limit, args.burst, args.daily_limit)
+
+    # Rewrites the metrics file every interval, e.g. for a Prometheus textfile collector
+    async def export_metrics():
+        while True:
+            await asyncio.sleep(args.metrics_interval)
+            service.metrics.write(args.metrics)
+
+    async def serve():
+        await server.start(args.host, args.port)
+        print(f"CapitEx server listening on {args.host}:{args.port}")
+        exporter = asyncio.create_task(export_metrics()) if args.metrics else None
+        try:
+            await asyncio.Event().wait()
+        finally:
+            if exporter is not None:
+                exporter.cancel()
+            await server.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if args.metrics:
+            service.metrics.write(args.metrics)
+
+
+# Copies bank_users.csv, with its journal replayed, into an SQLite database
+# The account number counter is copied too, so new numbers keep skipping the old ones
+def run_migrate(args):
+    source = Bank_Service(args.csv, Transaction_Journal(args.journal))
+    if not source.load_users():
+        print(f"{args.csv} does not exist")
+        return
+    # The database reads users on demand and would keep plaintext passwords until they log in
+    source.wait_migrated()
+    target = SQLite_Storage(args.db)
+    start = time.perf_counter()
+    target.save(source.user_row(user) for user in source.users.values())
+    if os.path.exists(source.allocator.path) and not os.path.exists(args.db + ".seq"):
+        shutil.copyfile(source.allocator.path, args.db + ".seq")
+    print(f"Migrated {len(source.users)} users to {args.db} in {time.perf_counter() - start:.2f} s")
+    target.close()
+    source.close()
+
+
+# Converts between bank_users.csv and a binary snapshot, or checks a snapshot's checksum
+# Either side's journal is folded into the file written, and the target's own journal is emptied
+def run_snapshot(args):
+    csv_service = Bank_Service(args.csv, Transaction_Journal(args.journal))
+    snapshot = Snapshot_Storage(args.snap)
+    if args.action == "verify":
+        users = snapshot.load()
+        print(f"{args.snap}: {users.count} users, checksum {'ok' if users.verify() else 'MISMATCH'}")
+        snapshot.close()
+        return
+    source, target = (csv_service, snapshot) if args.action == "build" else (Bank_Service(storage=snapshot), csv_service.storage)
+    if not source.load_users():
+        print(f"{source.path} does not exist")
+        return
+    source.wait_migrated()
+    start = time.perf_counter()
+    target.save(source.user_row(user) for user in source.users.values())
+    if os.path.exists(source.allocator.path) and not os.path.exists(target.path + ".seq"):
+        shutil.copyfile(source.allocator.path, target.path + ".seq")
+    print(f"Wrote {len(source.users)} users to {target.path} in {time.perf_counter() - start:.2f} s")
+    source.close()
+    target.close()
+
+
+# Reads (username, password) records from a .jsonl file of objects, or a .csv file with a header row
+def read_signups(file, jsonl):
+    if jsonl:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                yield record.get("username", ""), record.get("password", "")
+    else:
+        for record in csv.DictReader(file):
+            yield record.get("username") or "", record.get("password") or ""
+
+
+# Signs up every user in a CSV or JSONL file and prints the report
+def run_import(args):
+    service = open_service(args)
+    service.load_users()
+    source = sys.stdin if args.users == "-" else open(args.users, mode='r', newline='', encoding='utf-8')
+    rejects = open(args.rejects, mode='w') if args.rejects else None
+    try:
+        report = service.import_signups(read_signups(source, args.jsonl or args.users.endswith(".jsonl")),
+                                        rejects, workers=args.workers)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if rejects is not None:
+            rejects.close()
+        service.close()
+    print(json.dumps(report, indent=2))
+
+
+# Prints an account's transactions from a ledger file as JSON lines
+def run_statement(args):
+    ledger = Transaction_Ledger(args.ledger)
+    try:
+        if args.as_of:
+            print(json.dumps({"account": args.account, "balance": ledger.balance_as_of(args.account, args.as_of)}, default=float))
+            return
+        for record in ledger.statement(args.account, args.start, args.end):
+            print(json.dumps(record, default=float))
+    finally:
+        ledger.close()
+
+
+# Closes a period: applies interest, fees and penalties to every account and prints the totals
+def run_close_period(args):
+    tiers = []
+    for tier in args.tiers:
+        threshold, _, rate = tier.partition(":")
+        tiers.append((threshold, rate))
+    schedule = Interest_Schedule(tiers, args.periods_per_year, args.fee, args.fee_waiver, args.minimum_balance, args.penalty)
+    service = open_service(args)
+    service.load_users()
+    try:
+        report = service.close_period(schedule, args.period)
+    finally:
+        service.close()
+    print(json.dumps(report, indent=2, default=float))
+
+
+# Verifies a .csv user file and prints the report without its per-chunk checksums, which go to --report
+# Exits with status 1 when anything was found, so it can gate a backup or a deploy
+def run_reconcile(args):
+    reconciler = Reconciler(args.csv, args.workers, args.chunk_mb << 20, args.samples, args.workdir)
+    report = reconciler.run(args.expected_total)
+    if args.report:
+        with open(args.report, mode='w') as report_file:
+            json.dump(report, report_file, indent=2, default=str)
+    print(json.dumps({key: value for key, value in report.items() if key != "chunks"}, indent=2, default=str))
+    if not report["ok"]:
+        sys.exit(1)
+
+
 def main():
+    parser = argparse.ArgumentParser(description="CapitEx Banking Application")
+    commands = parser.add_subparsers(dest="command")
+
+    batch = commands.add_parser("batch", help="run a JSONL stream of operations without the GUI")
+    batch.add_argument("operations", help="JSONL file of operations, or - for stdin")
+    batch.add_argument("--results", help="write one JSON outcome per operation to this file")
+    batch.add_argument("--no-sync", action="store_true", help="do not fsync the journal after each operation")
+    batch.add_argument("--workers", type=int, default=1, help="threads that run independent operations in parallel")
+    batch.add_argument("--group-commit", action="store_true", help="batch journal writes into one fsync per commit")
+    batch.add_argument("--db", help="use this SQLite database instead of bank_users.csv")
+    batch.add_argument("--snapshot", help="use this binary snapshot (e.g. bank_users.snap) instead of bank_users.csv")
+    batch.add_argument("--metrics", help="write operation metrics here: .json for a snapshot, else Prometheus text")
+    batch.add_argument("--ledger", help="record every balance change in this transaction ledger")
+    batch.add_argument("--shards", type=int, help="spread the users over this many processes (bank_users.shard<i>.csv)")
+    batch.add_argument("--rate-limit", type=float, help="operations per second allowed per account")
+    batch.add_argument("--burst", type=int, default=20, help="operations an idle account may make at once")
+    batch.add_argument("--daily-limit", type=float, default=10000, help="most an account may withdraw and transfer a day")
+
+    serve = commands.add_parser("serve", help="serve the banking operations over TCP")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8642)
+    serve.add_argument("--flush-interval", type=float, default=0.01, help="seconds between group commits")
+    serve.add_argument("--idle-timeout", type=float, default=900, help="seconds before an unused session expires")
+    serve.add_argument("--credential-workers", type=int, default=4, help="threads that hash passwords for signup and login")
+    serve.add_argument("--db", help="use this SQLite database instead of bank_users.csv")
+    serve.add_argument("--snapshot", help="use this binary snapshot (e.g. bank_users.snap) instead of bank_users.csv")
+    serve.add_argument("--metrics", help="write operation metrics here: .json for a snapshot, else Prometheus text")
+    serve.add_argument("--metrics-interval", type=float, default=10, help="seconds between metrics writes")
+    serve.add_argument("--ledger", help="record every balance change in this transaction ledger")
+    serve.add_argument("--rate-limit", type=float, help="operations per second allowed per account")
+    serve.add_argument("--burst", type=int, default=20, help="operations an idle account may make at once")
+    serve.add_argument("--daily-limit", type=float, default=10000, help="most an account may withdraw and transfer a day")
+
+    migrate = commands.add_parser("migrate", help="copy bank_users.csv and its journal into an SQLite database")
+    migrate.add_argument("--csv", default="bank_users.csv")
+    migrate.add_argument("--journal", default="bank_users.journal")
+    migrate.add_argument("--db", default="bank_users.db")
+
+    snapshot = commands.add_parser("snapshot", help="convert between bank_users.csv and a binary snapshot")
+    snapshot.add_argument("action", choices=["build", "export", "verify"],
+                          help="build the snapshot from the .csv file, export it back to .csv, or verify its checksum")
+    snapshot.add_argument("--csv", default="bank_users.csv")
+    snapshot.add_argument("--journal", default="bank_users.journal", help="journal of the .csv file")
+    snapshot.add_argument("--snap", default="bank_users.snap")
+
+    signups = commands.add_parser("import", help="sign up every user in a CSV (username,password) or JSONL file")
+    signups.add_argument("users", help="CSV or JSONL file of new users, or - for stdin")
+    signups.add_argument("--jsonl", action="store_true", help="read JSONL even if the file does not end in .jsonl")
+    signups.add_argument("--rejects", help="write one JSON line per rejected record to this file")
+    signups.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="threads that hash passwords")
+    signups.add_argument("--db", help="use this SQLite database instead of bank_users.csv")
+
+    statement = commands.add_parser("statement", help="list an account's transactions from a ledger file")
+    statement.add_argument("account", help="account number")
+    statement.add_argument("--ledger", default="bank_users.ledger")
+    statement.add_argument("--start", help="first date, e.g. 2024-01-31 or 2024-01-31T09:00")
+    statement.add_argument("--end", help="date to stop before")
+    statement.add_argument("--as-of", help="print the balance at this date instead")
+
+    close = commands.add_parser("close-period", help="apply interest, fees and penalties to every account")
+    close.add_argument("period", help="name of the period, e.g. 2024-06; each one can be closed once")
+    close.add_argument("--tiers", nargs="+", default=["0:0.005", "1000:0.01", "10000:0.02"],
+                       help="threshold:annual rate, each rate applying to the balance above its threshold")
+    close.add_argument("--periods-per-year", type=int, default=12)
+    close.add_argument("--fee", default="5", help="monthly fee, waived from --fee-waiver up")
+    close.add_argument("--fee-waiver", default="1000")
+    close.add_argument("--minimum-balance", default="100", help="balances below this pay --penalty")
+    close.add_argument("--penalty", default="10")
+    close.add_argument("--db", help="use this SQLite database instead of bank_users.csv")
+    close.add_argument("--ledger", help="record every charge in this transaction ledger")
+
+    reconcile = commands.add_parser("reconcile", help="check a .csv user file for bad rows, duplicates and its control total")
+    reconcile.add_argument("--csv", default="bank_users.csv")
+    reconcile.add_argument("--expected-total", help="dollars every balance should add up to")
+    reconcile.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processes that read the file")
+    reconcile.add_argument("--chunk-mb", type=int, default=64, help="megabytes each process reads at a time")
+    reconcile.add_argument("--samples", type=int, default=20, help="examples kept of each kind of problem")
+    reconcile.add_argument("--workdir", help="folder for the spilled hashes (about 16 bytes per row)")
+    reconcile.add_argument("--report", help="write the full report, with per-chunk checksums, to this .json file")
+
+    args = parser.parse_args()
+    if args.command == "batch":
+        run_batch(args)
+        return
+    if args.command == "serve":
+        run_server(args)
+        return
+    if args.command == "migrate":
+        run_migrate(args)
+        return
+    if args.command == "snapshot":
+        run_snapshot(args)
+        return
+    if args.command == "import":
+        run_import(args)
+        return
+    if args.command == "statement":
+        run_statement(args)
+        return
+    if args.command == "close-period":
+        run_close_period(args)
+        return
+    if args.command == "reconcile":
+        run_reconcile(args)
+        return
+
     root = Tk()
-    app = CapitEx_App(root)
-    app.login_page()
+    CapitEx_App(root)
     root.mainloop()
 
 
@@ -1,5 +1,17 @@
 import pytest
-from capitex_banking_app.capitex_bank import CapitEx_App, Bank_Account, Account_User
+import json
+import asyncio
+import random
+import argparse
+import io
+import time
+import os
+import threading
+import gc
+from array import array
+from itertools import accumulate
+from decimal import Decimal, ROUND_HALF_EVEN
+from capitex_banking_app.capitex_bank import CapitEx_App, Bank_Account, Account_User, Transaction_Journal, Lazy_User_Table, Account_Store, Bank_Service, Batch_Engine, Lock_Table, Bank_Server, Credential_Hasher, Account_Number_Allocator, luhn_digit, Money, SQLite_Storage, run_migrate, Metrics, Transaction_Ledger, Shard_Router, Shard_Worker, Idempotency_Cache, Rate_Limiter, Interest_Schedule, Snapshot_Storage, run_snapshot, Version_Store, Reconciler, Session_Table
 
 # Sets up a root tkinter window for testing
 from tkinter import *
@@ -27,6 +39,7 @@ def test_invalid_username(app):
     assert app.validate_username("") == False
     assert app.validate_username("Tafadzwa27_%") == False
     assert app.validate_username("nyashadzaishewacho") == False
+    assert app.validate_username("tinotenda21\n") == False
 
 
 # Tests the validate_password function for all input
@@ -39,6 +52,7 @@ def test_invalid_password(app):
     assert app.validate_password("Welcometomypage") == False
     assert app.validate_password("leon1") == False
     assert app.validate_password("password*") == False
+    assert app.validate_password("password#\n") == False
 
 # Tests for valid user signup details
 def test_valid_user(app, monkeypatch):
@@ -56,7 +70,10 @@ def test_valid_user(app, monkeypatch):
 
     user = app.users.get("lennyzhe")
     assert user is not None
-    assert user.password == "password@12"
+    # The password is stored as a salted hash, never as plaintext, once the migration of loaded users is done
+    app.service.wait_migrated()
+    assert user.password != "password@12"
+    assert app.service.credentials.verify("password@12", user.password)
 
 
 
@@ -79,7 +96,9 @@ def test_login(app, monkeypatch):
 
     assert app.current_user is not None
     assert app.current_user.username == "lennyzhe"
-    assert app.current_user.password == "password@12"
+    # The plaintext password is upgraded to a hash on login
+    assert app.service.credentials.verify("password@12", app.current_user.password)
+    assert app.service.credentials.is_hashed(app.current_user.password)
 
 
 """Tests the functions in the homepage
@@ -296,4 +315,1360 @@ def test_logout(app, monkeypatch):
     app.root.update_idletasks()
 
     assert app.username_input.winfo_ismapped()
-    assert app.password_input.winfo_ismapped()
\ No newline at end of file
+    assert app.password_input.winfo_ismapped()
+
+# Tests that each page is built once, swapped on navigation and empty when shown again
+def test_pages_are_reused(app, monkeypatch):
+    monkeypatch.setattr("tkinter.messagebox.showerror", lambda *args: None)
+    app.finish_loading()
+    assert str(app.login_button.cget("state")) == "normal"
+
+    username_input = app.username_input
+    username_input.insert(0, "lennyzhe")
+    app.signup_page()
+    app.root.update_idletasks()
+    assert not username_input.winfo_ismapped()
+
+    app.login_page()
+    app.root.update_idletasks()
+    assert app.username_input is username_input
+    assert app.username_input.get() == ""
+    assert app.username_input.winfo_ismapped()
+    assert sorted(app.pages) == ["login", "signup"]
+
+"""Tests the transaction journal
+   Balance changes are appended and replayed over the .csv snapshot"""
+# Tests that the latest journaled row wins and a torn row is skipped
+def test_journal_replay(tmp_path):
+    journal = Transaction_Journal(str(tmp_path / "bank_users.journal"))
+    journal.append([["lennyzhe", "password@12", "12345678", 500.0]])
+    journal.append([["lennyzhe", "password@12", "12345678", 300.0], ["tinotendam", "sexxyredd", "87654321", 700.0]])
+    journal.close()
+
+    # Simulates a crash in the middle of an append
+    with open(journal.path, mode='a') as journal_file:
+        journal_file.write("tinotendam,sexxy")
+
+    users = {}
+    assert journal.replay(users) == 3
+    assert users["lennyzhe"].account.check_balance() == 300.0
+    assert users["tinotendam"].account.check_balance() == 700.0
+
+# Tests that the journal is emptied once it is folded into a snapshot
+def test_journal_reset(tmp_path):
+    journal = Transaction_Journal(str(tmp_path / "bank_users.journal"))
+    journal.append([["lennyzhe", "password@12", "12345678", 500.0]])
+    journal.reset()
+
+    users = {}
+    assert journal.replay(users) == 0
+    assert users == {}
+
+
+"""Tests the lazy user table
+   Users are loaded from the .csv file on first access"""
+# Tests lookups through the index, the LRU bound and a restart from the sidecar index
+def test_lazy_user_table(tmp_path):
+    path = str(tmp_path / "bank_users.csv")
+    with open(path, mode='w', newline='') as user_file:
+        for i in range(50):
+            user_file.write(f"user{i:04d},password@12,{10000000 + i},100.0\n")
+
+    journal = Transaction_Journal(str(tmp_path / "bank_users.journal"))
+    users = Lazy_User_Table(path, journal, capacity=5)
+
+    assert len(users) == 50
+    assert "user0007" in users
+    assert users.get("lennyzhe") is None
+
+    # Journals a deposit, then evicts the user from the cache
+    user = users["user0003"]
+    user.account.deposit(50)
+    offset, = journal.append([["user0003", "password@12", user.account.account_number, user.account.check_balance()]])
+    users.journaled("user0003", offset)
+    del user
+    for i in range(10, 20):
+        users.get(f"user{i:04d}")
+
+    assert len(users.cache) == 5
+    assert users["user0003"].account.check_balance() == 150.0
+
+    # A new table reuses the sidecar index and replays the journal
+    restarted = Lazy_User_Table(path, Transaction_Journal(journal.path), capacity=5)
+    assert restarted.load_index()
+    assert restarted["user0003"].account.check_balance() == 150.0
+    assert len(list(restarted.values())) == 50
+
+
+"""Tests the columnar account store
+   Views keep the Bank_Account rules while balances are stored in cents"""
+# Tests deposits, withdrawals and transfers through the store views
+def test_account_store_views():
+    users = Account_Store()
+    users.add("lennyzhe", "password@12", "12345678", "500.0")
+    users["tinotendam"] = Account_User("tinotendam", "sexxyredd", Bank_Account("87654321", 300.00))
+
+    user = users["lennyzhe"]
+    assert user.username == "lennyzhe"
+    assert user.password == "password@12"
+    assert user.account.account_number == "12345678"
+
+    assert user.account.deposit(200.10) == True
+    assert user.account.deposit(3000) == False
+    assert user.account.withdraw(800) == False
+    assert user.account.can_transfer(700.10) == True
+    assert users["lennyzhe"].account.check_balance() == 700.10
+
+    assert len(users) == 2
+    assert "tinotendam" in users
+    assert users.get("cat") is None
+
+# Tests the aggregate queries over the cent column
+def test_account_store_aggregates():
+    users = Account_Store()
+    for i in range(100):
+        users.add(f"user{i:04d}", "password@12", str(10000000 + i), i * 10)
+
+    assert users.total_deposits() == 49500.0
+    assert users.balance_histogram([0, 250, 500, 1000]) == [25, 25, 50, 0]
+
+
+"""Tests the headless bank service
+   Runs the same rules as the GUI without a Tk window"""
+# Creates a service whose files live in a temporary folder
+@pytest.fixture
+def service(tmp_path):
+    service = Bank_Service(str(tmp_path / "bank_users.csv"), Transaction_Journal(str(tmp_path / "bank_users.journal")))
+    service.users = {
+        "lennyzhe": Account_User("lennyzhe", "password@12", Bank_Account("12345678", 500.00)),
+        "tinotendam": Account_User("tinotendam", "sexxyredd", Bank_Account("87654321", 300.00))
+    }
+    return service
+
+# Tests signup and login through the service
+def test_service_signup_login(service):
+    user = service.signup("tafadzwa_27", "Password@")
+    assert user.account.check_balance() == 0
+    assert service.login("tafadzwa_27", "Password@").username == "tafadzwa_27"
+
+    with pytest.raises(ValueError):
+        service.signup("lennyzhe", "password@12")
+    with pytest.raises(ValueError):
+        service.signup("tinotend@_21", "password@12")
+    with pytest.raises(ValueError):
+        service.login("lennyzhe", "wrongpass1")
+
+# Tests deposits, withdrawals and transfers through the service
+def test_service_operations(service):
+    assert service.deposit("lennyzhe", 200) == 700.00
+    assert service.withdraw("lennyzhe", 100) == 600.00
+    assert service.transfer("lennyzhe", "tinotendam", 250) == 350.00
+    assert service.balance("tinotendam") == 550.00
+
+    with pytest.raises(ValueError):
+        service.deposit("lennyzhe", 3000)
+    with pytest.raises(ValueError):
+        service.withdraw("lennyzhe", 800)
+    with pytest.raises(ValueError):
+        service.transfer("lennyzhe", "nobody_here", 50)
+
+    # A transfer the recipient cannot accept leaves the sender untouched
+    service.users["lennyzhe"].account.balance = 5000.00
+    with pytest.raises(ValueError):
+        service.transfer("lennyzhe", "tinotendam", 4000)
+    assert service.balance("lennyzhe") == 5000.00
+
+    # Every change reached the journal
+    users = {}
+    service.journal.replay(users)
+    assert users["tinotendam"].account.check_balance() == 550.00
+
+# Tests that the batch engine counts successes and failures per operation
+def test_batch_engine(service):
+    lines = [
+        '{"op": "deposit", "username": "lennyzhe", "amount": 200}',
+        '{"op": "transfer", "username": "lennyzhe", "recipient": "tinotendam", "amount": 100}',
+        '{"op": "withdraw", "username": "tinotendam", "amount": 9000}',
+        '{"op": "balance", "username": "tinotendam"}',
+        'not json',
+    ]
+    report = Batch_Engine(service).run(lines)
+
+    assert report["operations"] == 5
+    assert report["succeeded"] == 3
+    assert report["failed"] == 2
+    assert report["by_op"]["withdraw"] == {"succeeded": 0, "failed": 1}
+    assert service.balance("tinotendam") == 400.00
+
+# Tests that concurrent random transfers never create or lose money
+def test_concurrent_transfers_conserve_money(service):
+    service.journal.sync = False
+    service.users = {}
+    for i in range(20):
+        service.users[f"user{i:04d}"] = Account_User(f"user{i:04d}", "password@12", Bank_Account(str(10000000 + i), 1000.00))
+
+    rng = random.Random(7)
+    lines = [json.dumps({"op": "transfer", "username": f"user{rng.randrange(20):04d}",
+                         "recipient": f"user{rng.randrange(20):04d}", "amount": rng.randrange(1, 400)})
+             for _ in range(4000)]
+    report = Batch_Engine(service, workers=8, chunk_size=100).run(lines)
+
+    assert report["operations"] == 4000
+    assert sum(user.account.check_balance() for user in service.users.values()) == 20000.00
+    assert all(user.account.check_balance() >= 0 for user in service.users.values())
+
+# Tests that overlapping accounts share stripes and are locked in a fixed order
+def test_lock_table_ordering():
+    locks = Lock_Table(stripes=4)
+    with locks.holding("12345678", "87654321", "12345678"):
+        held = [lock.locked() for lock in locks.stripes]
+    assert sum(held) == len({locks.stripe("12345678"), locks.stripe("87654321")})
+    assert not any(lock.locked() for lock in locks.stripes)
+
+
+"""Tests the asyncio network server
+   Requests are JSON lines that carry a session token after login"""
+# Tests login, pipelined requests and a request without a session
+def test_bank_server(service):
+    async def session():
+        server = Bank_Server(service)
+        listener = await server.start("127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", listener.sockets[0].getsockname()[1])
+
+        writer.write(b'{"id": 1, "op": "login", "username": "lennyzhe", "password": "password@12"}\n')
+        token = json.loads(await reader.readline())["result"]
+
+        # Sends three requests before reading any response
+        for request in ({"id": 2, "op": "deposit", "amount": 200},
+                        {"id": 3, "op": "transfer", "recipient": "tinotendam", "amount": 100},
+                        {"id": 4, "op": "check_balance"}):
+            writer.write((json.dumps(dict(request, token=token)) + "\n").encode())
+        responses = [json.loads(await reader.readline()) for _ in range(3)]
+
+        writer.write(b'{"id": 5, "op": "check_balance", "token": "cat"}\n')
+        rejected = json.loads(await reader.readline())
+
+        writer.close()
+        await server.stop()
+        return responses, rejected
+
+    responses, rejected = asyncio.run(session())
+
+    assert [response["id"] for response in responses] == [2, 3, 4]
+    assert responses[2]["result"] == 600.00
+    assert rejected["ok"] == False
+    assert service.balance("tinotendam") == 400.00
+
+    # Stopping the server committed every change
+    assert service.group_commit.committed == service.group_commit.issued
+    service.close()
+
+# Tests that a slow password check runs off the event loop, so other clients are still answered meanwhile
+def test_bank_server_credentials(service):
+    entered = threading.Event()
+    verified = threading.Event()
+    verify = service.credentials.verify
+
+    # Holds the login's password check until the test has heard from the other client
+    def slow_verify(password, stored):
+        entered.set()
+        time.sleep(0.5)
+        verified.set()
+        return verify(password, stored)
+    service.credentials.verify = slow_verify
+
+    async def session():
+        server = Bank_Server(service)
+        listener = await server.start("127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        first_reader, first_writer = await asyncio.open_connection("127.0.0.1", port)
+        second_reader, second_writer = await asyncio.open_connection("127.0.0.1", port)
+
+        first_writer.write(b'{"id": 1, "op": "login", "username": "lennyzhe", "password": "password@12"}\n')
+        while not entered.is_set():
+            await asyncio.sleep(0.01)
+        second_writer.write(b'{"id": 2, "op": "check_balance", "token": "cat"}\n')
+        answered = json.loads(await second_reader.readline())
+        answered_early = not verified.is_set()
+        login = json.loads(await first_reader.readline())
+
+        first_writer.close()
+        second_writer.close()
+        await server.stop()
+        return answered, answered_early, login
+
+    answered, answered_early, login = asyncio.run(session())
+    assert answered["error"] == "Please log in first"
+    assert answered_early
+    assert login["ok"] == True
+    service.close()
+
+# Tests that a deposit, and the request pipelined after it, are only answered once the deposit is durable
+def test_bank_server_durable(service):
+    async def session():
+        # Nothing commits on its own for a minute
+        server = Bank_Server(service, flush_interval=60)
+        listener = await server.start("127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", listener.sockets[0].getsockname()[1])
+
+        writer.write(b'{"id": 1, "op": "login", "username": "lennyzhe", "password": "password@12"}\n')
+        token = json.loads(await reader.readline())["result"]
+        for request in ({"id": 2, "op": "deposit", "amount": 200}, {"id": 3, "op": "check_balance"}):
+            writer.write((json.dumps(dict(request, token=token)) + "\n").encode())
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(reader.readline(), 0.2)
+
+        await asyncio.get_running_loop().run_in_executor(None, service.group_commit.commit)
+        responses = [json.loads(await reader.readline()) for _ in range(2)]
+        users = {}
+        service.journal.replay(users)
+
+        writer.close()
+        await server.stop()
+        return responses, users
+
+    responses, users = asyncio.run(session())
+    assert [response["id"] for response in responses] == [2, 3]
+    assert responses[1]["result"] == 700.00
+    assert users["lennyzhe"].account.check_balance() == 700.00
+    service.close()
+
+
+"""Tests group commit and crash consistency
+   Journal writes are batched, and a failed snapshot never damages the old one"""
+# Tests that many deposits to one account are committed as one journal row
+def test_group_commit_coalesces(service):
+    service.enable_group_commit(interval=60, batch_size=1000)
+    for _ in range(100):
+        service.deposit("lennyzhe", 2)
+    assert service.journal.records == 0
+
+    assert service.wait_durable(timeout=5) == True
+    assert service.journal.records == 1
+
+    users = {}
+    service.journal.replay(users)
+    assert users["lennyzhe"].account.check_balance() == 700.00
+    service.close()
+
+# Tests that a batch built before a snapshot is not written after it, where it would undo later changes
+def test_group_commit_snapshot(service):
+    service.save_users()
+    service.enable_group_commit(interval=60)
+    released = threading.Event()
+    write = service.storage.write
+
+    # Holds the first batch's write until the snapshot has been started
+    def slow_write(users, rows):
+        released.wait(5)
+        write(users, rows)
+    service.storage.write = slow_write
+
+    service.deposit("lennyzhe", 100)
+    committer = threading.Thread(target=service.group_commit.commit)
+    committer.start()
+    while not service.group_commit.commit_lock.locked():
+        time.sleep(0.01)
+    service.storage.write = write
+    service.transfer("lennyzhe", "tinotendam", 500)
+    saver = threading.Thread(target=service.save_users)
+    saver.start()
+    saver.join(0.2)
+    released.set()
+    committer.join()
+    saver.join()
+
+    # Restarts without committing the transfer's batch, as after a crash
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    restarted.load_users()
+    assert restarted.balance("lennyzhe") == 100.00
+    assert restarted.balance("tinotendam") == 800.00
+    restarted.close()
+    service.close()
+
+# Tests that a restart after a crash sees every change that was waited for
+def test_group_commit_recovery(service):
+    service.enable_group_commit()
+    service.transfer("lennyzhe", "tinotendam", 125)
+    service.wait_durable(timeout=5)
+
+    # Simulates a crash: the first service is never closed
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    restarted.load_users()
+    assert restarted.balance("lennyzhe") == 375.00
+    assert restarted.balance("tinotendam") == 425.00
+    service.close()
+
+# Tests that a failed write fails its waiters, and that the flusher keeps running and writes the batch later
+def test_group_commit_write_fails(service):
+    service.enable_group_commit(interval=0.01)
+    write = service.storage.write
+    def fail(users, rows):
+        raise OSError("disk full")
+    service.storage.write = fail
+
+    async def deposit():
+        service.deposit("lennyzhe", 100)
+        return await service.group_commit.durable_future()
+    with pytest.raises(OSError, match="disk full"):
+        asyncio.run(deposit())
+    with pytest.raises(OSError, match="disk full"):
+        service.wait_durable(timeout=5)
+    assert service.group_commit.thread.is_alive()
+
+    service.storage.write = write
+    assert service.wait_durable(timeout=5) == True
+    users = {}
+    service.journal.replay(users)
+    assert users["lennyzhe"].account.check_balance() == 600.00
+    service.close()
+
+# Tests that a crash in the middle of save_users leaves the old snapshot and journal intact
+def test_save_users_crash_keeps_snapshot(service, monkeypatch):
+    service.save_users()
+    service.deposit("lennyzhe", 100)
+
+    def crash(user):
+        raise OSError("disk full")
+    monkeypatch.setattr(service, "user_row", crash)
+    with pytest.raises(OSError):
+        service.save_users()
+    monkeypatch.undo()
+
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    restarted.load_users()
+    assert restarted.balance("lennyzhe") == 600.00
+    assert restarted.balance("tinotendam") == 300.00
+
+
+
+"""Tests password hashing and the login cache
+   Plaintext passwords are migrated and recent logins skip the slow hash"""
+# Tests hashing, verification and upgrades across schemes and costs
+def test_credential_hasher():
+    hasher = Credential_Hasher(cost=1000)
+    stored = hasher.hash("password@12")
+
+    assert stored.startswith("pbkdf2_sha256$1000$")
+    assert stored != hasher.hash("password@12")
+    assert hasher.verify("password@12", stored)
+    assert not hasher.verify("password@13", stored)
+    assert not hasher.needs_upgrade(stored)
+
+    # Plaintext and older costs still verify but need an upgrade
+    assert hasher.verify("password@12", "password@12")
+    assert hasher.needs_upgrade("password@12")
+    assert Credential_Hasher(cost=2000).needs_upgrade(stored)
+
+    scrypt = Credential_Hasher("scrypt", 2 ** 10)
+    assert scrypt.verify("password@12", scrypt.hash("password@12"))
+
+# Tests that load_users returns before plaintext rows are hashed, and that they are then journaled hashed
+def test_load_users_migrates_plaintext(service):
+    service.credentials = Credential_Hasher(cost=1000)
+    service.save_users()
+
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    restarted.credentials = Credential_Hasher(cost=1000)
+    released = threading.Event()
+    hash = restarted.credentials.hash
+
+    # Holds the migration until after the first login
+    def slow_hash(password):
+        if threading.current_thread() is restarted.migration:
+            released.wait(5)
+        return hash(password)
+    restarted.credentials.hash = slow_hash
+    restarted.load_users()
+
+    # A login before the migration gets to the user upgrades the password itself
+    assert restarted.login("lennyzhe", "password@12").username == "lennyzhe"
+    assert restarted.credentials.is_hashed(restarted.users["lennyzhe"].password)
+    released.set()
+    restarted.wait_migrated()
+
+    users = {}
+    restarted.journal.replay(users)
+    assert all(restarted.credentials.is_hashed(user.password) for user in users.values())
+    assert restarted.login("tinotendam", "sexxyredd").username == "tinotendam"
+    restarted.close()
+
+# Tests that a repeated login is answered by the cache until the password changes
+def test_login_cache(service, monkeypatch):
+    service.credentials = Credential_Hasher(cost=1000)
+    service.login("lennyzhe", "password@12")
+
+    calls = []
+    monkeypatch.setattr(service.credentials, "verify", lambda *args: calls.append(args) or False)
+    assert service.login("lennyzhe", "password@12").username == "lennyzhe"
+    assert calls == []
+
+    with pytest.raises(ValueError):
+        service.login("lennyzhe", "wrongpass1")
+
+    service.users["lennyzhe"].password = "changed"
+    with pytest.raises(ValueError):
+        service.login("lennyzhe", "password@12")
+
+
+
+"""Tests account numbers
+   New numbers never collide and every account number resolves in one lookup"""
+# Tests that allocated numbers are unique, 9 digits long and end in a Luhn digit
+def test_account_number_allocator(tmp_path):
+    path = str(tmp_path / "bank_users.csv.seq")
+    allocator = Account_Number_Allocator(path, block=100)
+    numbers = [allocator.allocate() for i in range(250)] + allocator.allocate_many(250)
+
+    assert len(set(numbers)) == 500
+    assert all(len(number) == 9 and number[-1] == luhn_digit(number[:-1]) for number in numbers)
+    assert luhn_digit("7992739871") == "3"
+
+    # A restart skips the rest of the reserved block instead of reusing it
+    restarted = Account_Number_Allocator(path, block=100)
+    assert restarted.key == allocator.key
+    assert restarted.counter >= allocator.counter
+    assert not set(restarted.allocate_many(100)) & set(numbers)
+
+# Tests transfers by account number through the dictionary, store and lazy indexes
+def test_transfer_by_account_number(service):
+    assert service.account_owner("87654321") == "tinotendam"
+    assert service.transfer("lennyzhe", "87654321", 100) == 400.00
+    assert service.balance("tinotendam") == 400.00
+
+    user = service.signup("tafadzwa_27", "Password@")
+    assert service.account_owner(user.account.account_number) == "tafadzwa_27"
+    with pytest.raises(ValueError):
+        service.transfer("lennyzhe", "00000000", 100)
+
+    service.save_users()
+    for mode in ({"columnar": True}, {"lazy": True}):
+        restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path), **mode)
+        restarted.load_users()
+        assert restarted.account_owner(user.account.account_number) == "tafadzwa_27"
+        assert restarted.account_owner("12345678") == "lennyzhe"
+        assert restarted.account_owner("11111111") is None
+
+
+
+"""Tests batch transfers
+   Legs are netted per account and applied all or nothing"""
+# Tests that only the net debit has to fit and that the batch is journaled once
+def test_transfer_batch(service):
+    account_number = service.signup("tafadzwa_27", "Password@").account.account_number
+    service.journal.reset()
+    legs = [("lennyzhe", "tinotendam", 400), ("tinotendam", "lennyzhe", 300),
+            ("lennyzhe", account_number, 350), ("tafadzwa_27", "tinotendam", 100)]
+    report = service.transfer_batch(iter(legs))
+
+    assert report == {"legs": 4, "accounts": 3, "moved": 1150}
+    assert service.balance("lennyzhe") == 50.00
+    assert service.balance("tinotendam") == 500.00
+    assert service.balance("tafadzwa_27") == 250.00
+    assert service.journal.records == 3
+
+# Tests that one bad leg or an overdrawn net balance leaves every account unchanged
+def test_transfer_batch_all_or_nothing(service):
+    for legs in ([("lennyzhe", "tinotendam", 100), ("lennyzhe", "cat", 100)],
+                 [("lennyzhe", "tinotendam", 100), ("tinotendam", "lennyzhe", 5000)],
+                 [("lennyzhe", "tinotendam", 2000), ("lennyzhe", "tinotendam", 2000)]):
+        with pytest.raises(ValueError):
+            service.transfer_batch(legs)
+
+    assert service.balance("lennyzhe") == 500.00
+    assert service.balance("tinotendam") == 300.00
+    assert service.journal.records == 0
+
+
+
+"""Tests the Money type
+   Balances are whole cents, so repeated small amounts never drift"""
+# Tests parsing, exact arithmetic, comparisons and formatting
+def test_money():
+    assert Money.parse("12.5").cents == 1250
+    assert Money.parse("-0.75").cents == -75
+    assert Money.parse("100.30000000000001", exact=False).cents == 10030
+    for text in ("cat", "0.001", "nan", "1e400"):
+        with pytest.raises(ValueError):
+            Money.parse(text)
+
+    account = Bank_Account("12345678")
+    for _ in range(1000):
+        account.deposit(Money.parse("1.10"))
+        account.withdraw("1.00")
+    assert account.check_balance().cents == 10000
+    assert account.check_balance() == 100
+    assert account.check_balance() == 100.00
+    assert Money.parse("700.10") == 700.10
+    assert Money.parse("0.10") < 1
+    assert sum([Money(5), Money(7)]) == Money(12)
+    assert f"{Money.parse('1234.5'):,.2f}" == "1,234.50"
+    assert str(Money(-5)) == "-0.05"
+
+# Tests that sub-cent amounts are rejected and older float balances load rounded
+def test_service_money(service):
+    with pytest.raises(ValueError):
+        service.deposit("lennyzhe", "10.005")
+    assert service.deposit("lennyzhe", "10.10") == 510.10
+
+    service.journal.reset()
+    with open(service.path, mode='w', newline='') as user_file:
+        user_file.write("lennyzhe,password@12,12345678,100.30000000000001\n")
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path), columnar=True)
+    restarted.load_users()
+    assert restarted.balance("lennyzhe").cents == 10030
+
+
+
+"""Tests the SQLite storage
+   Users are looked up through the database indexes and each operation updates only its rows"""
+# Tests the service rules on an SQLite database, and that a restart sees every change
+def test_sqlite_storage(service, tmp_path):
+    storage = SQLite_Storage(str(tmp_path / "bank_users.db"))
+    storage.save(service.user_row(user) for user in service.users.values())
+    bank = Bank_Service(storage=storage)
+    bank.credentials = Credential_Hasher(cost=1000)
+    assert bank.load_users()
+
+    user = bank.signup("tafadzwa_27", "Password@")
+    bank.deposit("lennyzhe", 200)
+    bank.transfer("lennyzhe", user.account.account_number, 100)
+    assert bank.users["lennyzhe"] is bank.users["lennyzhe"]
+    assert bank.account_owner("87654321") == "tinotendam"
+    assert len(bank.users) == 3
+    bank.close()
+
+    restarted = Bank_Service(storage=SQLite_Storage(storage.path))
+    restarted.credentials = bank.credentials
+    restarted.load_users()
+    assert restarted.balance("lennyzhe") == 600.00
+    assert restarted.balance("tafadzwa_27") == 100.00
+    assert restarted.login("tafadzwa_27", "Password@").username == "tafadzwa_27"
+    assert sorted(restarted.users) == ["lennyzhe", "tafadzwa_27", "tinotendam"]
+    restarted.close()
+
+# Tests that the migration tool copies the .csv snapshot with its journal replayed
+def test_migrate_to_sqlite(service, tmp_path):
+    service.credentials = Credential_Hasher(cost=1000)
+    service.save_users()
+    service.deposit("lennyzhe", 100)
+
+    db = str(tmp_path / "bank_users.db")
+    run_migrate(argparse.Namespace(csv=service.path, journal=service.journal.path, db=db))
+
+    bank = Bank_Service(storage=SQLite_Storage(db))
+    bank.load_users()
+    assert bank.balance("lennyzhe") == 600.00
+    assert bank.balance("tinotendam") == 300.00
+    bank.close()
+
+
+
+"""Tests the metrics
+   Operations are counted and timed only while metrics are enabled"""
+# Tests counters, quantiles and both export formats
+def test_metrics(service, tmp_path):
+    metrics = service.enable_metrics()
+    service.deposit("lennyzhe", 200)
+    with pytest.raises(ValueError):
+        service.deposit("lennyzhe", 5000)
+    service.transfer("lennyzhe", "tinotendam", 100)
+
+    snapshot = metrics.snapshot()
+    assert snapshot["deposit"]["calls"] == 2
+    assert snapshot["deposit"]["rejected"] == 1
+    assert snapshot["transfer"]["ok"] == 1
+    assert snapshot["storage_write"]["calls"] == 2
+    assert 0 < snapshot["deposit"]["p50_us"] <= snapshot["deposit"]["max_us"]
+
+    text = metrics.prometheus()
+    assert 'capitex_operations_total{op="deposit",outcome="rejected"} 1' in text
+    assert 'capitex_operation_seconds_bucket{op="transfer",le="+Inf"} 1' in text
+    metrics.write(str(tmp_path / "metrics.json"))
+    with open(tmp_path / "metrics.json") as metrics_file:
+        assert json.load(metrics_file)["deposit"]["ok"] == 1
+
+    # Disabling removes the wrappers and keeps what was recorded
+    service.disable_metrics()
+    service.deposit("lennyzhe", 200)
+    assert metrics.snapshot()["deposit"]["calls"] == 2
+    assert "deposit" not in vars(service)
+
+# Tests that each latency is reported within 1.6% of its value
+def test_metrics_buckets():
+    for ns in (1, 127, 128, 1000, 123456789, 2 ** 39):
+        metrics = Metrics()
+        metrics.record("op", ns, 0)
+        histogram, counts = metrics.merged()["op"]
+        assert ns <= metrics.quantile(histogram, 1, 1) <= ns * 1.016 + 1
+
+
+
+"""Tests the bulk signup import
+   Invalid and duplicate records are reported and the rest are created together"""
+# Tests an import with invalid rows and duplicates against the users and within the batch
+def test_import_signups(service, tmp_path):
+    service.credentials = Credential_Hasher(cost=1000)
+    records = [("tafadzwa_27", "Password@"), ("tinotend@_21", "Password@"), ("rutendo_99", "pass"),
+               ("lennyzhe", "password@12"), ("tafadzwa_27", "Password#"), ("chipo_mazvita", "Password@"),
+               ("kudzai_2024", "Password!")]
+    rejects = io.StringIO()
+    report = service.import_signups(records, rejects, workers=2)
+
+    assert report["rows"] == 7
+    assert report["created"] == 2
+    assert report["invalid_username"] == 2
+    assert report["invalid_password"] == 1
+    assert report["duplicate"] == 1
+    assert report["duplicate_in_batch"] == 1
+    assert [json.loads(line)["row"] for line in rejects.getvalue().splitlines()] == [2, 3, 4, 5, 6]
+
+    assert service.login("tafadzwa_27", "Password@").account.check_balance() == 0
+    assert service.login("kudzai_2024", "Password!").username == "kudzai_2024"
+    assert service.account_owner(service.users["kudzai_2024"].account.account_number) == "kudzai_2024"
+
+    bank = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    bank.load_users()
+    assert "tafadzwa_27" in bank.users and "kudzai_2024" in bank.users
+
+
+
+"""Tests the transaction ledger
+   Every balance change is kept as a record that statements and past balances are read from"""
+# Tests statements and balances as of a time, before and after reopening the ledger
+def test_ledger_statement(service, tmp_path):
+    service.ledger = Transaction_Ledger(str(tmp_path / "bank_users.ledger"))
+    service.deposit("lennyzhe", 200)
+    middle = time.time()
+    time.sleep(0.01)
+    service.withdraw("lennyzhe", 100)
+    service.transfer("lennyzhe", "tinotendam", 50)
+    service.transfer_batch([("tinotendam", "lennyzhe", 30), ("lennyzhe", "tinotendam", 10)])
+
+    kinds = [record["kind"] for record in service.statement("lennyzhe")]
+    assert kinds == ["deposit", "withdraw", "transfer_out", "batch_in", "batch_out"]
+    assert [record["balance"] for record in service.statement("lennyzhe")] == [700, 600, 550, 580, 570]
+    assert service.statement("lennyzhe", end=middle)[0]["amount"] == 200
+    assert len(service.statement("lennyzhe", start=middle)) == 4
+    assert service.statement("tinotendam")[0]["counterparty"] == "12345678"
+
+    assert service.balance_as_of("lennyzhe", middle) == 700
+    assert service.balance_as_of("lennyzhe", middle - 3600) == 500
+    assert service.balance_as_of("tinotendam", time.time()) == 330
+    service.close()
+
+    # A torn record at the end is dropped when the ledger is opened again
+    with open(tmp_path / "bank_users.ledger", mode='ab') as ledger_file:
+        ledger_file.write(b"torn")
+    ledger = Transaction_Ledger(str(tmp_path / "bank_users.ledger"))
+    assert [record["amount"] for record in ledger.statement("12345678")] == [200, -100, -50, 30, -10]
+    assert ledger.balance_as_of("87654321", "2000-01-01") == 300
+    assert ledger.balance_as_of("00000000", middle) is None
+    ledger.close()
+
+# Tests that with group commit the ledger is written with each batch, with one fsync, after its balances
+def test_ledger_group_commit(service, tmp_path, monkeypatch):
+    service.ledger = Transaction_Ledger(str(tmp_path / "bank_users.ledger"))
+    service.enable_group_commit(interval=60)
+    for _ in range(10):
+        service.deposit("lennyzhe", 10)
+    service.transfer_batch([("lennyzhe", "tinotendam", 30)])
+    assert service.ledger.records == 0 and service.statement("lennyzhe") == []
+
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+    write = service.storage.write
+    service.storage.write = lambda users, rows: (synced.append("journal"), write(users, rows))
+    assert service.wait_durable(timeout=5)
+    ledger_syncs = [fd for fd in synced if fd == service.ledger.ledger_file.fileno()]
+    assert len(ledger_syncs) == 1 and synced.index("journal") < synced.index(ledger_syncs[0])
+    assert [record["balance"] for record in service.statement("lennyzhe")][-2:] == [600, 570]
+
+    # A period close writes what is still buffered first, so the ledger stays in time order
+    service.deposit("lennyzhe", 10)
+    service.close_period(Interest_Schedule(monthly_fee=0), "2024-06")
+    kinds = [record["kind"] for record in service.statement("lennyzhe")]
+    assert kinds[-3:] == ["batch_out", "deposit", "interest"]
+    service.close()
+
+
+
+"""Tests the sharded mode
+   Users live in several processes and transfers between them use two phases"""
+# Tests transfers within and across shards, by username and by account number
+def test_shard_router(tmp_path):
+    router = Shard_Router(str(tmp_path / "bank_users.csv"), shards=3, sync=False)
+    names = ["lennyzhe_1", "tinotendam", "tafadzwa_27", "chipo_1234"]
+    numbers = {name: router.signup(name, "Password@") for name in names}
+    assert sorted(router.shard_of(name) for name in names) == [0, 0, 1, 2]
+    assert all(router.account_shard(numbers[name]) == router.shard_of(name) for name in names)
+    for name in names:
+        router.deposit(name, 1000)
+
+    assert router.transfer("lennyzhe_1", "tinotendam", 100) == 900
+    assert router.transfer("lennyzhe_1", numbers["chipo_1234"], 50) == 850
+    with pytest.raises(ValueError):
+        router.transfer("lennyzhe_1", "nobody_here", 10)
+    with pytest.raises(ValueError):
+        router.transfer("tafadzwa_27", "lennyzhe_1", 5000)
+
+    # Only the first of these fits the balance; the refused ones release their holds
+    outcomes = router.execute_all([{"op": "transfer", "username": "tinotendam", "recipient": "tafadzwa_27", "amount": 600}] * 2)
+    assert [outcome["ok"] for outcome in outcomes] == [True, False]
+    router.close()
+
+    router = Shard_Router(str(tmp_path / "bank_users.csv"), shards=3, sync=False)
+    assert [router.balance(name) for name in names] == [850, 500, 1600, 1050]
+    assert router.login("chipo_1234", "Password@") == "chipo_1234"
+    router.close()
+
+# Tests that a restarted router finishes a transfer whose credit committed before a crash,
+# and aborts one that crashed before its decision was logged
+def test_shard_router_recovery(tmp_path):
+    path = str(tmp_path / "bank_users.csv")
+    router = Shard_Router(path, shards=2, sync=False)
+    names = ["lennyzhe_1", "chipo_1234"]
+    assert router.shard_of(names[0]) != router.shard_of(names[1])
+    for name in names:
+        router.signup(name, "Password@")
+        router.deposit(name, 1000)
+
+    # Crashes after the credit's shard has committed and before the debit's shard hears anything
+    exchange = router.exchange
+    def crash(batches):
+        credit = router.shard_of(names[1])
+        if any(op == "commit" for op, _ in batches.get(credit, [])):
+            exchange({credit: batches[credit]})
+            raise RuntimeError("crashed")
+        return exchange(batches)
+    router.exchange = crash
+    with pytest.raises(RuntimeError):
+        router.transfer(names[0], names[1], 100)
+    for process in router.processes:
+        process.kill()
+        process.join()
+
+    router = Shard_Router(path, shards=2, sync=False)
+    assert [router.balance(name) for name in names] == [900, 1100]
+
+    # Crashes after both sides prepared, before the decision is logged
+    def crash_before_logging(decisions):
+        raise RuntimeError("crashed")
+    router.log_decisions = crash_before_logging
+    with pytest.raises(RuntimeError):
+        router.transfer(names[0], names[1], 100)
+    for process in router.processes:
+        process.kill()
+        process.join()
+
+    router = Shard_Router(path, shards=2, sync=False)
+    assert [router.balance(name) for name in names] == [900, 1100]
+    # The aborted transfer's hold is gone, so the whole balance can be spent
+    assert router.withdraw(names[0], 900) == 0
+    router.close()
+
+# Tests that a compaction keeps a prepared transfer, whose journaled record it folds away
+def test_shard_worker_checkpoint(tmp_path):
+    path, journal = str(tmp_path / "bank_users.shard0.csv"), str(tmp_path / "bank_users.shard0.journal")
+    worker = Shard_Worker(path, journal, sync=False)
+    worker.compact_threshold = 0
+    replies = worker.handle([("signup", ("lennyzhe_1", "Password@")), ("deposit", ("lennyzhe_1", Money.of(500))),
+                             ("prepare_debit", (7, "lennyzhe_1", 40000))])
+    assert [ok for ok, _ in replies] == [True, True, True]
+    assert os.path.getsize(journal) == 0
+    worker.close()
+
+    worker = Shard_Worker(path, journal, sync=False)
+    assert worker.handle([("in_doubt", ()), ("withdraw", ("lennyzhe_1", Money.of(200)))]) == [
+        (True, [(7, "debit")]), (False, "You have insufficient funds in your account or you entered an invalid amount")]
+    assert worker.handle([("commit", (7, "debit")), ("commit", (7, "debit"))]) == [(True, 100), (True, None)]
+    worker.close()
+
+
+
+"""Tests idempotency keys
+   A retried request with the same key returns the first outcome without running again"""
+# Tests retries, reused keys, cached rejections and a restart
+def test_idempotent_retries(service):
+    service.save_users()
+    assert service.deposit("lennyzhe", 200, key="retry-1") == 700.00
+    assert service.deposit("lennyzhe", 200, key="retry-1") == 700.00
+    assert service.transfer("lennyzhe", "tinotendam", 50, key="retry-2") == 650.00
+    assert service.transfer("lennyzhe", "tinotendam", 50, key="retry-2") == 650.00
+    # The same key from another user is a different key
+    assert service.deposit("tinotendam", 200, key="retry-1") == 550.00
+
+    with pytest.raises(ValueError, match="different request"):
+        service.deposit("lennyzhe", 300, key="retry-1")
+    with pytest.raises(ValueError, match="insufficient funds"):
+        service.withdraw("lennyzhe", 5000, key="retry-3")
+    service.deposit("lennyzhe", 2000)
+    with pytest.raises(ValueError, match="insufficient funds"):
+        service.withdraw("lennyzhe", 5000, key="retry-3")
+    service.close()
+
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    restarted.load_users()
+    assert restarted.deposit("lennyzhe", 200, key="retry-1") == 700.00
+    assert restarted.balance("lennyzhe") == 2650.00
+    restarted.close()
+
+# Tests a storm of duplicates from many threads, with and without group commit
+@pytest.mark.parametrize("group_commit", [False, True])
+def test_idempotency_duplicate_storm(service, group_commit):
+    if group_commit:
+        service.enable_group_commit()
+    lines = [json.dumps({"op": "deposit", "username": "lennyzhe", "amount": 10, "key": f"storm-{i % 25}"})
+             for i in range(2000)]
+    report = Batch_Engine(service, workers=8, chunk_size=50).run(lines)
+    assert report["failed"] == 0
+    assert service.balance("lennyzhe") == 750.00
+    service.close()
+
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    assert len(restarted.idempotency.entries) == 25
+    restarted.close()
+
+# Tests that entries expire and that the cache and its file stay within the capacity
+def test_idempotency_cache_bounds(tmp_path):
+    cache = Idempotency_Cache(str(tmp_path / "bank_users.csv.keys"), ttl=60, capacity=10)
+    for i in range(50):
+        assert cache.run(f"key-{i}", ["deposit", i], lambda: Money(i)) == Money(i)
+    assert len(cache.entries) == 10
+    assert cache.lines <= 20
+    assert cache.run("key-49", ["deposit", 49], lambda: Money(0)) == Money(49)
+    cache.close()
+
+    cache = Idempotency_Cache(str(tmp_path / "bank_users.csv.keys"), ttl=0, capacity=10)
+    assert len(cache.entries) == 10
+    assert cache.run("key-1", ["deposit", 1], lambda: Money(7)) == Money(7)
+    assert cache.run("key-1", ["deposit", 1], lambda: Money(8)) == Money(8)
+    cache.close()
+
+
+
+"""Tests the rate limits
+   Each account has a token bucket for its operations and a rolling daily limit on money sent"""
+# Tests that a burst is allowed, the next operation is refused, and tokens come back with time
+def test_rate_limit_bucket(service):
+    limits = service.enable_rate_limits(rate=2, burst=3)
+    now = 1000000.0
+    limits.clock = lambda: now
+    for _ in range(3):
+        service.deposit("lennyzhe", 10)
+    with pytest.raises(ValueError, match="Too many requests"):
+        service.deposit("lennyzhe", 10)
+    # Another account has its own bucket
+    service.deposit("tinotendam", 10)
+
+    now += 0.5
+    service.withdraw("lennyzhe", 10)
+    with pytest.raises(ValueError, match="Too many requests"):
+        service.transfer("lennyzhe", "tinotendam", 10)
+    assert service.balance("lennyzhe") == 520.00
+    assert limits.status("12345678")["requests_left"] == 0
+
+# Tests that withdrawals and transfers share a daily limit that rolls off over the next day
+def test_rate_limit_daily(service):
+    limits = service.enable_rate_limits(rate=1000, burst=1000, daily_limit=400)
+    now = 10 * Rate_Limiter.DAY + 3600.0
+    limits.clock = lambda: now
+    service.withdraw("lennyzhe", 200)
+    service.transfer("lennyzhe", "tinotendam", 150)
+    with pytest.raises(ValueError, match="daily limit"):
+        service.withdraw("lennyzhe", 100)
+    assert service.balance("lennyzhe") == 150.00
+    assert limits.status("12345678")["left_today"] == 50.00
+    # Deposits do not count
+    service.deposit("lennyzhe", 500)
+
+    # Half way through the next day, half of yesterday's total still counts
+    now = 11 * Rate_Limiter.DAY + Rate_Limiter.DAY / 2
+    assert limits.status("12345678")["sent_today"] == 175.00
+    service.withdraw("lennyzhe", 225)
+    with pytest.raises(ValueError, match="daily limit"):
+        service.withdraw("lennyzhe", 1)
+    now = 13 * Rate_Limiter.DAY
+    service.withdraw("lennyzhe", 400)
+
+# Tests that a batch counts each sender's net debit against the daily limit and takes one operation from it
+def test_rate_limit_batch(service):
+    limits = service.enable_rate_limits(rate=1, burst=2, daily_limit=50)
+    now = 1000000.0
+    limits.clock = lambda: now
+    with pytest.raises(ValueError, match="daily limit"):
+        service.transfer_batch([("lennyzhe", "tinotendam", 40), ("lennyzhe", "tinotendam", 30)])
+    assert service.balance("lennyzhe") == 500.00
+
+    service.transfer_batch([("lennyzhe", "tinotendam", 40), ("tinotendam", "lennyzhe", 20)])
+    assert limits.status("12345678")["sent_today"] == 20.00
+    assert limits.status("87654321")["sent_today"] == 0
+    with pytest.raises(ValueError, match="Too many requests"):
+        service.transfer_batch([("lennyzhe", "tinotendam", 10)])
+    assert service.balance("lennyzhe") == 480.00
+
+# Tests that a refusal by the limits is not remembered under an idempotency key, so a later retry goes through
+def test_rate_limit_idempotent_retry(service):
+    limits = service.enable_rate_limits(rate=1, burst=1, daily_limit=100)
+    now = 1000000.0
+    limits.clock = lambda: now
+    service.deposit("lennyzhe", 10)
+    with pytest.raises(ValueError, match="Too many requests"):
+        service.deposit("lennyzhe", 10, key="retry-1")
+    now += 100
+    assert service.deposit("lennyzhe", 10, key="retry-1") == 520.00
+    assert service.deposit("lennyzhe", 10, key="retry-1") == 520.00
+
+    now += 100
+    service.withdraw("lennyzhe", 60)
+    now += 100
+    with pytest.raises(ValueError, match="daily limit"):
+        service.withdraw("lennyzhe", 60, key="retry-2")
+    now += Rate_Limiter.DAY * 2
+    assert service.withdraw("lennyzhe", 60, key="retry-2") == 400.00
+
+
+
+"""Tests the end-of-period interest and fee job
+   Every balance is updated in one pass and saved in one snapshot"""
+# Tests tiered interest with half-even rounding against Decimal arithmetic
+def test_interest_schedule():
+    schedule = Interest_Schedule(tiers=[(0, "0.12"), (1000, "0.24")], monthly_fee=0, penalty=0)
+    assert schedule.interest(50) == 0
+    assert schedule.interest(150) == 2
+    assert schedule.interest(200000) == 3000
+
+    rng = random.Random(7)
+    balances = [rng.randrange(0, 5000000) for _ in range(2000)]
+    closing, interest, fees, penalties = schedule.apply(array("q", balances))
+    for cents, balance in zip(balances, closing):
+        exact = Decimal(min(cents, 100000)) / 100 + Decimal(max(cents - 100000, 0)) * 2 / 100
+        assert balance - cents == int(exact.quantize(Decimal(1), ROUND_HALF_EVEN))
+    assert interest == sum(closing) - sum(balances)
+    assert fees == penalties == 0
+
+    # A negative balance earns nothing and pays nothing
+    charged = Interest_Schedule()
+    assert charged.apply(array("q", [-500])) == (array("q", [-500]), 0, 0, 0)
+    assert charged.charges(-500) == (0, 0, 0)
+
+# Tests fees, penalties, persistence, ledger entries and closing a period twice
+def test_close_period(service, tmp_path):
+    service.credentials = Credential_Hasher(cost=1000)
+    service.users["tafadzwa_27"] = Account_User("tafadzwa_27", "Password@", Bank_Account("11112222", 3.00))
+    service.ledger = Transaction_Ledger(str(tmp_path / "bank_users.ledger"))
+    report = service.close_period(Interest_Schedule(), "2024-06")
+    assert report["accounts"] == 3
+    assert service.balance("lennyzhe") == Money.parse("495.21")
+    assert service.balance("tinotendam") == Money.parse("295.12")
+    # The fee takes what is left and the penalty finds nothing
+    assert service.balance("tafadzwa_27") == 0
+    assert report["interest"] == Money.parse("0.33") and report["fees"] == Money.parse("13.00")
+    assert [record["kind"] for record in service.statement("lennyzhe")] == ["interest", "fee"]
+
+    with pytest.raises(ValueError):
+        service.close_period(Interest_Schedule(), "2024-06")
+    service.close()
+
+    columnar = Bank_Service(service.path, Transaction_Journal(service.journal.path), columnar=True)
+    columnar.load_users()
+    assert columnar.balance("lennyzhe") == Money.parse("495.21")
+    columnar.close_period(Interest_Schedule(monthly_fee=0), "2024-07")
+    assert columnar.balance("lennyzhe") == Money.parse("495.42")
+
+# Tests that a close cut short after its marker is not applied again, and that concurrent closes apply once
+def test_close_period_once(service):
+    service.credentials = Credential_Hasher(cost=1000)
+    service.save_users()
+    save = service.storage.save
+
+    # Crashes once the new snapshot is on disk and marked, before it replaces the old one
+    def crash(rows, before_replace=None):
+        list(rows)
+        before_replace()
+        raise OSError("crashed")
+    service.storage.save = crash
+    with pytest.raises(OSError):
+        service.close_period(Interest_Schedule(), "2024-06")
+    service.storage.save = save
+
+    restarted = Bank_Service(service.path, Transaction_Journal(service.journal.path))
+    restarted.load_users()
+    with pytest.raises(ValueError, match="already closed"):
+        restarted.close_period(Interest_Schedule(), "2024-06")
+    assert restarted.balance("lennyzhe") == 500.00
+
+    outcomes = []
+    def close():
+        try:
+            restarted.close_period(Interest_Schedule(monthly_fee=0), "2024-07")
+            outcomes.append("closed")
+        except ValueError:
+            outcomes.append("refused")
+    threads = [threading.Thread(target=close) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(outcomes) == ["closed", "refused", "refused", "refused"]
+    assert restarted.balance("lennyzhe") == Money.parse("500.21")
+
+    # A save that fails before the marker leaves the balances alone, so retrying charges only once
+    def fail(rows, before_replace=None):
+        raise OSError("disk full")
+    restarted.storage.save = fail
+    with pytest.raises(OSError):
+        restarted.close_period(Interest_Schedule(monthly_fee=0), "2024-08")
+    del restarted.storage.save
+    assert restarted.balance("lennyzhe") == Money.parse("500.21")
+    restarted.close_period(Interest_Schedule(monthly_fee=0), "2024-08")
+    closing = Interest_Schedule(monthly_fee=0).apply([50021])[0]
+    assert restarted.balance("lennyzhe") == Money(closing[0])
+    restarted.close()
+
+
+"""Tests the binary snapshot
+   Users are looked up in the memory-mapped file and changes go to its journal until the next save"""
+# Tests the service rules on a snapshot, and that compaction and a restart see every change
+def test_snapshot_storage(service, tmp_path):
+    storage = Snapshot_Storage(str(tmp_path / "bank_users.snap"))
+    storage.save(service.user_row(user) for user in service.users.values())
+    bank = Bank_Service(storage=storage)
+    bank.credentials = Credential_Hasher(cost=1000)
+    assert bank.load_users()
+    assert storage.users.verify()
+
+    user = bank.signup("tafadzwa_27", "Password@")
+    bank.deposit("lennyzhe", 200)
+    bank.transfer("lennyzhe", user.account.account_number, 100)
+    assert bank.users["lennyzhe"] is bank.users["lennyzhe"]
+    assert bank.account_owner("87654321") == "tinotendam"
+    assert bank.account_owner(user.account.account_number) == "tafadzwa_27"
+    assert "nobody" not in bank.users and len(bank.users) == 3
+
+    bank.save_users()
+    assert storage.users.count == 3 and not storage.users.journal_offsets
+    assert bank.users["tafadzwa_27"] is user
+    bank.withdraw("tinotendam", 50)
+    bank.close()
+
+    restarted = Bank_Service(storage=Snapshot_Storage(storage.path))
+    restarted.credentials = bank.credentials
+    restarted.load_users()
+    assert restarted.balance("lennyzhe") == 600.00
+    assert restarted.balance("tinotendam") == 250.00
+    assert restarted.login("tafadzwa_27", "Password@").username == "tafadzwa_27"
+    assert sorted(restarted.users) == ["lennyzhe", "tafadzwa_27", "tinotendam"]
+
+    # A save part-way through a stream maps the new file, and the stream finishes over the old one
+    users = restarted.users.values()
+    first = next(users)
+    restarted.storage.save([restarted.user_row(restarted.users["lennyzhe"])])
+    assert len(restarted.users) == 1
+    assert sorted([first.username] + [user.username for user in users]) == ["lennyzhe", "tafadzwa_27", "tinotendam"]
+    restarted.close()
+
+# Tests that changed users are not held once evicted, and are read back from their journal rows
+def test_snapshot_evicts_changed_users(service, tmp_path):
+    storage = Snapshot_Storage(str(tmp_path / "bank_users.snap"), capacity=1)
+    storage.save(service.user_row(user) for user in service.users.values())
+    bank = Bank_Service(storage=storage)
+    bank.load_users()
+    bank.deposit("lennyzhe", 200)
+    bank.deposit("tinotendam", 50)
+    gc.collect()
+    assert "lennyzhe" not in storage.users.live
+    assert list(storage.users.journal_offsets) == ["lennyzhe", "tinotendam"]
+
+    assert bank.balance("lennyzhe") == 700.00
+    assert [user.account.check_balance() for user in storage.users.values()] == [700.00, 350.00]
+    bank.close()
+
+# Tests the round trip through the snapshot tool, and that a damaged or newer file is refused
+def test_snapshot_export(service, tmp_path):
+    service.credentials = Credential_Hasher(cost=1000)
+    service.save_users()
+    service.deposit("lennyzhe", 100)
+
+    snap = str(tmp_path / "bank_users.snap")
+    run_snapshot(argparse.Namespace(action="build", csv=service.path, journal=service.journal.path, snap=snap))
+    exported = str(tmp_path / "exported.csv")
+    run_snapshot(argparse.Namespace(action="export", csv=exported, journal=str(tmp_path / "exported.journal"), snap=snap))
+    with open(exported) as exported_file:
+        assert exported_file.read().splitlines()[0].startswith("lennyzhe,")
+    bank = Bank_Service(exported, Transaction_Journal(str(tmp_path / "exported.journal")))
+    bank.load_users()
+    assert bank.balance("lennyzhe") == 600.00
+    assert bank.balance("tinotendam") == 300.00
+
+    with open(snap, mode='r+b') as snap_file:
+        snap_file.seek(-1, os.SEEK_END)
+        snap_file.write(b"!")
+    storage = Snapshot_Storage(snap)
+    assert not storage.load().verify()
+    storage.close()
+    with open(snap, mode='r+b') as snap_file:
+        snap_file.seek(8)
+        snap_file.write(b"\x02")
+    with pytest.raises(ValueError):
+        Snapshot_Storage(snap).load()
+
+
+
+"""Tests the snapshot reads
+   A Balance_View sees every balance as of the moment it was opened, while writers carry on"""
+# Tests that a view keeps its versions while changes go on, and that they are dropped once it closes
+def test_balance_view(service):
+    versions = service.enable_snapshot_reads()
+    service.deposit("lennyzhe", 100)
+    with service.read_view() as before:
+        service.transfer("lennyzhe", "tinotendam", 250)
+        service.transfer_batch([("tinotendam", "lennyzhe", 50)])
+        with service.read_view() as after:
+            service.withdraw("tinotendam", 100)
+            assert before.balance("lennyzhe") == 600.00 and before.balance("tinotendam") == 300.00
+            assert after.balance("lennyzhe") == 400.00 and after.balance("tinotendam") == 500.00
+            assert dict(after.balances()) == {"lennyzhe": 400.00, "tinotendam": 500.00}
+            assert before.total_deposits() == after.total_deposits() == 900.00
+        assert service.balance("tinotendam") == 400.00
+    assert versions.chains == {} and versions.readers == {}
+
+    with pytest.raises(ValueError):
+        Bank_Service(service.path).read_view()
+
+# Tests that a reader keeps reading the balance of its version after later changes commit,
+# and that a change is not visible to a reader opened while it is being made
+def test_version_store():
+    versions = Version_Store()
+    account = Bank_Account("12345678", 500.00)
+    old = versions.open()
+    with versions.writing([account]):
+        account.deposit(200)
+        during = versions.open()
+        assert versions.read(account, during) == 50000
+    new = versions.open()
+    with versions.writing([account]):
+        account.withdraw(100)
+
+    assert versions.read(account, old) == versions.read(account, during) == 50000
+    assert versions.read(account, new) == 70000
+    assert list(versions.read_all([account], old)) == [50000]
+    assert versions.read(account, versions.open()) == account.cents == 60000
+
+    for version in (old, during, new, versions.version):
+        versions.close(version)
+    assert versions.chains == {} and versions.readers == {}
+
+# Tests that views opened during concurrent random transfers never see money created or lost
+def test_balance_view_under_transfers(service):
+    service.journal.sync = False
+    service.users = {}
+    for i in range(20):
+        service.users[f"user{i:04d}"] = Account_User(f"user{i:04d}", "password@12", Bank_Account(str(10000000 + i), 1000.00))
+    service.enable_snapshot_reads()
+
+    rng = random.Random(11)
+    lines = [json.dumps({"op": "transfer", "username": f"user{rng.randrange(20):04d}",
+                         "recipient": f"user{rng.randrange(20):04d}", "amount": rng.randrange(1, 400)})
+             for _ in range(4000)]
+    totals = []
+    engine = threading.Thread(target=Batch_Engine(service, workers=4, chunk_size=100).run, args=(lines,))
+    engine.start()
+    while engine.is_alive():
+        with service.read_view() as view:
+            totals.append(view.total_deposits())
+    engine.join()
+
+    assert set(totals) <= {Money.parse("20000")}
+    assert service.versions.chains == {}
+
+
+
+"""Tests the reconciliation tool
+   The file is checked in chunks across processes, and duplicates are found across chunks"""
+# Tests that a clean file passes and matches its control total
+def test_reconcile_clean(service, tmp_path):
+    service.users = {f"user{i:04d}": Account_User(f"user{i:04d}", "password@12", Bank_Account(str(10000000 + i), 12.34))
+                     for i in range(500)}
+    service.save_users()
+    report = Reconciler(service.path, workers=2, chunk_size=1000).run(expected_total="6170")
+    assert report["ok"] and report["rows"] == 500 and report["total"] == Money.parse("6170")
+    assert len(report["chunks"]) > 1 and sum(chunk["rows"] for chunk in report["chunks"]) == 500
+    assert not Reconciler(service.path, workers=2).run(expected_total="6170.01")["ok"]
+
+# Tests that bad rows, duplicates in different chunks and a cut-off last row are all reported
+def test_reconcile_problems(tmp_path):
+    path = str(tmp_path / "bank_users.csv")
+    rows = [f"user{i:04d},password@12,{10000000 + i},100.0" for i in range(300)]
+    rows[5] = "user0005,password@12,10000005"
+    rows[6] = "user0006,password@12,10000006,-5.00"
+    rows[250] = "user0010,password@12,10000250,100.0"
+    rows[260] = "user0260,password@12,10000020,100.0"
+    with open(path, mode='w') as user_file:
+        user_file.write("\n".join(rows) + "\nuser0300,pass")
+
+    report = Reconciler(path, workers=2, chunk_size=2000).run()
+    assert not report["ok"] and report["truncated"]
+    assert report["malformed"] == 2 and report["negative"] == 1
+    assert report["duplicate_usernames"] == 1 and report["duplicate_accounts"] == 1
+    offsets = list(accumulate(len(row) + 1 for row in rows))
+    assert report["examples"]["usernames"] == {"user0010": [offsets[9], offsets[249]]}
+    assert list(report["examples"]["accounts"]) == ["10000020"]
+    assert [example["reason"] for example in report["examples"]["rows"]] == ["3 fields instead of 4", "negative balance", "2 fields instead of 4"]
+
+
+
+"""Tests the session table
+   Tokens map to usernames, and idle sessions expire through the timing wheel"""
+# Tests that used sessions stay alive, idle ones expire, and ended ones are gone, across every wheel level
+def test_session_table():
+    now = 0.0
+    sessions = Session_Table(idle_timeout=5000, clock=lambda: now)
+    idle = sessions.create("lennyzhe")
+    busy = sessions.create("tinotendam")
+    ended = sessions.create("tafadzwa_27")
+    assert idle != busy and sessions.validate(busy) == "tinotendam"
+    assert sessions.end(ended) and not sessions.end(ended) and sessions.validate(ended) is None
+
+    # The busy session is used every 4000 seconds, so its deadline keeps moving
+    for _ in range(3):
+        now += 4000
+        assert sessions.validate(busy) == "tinotendam"
+    assert sessions.validate(idle) is None and len(sessions) == 1
+    now += 5000
+    assert sessions.expire() == 1 and len(sessions) == 0
+
+    # Sessions with deadlines spread over several levels each expire on the tick they are due
+    wheel = Session_Table(idle_timeout=70000, clock=lambda: now)
+    deadlines = []
+    for i in range(300):
+        now += 250
+        wheel.create(f"user{i:04d}")
+        deadlines.append(now + 70000)
+    while len(wheel):
+        now += 100
+        wheel.expire()
+        assert len(wheel) == sum(deadline > now for deadline in deadlines)
+    assert now < deadlines[-1] + 100
+
+# Tests that operations go through session tokens, and that an expired token is refused
+def test_service_sessions(service):
+    service.credentials = Credential_Hasher(cost=1000)
+    now = 0.0
+    service.sessions = Session_Table(idle_timeout=60, clock=lambda: now)
+    token = service.open_session("lennyzhe", "password@12")
+    other = service.open_session("tinotendam", "sexxyredd")
+    service.deposit(service.session_user(token), 100)
+    service.transfer(service.session_user(other), "lennyzhe", 50)
+    assert service.balance(service.session_user(token)) == 650.00
+
+    now += 59
+    service.session_user(token)
+    now += 59
+    assert service.session_user(token) == "lennyzhe"
+    with pytest.raises(ValueError, match="log in"):
+        service.session_user(other)
+    assert service.close_session(token)
+    with pytest.raises(ValueError, match="log in"):
+        service.session_user(token)